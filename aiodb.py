@@ -0,0 +1,171 @@
+# coding=utf-8
+# __author__ = 'Mario Romera Fernández'
+
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import db
+import feed
+import writer
+
+
+# Threads running SQLite work, as many as pooled connections so they never wait for one
+THREADS = db.POOL_SIZE
+
+_executor = None
+
+
+def get_executor():
+    """
+    Returns the bounded thread pool running SQLite work, creating it on first use
+    :return: concurrent.futures.ThreadPoolExecutor
+    """
+
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=THREADS, thread_name_prefix='aiodb')
+    return _executor
+
+
+def shutdown():
+    """
+    Waits for running SQLite work and stops the thread pool
+    :return: None
+    """
+
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
+
+
+async def run(function, *args, **kwargs):
+    """
+    Runs a blocking data layer function in the thread pool
+    :param function: FUNCTION to run
+    :return: function result
+    """
+
+    return await asyncio.get_running_loop().run_in_executor(get_executor(),
+                                                            functools.partial(function, *args, **kwargs))
+
+
+async def ingest(message, result=None):
+    """
+    Async writer.ingest
+    :param message: DICT or provider.Message received from external provider
+    :param result: DICT filled with 'changed', 'unchanged' and 'unknown' selections for 'UpdateOdds' messages
+    :return: BOOLEAN True if the message has been processed, False if it had been already processed
+    """
+
+    return await run(writer.ingest, message, result)
+
+
+async def ingest_parsed(batch):
+    """
+    Async feed.ingest_parsed
+    :param batch: LIST of (INT line number, provider.Message or None, provider.MessageError or None)
+    :return: LIST of DICT per-message results
+    """
+
+    return await run(feed.ingest_parsed, batch)
+
+
+async def get_match_snapshot(match_id):
+    """
+    Async db.get_match_snapshot; cached matches are returned without leaving the event loop
+    :param match_id: INT match id
+    :return: cache.Snapshot or None if not found
+    """
+
+    snapshot = db.MATCH_CACHE.get(match_id)
+    if snapshot is not None:
+        return snapshot
+    return await run(db.get_match_snapshot, match_id)
+
+
+async def get_odds_history(match_id, start=None, end=None):
+    """
+    Async db.get_odds_history
+    :return: DICT odds history or None if the match does not exist
+    """
+
+    return await run(db.get_odds_history, match_id, start, end)
+
+
+async def get_match_snapshots(match_ids):
+    """
+    Async db.get_match_snapshots
+    :param match_ids: LIST of INT match ids
+    :return: LIST of cache.Snapshot
+    """
+
+    return await run(db.get_match_snapshots, match_ids)
+
+
+async def iter_match_snapshots(match_ids):
+    """
+    Async db.iter_match_snapshots, reading one chunk of matches at a time in the thread pool
+    :param match_ids: LIST of INT match ids
+    :return: ASYNC GENERATOR of cache.Snapshot
+    """
+
+    match_ids = list(dict.fromkeys(match_ids))
+    for index in range(0, len(match_ids), db.MATCHES_FETCH_CHUNK):
+        for snapshot in await get_match_snapshots(match_ids[index:index + db.MATCHES_FETCH_CHUNK]):
+            yield snapshot
+
+
+async def get_match_by_name(match_name, limit=None):
+    """
+    Async db.get_match_by_name
+    :param match_name: STR match name
+    :param limit: INT maximum number of matches or None for every match
+    :return: LIST of DICT matches data
+    """
+
+    return await run(db.get_match_by_name, match_name, limit)
+
+
+async def search_matches(text, limit=db.SEARCH_LIMIT):
+    """
+    Async db.search_matches
+    :param text: STR search text
+    :param limit: INT maximum number of matches
+    :return: LIST of DICT matches data
+    """
+
+    return await run(db.search_matches, text, limit)
+
+
+async def get_matches_by_start_time(sport_name, start=None, end=None, cursor=None, limit=db.MATCHES_PAGE_SIZE):
+    """
+    Async db.get_matches_by_start_time
+    :return: TUPLE (LIST of DICT matches data, STR cursor of the next page or None)
+    """
+
+    return await run(db.get_matches_by_start_time, sport_name, start, end, cursor, limit)
+
+
+async def iter_matches_by_start_time(sport_name, start=None, end=None, cursor=None):
+    """
+    Async db.iter_matches_by_start_time, reading one page at a time in the thread pool
+    :return: ASYNC GENERATOR of DICT matches data
+    """
+
+    while True:
+        matches, cursor = await get_matches_by_start_time(sport_name, start, end, cursor, db.MATCHES_PAGE_SIZE)
+        for match in matches:
+            yield match
+        if cursor is None:
+            return
+
+
+async def stats():
+    """
+    Async writer.stats
+    :return: DICT stats by component
+    """
+
+    return await run(writer.stats)
@@ -0,0 +1,600 @@
+# coding=utf-8
+# __author__ = 'Mario Romera Fernández'
+
+import argparse
+import asyncio
+import copy
+import datetime
+import importlib
+import json
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+import timeit
+from urllib.parse import urlsplit
+
+import db
+import provider
+import serialize
+import statements
+
+
+# Message shapes of synthetic traffic, as sent by external providers
+TEMPLATE_DIR = os.path.dirname(os.path.abspath(__file__))
+NEW_EVENT_TEMPLATE = os.path.join(TEMPLATE_DIR, 'newevent.json')
+UPDATE_ODDS_TEMPLATE = os.path.join(TEMPLATE_DIR, 'updateodds.json')
+
+# Default synthetic traffic: events, markets per event, selections per market and odds updates
+TRAFFIC_EVENTS = 200
+TRAFFIC_MARKETS = 10
+TRAFFIC_SELECTIONS = 3
+TRAFFIC_UPDATES = 2000
+
+# Matches per page of the listing scenario
+BENCH_PAGE_SIZE = 50
+
+# Matches per bulk fetch scenario
+BENCH_IDS_BATCH = 100
+
+
+def synthetic_rows(markets, selections=3, event_id=1):
+    """
+    Builds joined event rows as returned by the get match by id query
+    :param markets: INT number of markets
+    :param selections: INT number of selections per market
+    :param event_id: INT event id
+    :return: LIST of rows ordered by market and selection
+    """
+
+    return [(event_id, 'Home vs Away', 1529487000, 221, 'Football',
+             market, 'Market %i' % market, market * 1000 + selection, 'Selection %i' % selection, 1.01)
+            for market in range(1, markets + 1) for selection in range(selections)]
+
+
+def group_markets_quadratic(results):
+    """
+    Former get match by id grouping: a set of markets and a scan of every row per market
+    Kept as reference for the benchmark
+    :param results: LIST of joined event rows
+    :return: LIST of DICT markets data
+    """
+
+    markets_list = []
+    markets = set([(x[5], x[6]) for x in results])
+    for market in markets:
+        selections = [(x[7], x[8], x[9]) for x in results if (x[5], x[6]) == market]
+        markets_list.append({'id': market[0],
+                             'name': market[1],
+                             'selections': [{'id': selection[0],
+                                             'name': selection[1],
+                                             'odds': selection[2]} for selection in selections]})
+    return markets_list
+
+
+def bench_grouping(sizes=(10, 100, 1000), selections=3):
+    """
+    Times market/selection grouping of get match by id for events of several sizes
+    :param sizes: TUPLE of INT number of markets per event
+    :param selections: INT number of selections per market
+    :return: LIST of DICT {'markets', 'quadratic', 'single_pass', 'speedup'} timings in seconds
+    """
+
+    report = []
+    for markets in sizes:
+        rows = synthetic_rows(markets, selections)
+        number = max(1, 10000 // (markets * selections))
+        quadratic = min(timeit.repeat(lambda: group_markets_quadratic(rows), number=number, repeat=3)) / number
+        single_pass = min(timeit.repeat(lambda: db._group_markets(rows), number=number, repeat=3)) / number
+        report.append({'markets': markets,
+                       'quadratic': quadratic,
+                       'single_pass': single_pass,
+                       'speedup': quadratic / single_pass})
+    return report
+
+
+def bench_statements(sizes=(1000, 10000), selections=1000):
+    """
+    Times odds updates with SQL formatted per update, as the data layer used to build it, against
+    the registered statement with bound parameters, on an in-memory SELECTIONS table
+    :param sizes: TUPLE of INT number of updates
+    :param selections: INT number of selections in the table
+    :return: LIST of DICT {'updates', 'formatted', 'bound', 'speedup'} timings in seconds per update
+    """
+
+    conn = sqlite3.connect(':memory:', cached_statements=db.POOL_CACHED_STATEMENTS)
+    conn.execute('''CREATE TABLE SELECTIONS (Se_ID INTEGER PRIMARY KEY, Se_NAME text, Se_ODDS FLOAT,
+                                            Se_MARKETID INTEGER, Se_EVENTID INTEGER);''')
+    conn.executemany('''INSERT INTO SELECTIONS VALUES(?, ?, ?, ?, ?);''',
+                     [(selection, 'Selection %i' % selection, 1.01, selection // 3, 1)
+                      for selection in range(selections)])
+    conn.commit()
+    statement = statements.Statement('update_odds', db.UPDATE_ODDS.sql)
+    cur = conn.cursor()
+
+    def formatted(updates):
+        for update in updates:
+            cur.execute('''UPDATE SELECTIONS SET Se_ODDS = %r WHERE
+                           Se_ID = %i AND Se_MARKETID = %i AND Se_EVENTID = %i;''' % update)
+
+    def bound(updates):
+        for update in updates:
+            statement.execute(cur, update)
+
+    report = []
+    for size in sizes:
+        updates = [(1.01 + index / 1000.0, index % selections, index % selections // 3, 1) for index in range(size)]
+        formatted_time = min(timeit.repeat(lambda: formatted(updates), number=1, repeat=3)) / size
+        bound_time = min(timeit.repeat(lambda: bound(updates), number=1, repeat=3)) / size
+        report.append({'updates': size,
+                       'formatted': formatted_time,
+                       'bound': bound_time,
+                       'speedup': formatted_time / bound_time})
+    conn.close()
+    return report
+
+
+def print_report(report):
+    """
+    Prints a benchmark report as a table
+    :param report: LIST of DICT with the same keys
+    :return: None
+    """
+
+    if not report:
+        return
+    columns = list(report[0].keys())
+    print(' '.join('%14s' % column for column in columns))
+    for line in report:
+        print(' '.join('%14.6g' % line[column] if isinstance(line[column], float) else '%14s' % line[column]
+                       for column in columns))
+
+
+# Load test of the serving modes: Flask (python betbright_task-api.py) and ASGI
+# (uvicorn betbright_task_asgi:app --port 8000), both running against the same database
+LOAD_TEST_URLS = ('http://127.0.0.1:5000/api/v1/resources/match/994839351740',
+                  'http://127.0.0.1:8000/api/v1/resources/match/994839351740')
+LOAD_TEST_CONCURRENCY = 64
+LOAD_TEST_DURATION = 10.0
+
+
+def percentile(values, fraction):
+    """
+    Gets a percentile of a list of values
+    :param values: LIST of FLOAT values, sorted
+    :param fraction: FLOAT percentile as a fraction, e.g. 0.99
+    :return: FLOAT value or None if there are no values
+    """
+
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def _http_client(host, port, target, deadline, latencies):
+    """
+    Sends GET requests on a keep-alive connection until the deadline
+    :param host: STR server host
+    :param port: INT server port
+    :param target: STR request path and query
+    :param deadline: FLOAT loop time to stop at
+    :param latencies: LIST to append each request latency to, in seconds
+    :return: INT number of failed requests
+    """
+
+    loop = asyncio.get_running_loop()
+    request = ('GET %s HTTP/1.1\r\nHost: %s:%i\r\n\r\n' % (target, host, port)).encode('latin-1')
+    errors = 0
+    writer = None
+    while loop.time() < deadline:
+        start = time.perf_counter()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(host, port)
+            writer.write(request)
+            status = await reader.readline()
+            length = None
+            keep_alive = status.startswith(b'HTTP/1.1')
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                if name.lower() == 'content-length':
+                    length = int(value)
+                elif name.lower() == 'connection':
+                    keep_alive = value.strip().lower() == 'keep-alive'
+            if length is None:
+                await reader.read()
+            else:
+                await reader.readexactly(length)
+            if length is None or not keep_alive:
+                writer.close()
+                writer = None
+            if b' 200 ' not in status:
+                errors += 1
+                continue
+        except (OSError, asyncio.IncompleteReadError):
+            errors += 1
+            if writer is not None:
+                writer.close()
+            writer = None
+            continue
+        latencies.append(time.perf_counter() - start)
+    if writer is not None:
+        writer.close()
+    return errors
+
+
+async def load_test(url, concurrency=LOAD_TEST_CONCURRENCY, duration=LOAD_TEST_DURATION):
+    """
+    Sends GET requests to a url from concurrent keep-alive clients
+    :param url: STR url
+    :param concurrency: INT number of concurrent clients
+    :param duration: FLOAT seconds
+    :return: DICT {'url', 'requests', 'errors', 'rps', 'p50', 'p99'} latencies in seconds
+    """
+
+    parts = urlsplit(url)
+    target = parts.path + ('?' + parts.query if parts.query else '')
+    deadline = asyncio.get_running_loop().time() + duration
+    latencies = []
+    errors = await asyncio.gather(*[_http_client(parts.hostname, parts.port or 80, target, deadline, latencies)
+                                    for _ in range(concurrency)])
+    latencies.sort()
+    return {'url': url,
+            'requests': len(latencies),
+            'errors': sum(errors),
+            'rps': len(latencies) / duration,
+            'p50': percentile(latencies, 0.5),
+            'p99': percentile(latencies, 0.99)}
+
+
+def bench_serving(urls=LOAD_TEST_URLS, concurrency=LOAD_TEST_CONCURRENCY, duration=LOAD_TEST_DURATION):
+    """
+    Compares serving modes with the same load, one url after the other
+    :param urls: TUPLE of STR urls
+    :param concurrency: INT number of concurrent clients
+    :param duration: FLOAT seconds per url
+    :return: LIST of DICT load test results
+    """
+
+    return [asyncio.run(load_test(url, concurrency, duration)) for url in urls]
+
+
+class Traffic(object):
+    """
+    Synthetic provider traffic built from the shapes of newevent.json and updateodds.json
+    Ids are derived from the event index, so the same arguments always build the same messages
+    """
+
+    def __init__(self, events=TRAFFIC_EVENTS, markets=TRAFFIC_MARKETS, selections=TRAFFIC_SELECTIONS,
+                 updates=TRAFFIC_UPDATES, seed=0):
+        """
+        :param events: INT number of NewEvent messages
+        :param markets: INT number of markets per event
+        :param selections: INT number of selections per market
+        :param updates: INT number of UpdateOdds messages, spread randomly over the events
+        :param seed: INT random seed
+        """
+
+        with open(NEW_EVENT_TEMPLATE) as template:
+            self._new_event = json.load(template)
+        with open(UPDATE_ODDS_TEMPLATE) as template:
+            self._update_odds = json.load(template)
+        self._random = random.Random(seed)
+        self._message_id = 0
+        self.markets = markets
+        self.selections = selections
+        self.new_events = [self.new_event(index) for index in range(events)]
+        self.update_odds = [self.update(self._random.randrange(events)) for _ in range(updates)]
+
+    def _next_message_id(self):
+        self._message_id += 1
+        return self._message_id
+
+    def event_id(self, index):
+        """
+        :param index: INT event index
+        :return: INT event id
+        """
+
+        return 1000000 + index
+
+    def new_event(self, index):
+        """
+        Builds a NewEvent message with markets * selections selections
+        :param index: INT event index
+        :return: DICT message
+        """
+
+        event_id = self.event_id(index)
+        start_time = datetime.datetime(2018, 6, 20, 10, 30) + datetime.timedelta(minutes=15 * index)
+        message = copy.deepcopy(self._new_event)
+        message['id'] = self._next_message_id()
+        message['event'].update({'id': event_id,
+                                 'name': 'Home %i vs Away %i' % (index, index),
+                                 'startTime': start_time.strftime("%Y-%m-%d %H:%M:%S"),
+                                 'markets': [{'id': event_id * 1000 + market,
+                                              'name': 'Market %i' % market,
+                                              'selections': [{'id': (event_id * 1000 + market) * 100 + selection,
+                                                              'name': 'Selection %i' % selection,
+                                                              'odds': 2.0}
+                                                             for selection in range(self.selections)]}
+                                             for market in range(self.markets)]})
+        return message
+
+    def update(self, index):
+        """
+        Builds an UpdateOdds message with new odds for every selection of one market of an event
+        :param index: INT event index
+        :return: DICT message
+        """
+
+        event_id = self.event_id(index)
+        market_id = event_id * 1000 + self._random.randrange(self.markets)
+        message = copy.deepcopy(self._update_odds)
+        message['id'] = self._next_message_id()
+        message['event'].update({'id': event_id,
+                                 'name': 'Home %i vs Away %i' % (index, index),
+                                 'markets': [{'id': market_id,
+                                              'name': 'Market',
+                                              'selections': [{'id': market_id * 100 + selection,
+                                                              'name': 'Selection %i' % selection,
+                                                              'odds': round(self._random.uniform(1.01, 20.0), 2)}
+                                                             for selection in range(self.selections)]}]})
+        return message
+
+    def duplicates(self):
+        """
+        Replay of every message already built, as sent again by a provider
+        :return: LIST of DICT messages
+        """
+
+        return self.new_events + self.update_odds
+
+
+def measure(scenario, function, items):
+    """
+    Calls a function once per item and times every call
+    :param scenario: STR scenario name
+    :param function: FUNCTION called with each item
+    :param items: LIST of items
+    :return: DICT {'scenario', 'ops', 'ops_s', 'p50', 'p99'} latencies in seconds
+    """
+
+    latencies = []
+    start = time.perf_counter()
+    for item in items:
+        call_start = time.perf_counter()
+        function(item)
+        latencies.append(time.perf_counter() - call_start)
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {'scenario': scenario,
+            'ops': len(items),
+            'ops_s': len(items) / elapsed if elapsed else 0.0,
+            'p50': percentile(latencies, 0.5),
+            'p99': percentile(latencies, 0.99)}
+
+
+def _run_scenarios(traffic, ingest, match_by_id, match_by_name, match_by_time, matches_by_ids):
+    """
+    Runs the scenarios of synthetic traffic on an empty temporary database
+    Matches are read five times each, so reads are measured mostly from the match cache. Bulk fetches
+    of BENCH_IDS_BATCH matches are measured with an empty match cache
+    :param traffic: Traffic
+    :param ingest: FUNCTION ingesting a message
+    :param match_by_id: FUNCTION getting a match by id
+    :param match_by_name: FUNCTION getting matches by name
+    :param match_by_time: FUNCTION getting the first page of matches of a sport by start time
+    :param matches_by_ids: FUNCTION getting matches by a LIST of ids
+    :return: LIST of DICT measures
+    """
+
+    def cold_matches_by_ids(match_ids):
+        db.MATCH_CACHE.clear()
+        matches_by_ids(match_ids)
+
+
+    directory = tempfile.mkdtemp(prefix='betbright-bench-')
+    database = db.DB_NAME
+    db.DB_NAME = os.path.join(directory, 'bench.db')
+    try:
+        db.create_db()
+        events = [message['event'] for message in traffic.new_events]
+        return [measure('new_event', ingest, traffic.new_events),
+                measure('update_odds', ingest, traffic.update_odds),
+                measure('duplicate', ingest, traffic.duplicates()),
+                measure('match_by_id', match_by_id, [event['id'] for event in events] * 5),
+                measure('match_by_name', match_by_name, [event['name'] for event in events] * 5),
+                measure('match_by_time', match_by_time, [event['sport']['name'] for event in events] * 5),
+                measure('matches_by_ids', cold_matches_by_ids,
+                        [[event['id'] for event in events[index:index + BENCH_IDS_BATCH]]
+                         for index in range(0, len(events), BENCH_IDS_BATCH)] * 5)]
+    finally:
+        db.get_pool().close()
+        db.DB_NAME = database
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def bench_db(traffic=None):
+    """
+    Times the data layer functions with synthetic traffic, in this process
+    :param traffic: Traffic or None for the default one
+    :return: LIST of DICT measures per scenario
+    """
+
+    return _run_scenarios(traffic or Traffic(), db.ingest, db.get_match_snapshot, db.get_match_by_name,
+                          lambda sport_name: db.get_matches_by_start_time(sport_name, limit=BENCH_PAGE_SIZE),
+                          db.get_match_snapshots)
+
+
+def bench_flask(traffic=None):
+    """
+    Times the Flask API with synthetic traffic through its test client, in this process
+    :param traffic: Traffic or None for the default one
+    :return: LIST of DICT measures per scenario
+    """
+
+    client = importlib.import_module('betbright_task-api').app.test_client()
+
+    def ingest(message):
+        client.post('/api/v1/resources/external/', data=json.dumps(message), content_type='application/json')
+
+    def get(path, query=None):
+        response = client.get('/api/v1/resources/' + path, query_string=query)
+        if response.status_code != 200:
+            raise AssertionError('GET %s returned %i' % (path, response.status_code))
+        return response.data
+
+    return _run_scenarios(traffic or Traffic(), ingest,
+                          lambda match_id: get('match/%i' % match_id),
+                          lambda name: get('match/', {'name': name}),
+                          lambda sport_name: get('match/sport/%s/' % sport_name,
+                                                 {'ordering': 'startTime', 'limit': BENCH_PAGE_SIZE}),
+                          lambda match_ids: get('match/', {'ids': ','.join(map(str, match_ids))}))
+
+
+def bench_snapshot(traffic=None):
+    """
+    Times starting a database from a snapshot against replaying the provider messages, on temporary
+    databases
+    :param traffic: Traffic or None for the default one
+    :return: LIST of DICT {'method', 'seconds', 'rows_s'} with the rows of every table
+    """
+
+    traffic = traffic or Traffic()
+    directory = tempfile.mkdtemp(prefix='betbright-bench-')
+    database = db.DB_NAME
+    path = os.path.join(directory, 'bench.snapshot')
+    try:
+        db.DB_NAME = os.path.join(directory, 'replay.db')
+        db.create_db()
+        start = time.perf_counter()
+        for message in traffic.new_events + traffic.update_odds:
+            db.ingest(message)
+        replay = time.perf_counter() - start
+        start = time.perf_counter()
+        rows = sum(db.export_snapshot(path).values())
+        export = time.perf_counter() - start
+        db.get_pool().close()
+
+        db.DB_NAME = os.path.join(directory, 'snapshot.db')
+        db.create_db()
+        start = time.perf_counter()
+        db.import_snapshot(path)
+        load = time.perf_counter() - start
+        return [{'method': method, 'seconds': seconds, 'rows_s': rows / seconds}
+                for method, seconds in (('replay', replay), ('export', export), ('import', load))]
+    finally:
+        db.get_pool().close()
+        db.DB_NAME = database
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def bench_decode(traffic=None, repeat=5):
+    """
+    Times decoding provider messages as received: JSON parsing only, with the json module and with
+    serialize.loads, against parsing and validating them into provider records, and start time
+    parsing with strptime against the cached parse
+    :param traffic: Traffic or None for the default one
+    :param repeat: INT number of runs, the fastest one is reported
+    :return: LIST of DICT {'decoder', 'messages', 'seconds', 'messages_s'}
+    """
+
+    traffic = traffic or Traffic()
+    bodies = [json.dumps(message).encode('utf-8') for message in traffic.new_events + traffic.update_odds]
+    start_times = [message['event']['startTime'] for message in traffic.new_events]
+    provider.parse_start_time.cache_clear()
+
+    decoders = (('json', bodies, json.loads),
+                ('serialize', bodies, serialize.loads),
+                ('validate_json', bodies, lambda body: provider.validate(json.loads(body))),
+                ('decode', bodies, provider.decode),
+                ('strptime', start_times,
+                 lambda value: int(datetime.datetime.strptime(value, provider.START_TIME_FORMAT).timestamp())),
+                ('start_time', start_times, provider.parse_start_time))
+    report = []
+    for name, items, decoder in decoders:
+        seconds = min(timeit.repeat(lambda: [decoder(item) for item in items], number=1, repeat=repeat))
+        report.append({'decoder': name,
+                       'messages': len(items),
+                       'seconds': seconds,
+                       'messages_s': len(items) / seconds})
+    return report
+
+
+def save_baseline(path, reports):
+    """
+    Saves benchmark reports to compare later runs against
+    :param path: STR baseline file
+    :param reports: DICT benchmark name -> LIST of DICT report lines
+    :return: None
+    """
+
+    with open(path, 'w') as baseline:
+        json.dump(reports, baseline, indent=2)
+
+
+def compare_reports(report, baseline):
+    """
+    Compares a report with its baseline, line by line
+    Lines are matched by their first column, numeric columns are given as current / baseline ratios
+    :param report: LIST of DICT report lines
+    :param baseline: LIST of DICT baseline report lines
+    :return: LIST of DICT comparison lines
+    """
+
+    if not report:
+        return []
+    key = list(report[0].keys())[0]
+    baseline = {str(line[key]): line for line in baseline}
+    comparison = []
+    for line in report:
+        previous = baseline.get(str(line[key]))
+        if previous is None:
+            continue
+        compared = {key: line[key]}
+        for column, value in line.items():
+            if column != key and isinstance(value, (int, float)) and previous.get(column):
+                compared[column] = float(value) / previous[column]
+        comparison.append(compared)
+    return comparison
+
+
+BENCHMARKS = {'grouping': bench_grouping,
+              'statements': bench_statements,
+              'db': bench_db,
+              'flask': bench_flask,
+              'serving': bench_serving,
+              'snapshot': bench_snapshot,
+              'decode': bench_decode}
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='BetBright API benchmarks')
+    parser.add_argument('benchmarks', nargs='*', default=['grouping'], choices=sorted(BENCHMARKS))
+    parser.add_argument('--save', metavar='FILE', help='save the reports as baseline')
+    parser.add_argument('--compare', metavar='FILE', help='compare the reports with a baseline')
+    arguments = parser.parse_args()
+
+    baselines = {}
+    if arguments.compare:
+        with open(arguments.compare) as baseline_file:
+            baselines = json.load(baseline_file)
+
+    reports = {}
+    for name in arguments.benchmarks:
+        reports[name] = BENCHMARKS[name]()
+        print(name)
+        print_report(reports[name])
+        if name in baselines:
+            print('%s / baseline' % name)
+            print_report(compare_reports(reports[name], baselines[name]))
+
+    if arguments.save:
+        save_baseline(arguments.save, reports)
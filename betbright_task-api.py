@@ -1,13 +1,82 @@
 # coding=utf-8
 # __author__ = 'Mario Romera Fernández'
 
+import gzip
+import time
+import zlib
 import flask
 import db
+import feed
+import metrics
+import provider
+import pubsub
+import serialize
+import writer
 
 app = flask.Flask(__name__)
 # app.config["DEBUG"] = True
 
 
+def _json_response(data):
+    """
+    Builds a JSON response with the fastest available encoder
+    :param data: JSON serializable data
+    :return: flask.Response
+    """
+
+    return flask.Response(serialize.dumps(data), mimetype='application/json')
+
+
+def _odds_headers(result):
+    """
+    Headers reporting the changed, unchanged and unknown selections of an odds update
+    :param result: DICT filled by writer.ingest
+    :return: DICT headers, empty for other messages
+    """
+
+    if 'changed' not in result:
+        return {}
+    return {'X-Odds-Changed': str(result['changed']), 'X-Odds-Unchanged': str(result['unchanged']),
+            'X-Odds-Unknown': str(result['unknown'])}
+
+
+@app.before_request
+def start_worker():
+    """
+    Prepares the process on its first request, see writer.start_worker
+    :return: None
+    """
+
+    writer.start_worker()
+
+
+@app.before_request
+def start_request_timer():
+    """
+    Starts timing the request and registers it with the slow request sampler
+    :return: None
+    """
+
+    flask.g.request_start = time.perf_counter()
+    metrics.SAMPLER.begin()
+
+
+@app.teardown_request
+def observe_request(error=None):
+    """
+    Records the request time by route in metrics.REQUEST_SECONDS
+    Streamed responses are timed until their first chunk is ready
+    :param error: Exception raised by the handler or None
+    :return: None
+    """
+
+    route = flask.request.endpoint or 'not_found'
+    metrics.SAMPLER.end(route)
+    start = flask.g.pop('request_start', None)
+    if start is not None:
+        metrics.REQUEST_SECONDS.observe(time.perf_counter() - start, (route,))
+
+
 @app.route('/', methods=['GET'])
 def home():
     """
@@ -25,26 +94,69 @@ def api_external_providers():
     Handler for external data providers
     Accepts POST & PUT requests
     Handles 'NewEvent' & 'UpdateOdds' messages from external providers
-    Checks for messages id to not process them if they have been already processed
+    Checks for messages id to not process them if they have been already processed, in the same
+    transaction that stores the message data
+    With a writer process (see writer.py) messages are written by it and a full queue gets 429
+    'UpdateOdds' only write the odds that changed, the X-Odds-Changed, X-Odds-Unchanged and
+    X-Odds-Unknown headers give the number of selections of each, unknown ones being ignored
+    Messages are parsed and validated (see provider.py) before any database work
     :return: Confirmation or deny html
     """
 
-    query_parameters = flask.request.get_json(force=True)
+    try:
+        message = provider.validate(serialize.loads(flask.request.get_data()))
+    except provider.MessageTypeError:
+        return "<h1>400</h1><p>Bad request: bad message_type</p>", 400
+    except provider.MessageError:
+        return "<h1>400</h1><p>Bad request: bad message</p>", 400
+    except ValueError:
+        return "<h1>400</h1><p>Bad request: bad JSON</p>", 400
 
-    if not db.message_processed(query_parameters['id']):
+    result = {}
+    try:
+        processed = writer.ingest(message, result)
+    except writer.MessageError:
+        return "<h1>400</h1><p>Bad request: bad message</p>", 400
+    except writer.QueueFull:
+        return "<h1>429</h1><p>Too many requests: ingest queue full</p>", 429, {'Retry-After': '1'}
+    except writer.WriterError:
+        return "<h1>503</h1><p>Ingest unavailable</p>", 503
 
-        if query_parameters['message_type'] == 'NewEvent':
-            db.new_event(query_parameters)
+    if processed:
+        return "<p>200</p>", 200, _odds_headers(result)
 
-        elif query_parameters['message_type'] == 'UpdateOdds':
-            db.update_odds(query_parameters)
+    return "<h1>400</h1><p>Message already processed</p>", 400
 
-        else:
-            return "<h1>400</h1><p>Bad request: bad message_type</p>", 400
 
-        return "<p>200</p>", 200
+@app.route('/api/v1/resources/external/bulk/', methods=['POST', 'PUT'])
+def api_external_providers_bulk():
+    """
+    Handler for external data providers sending messages in bulk
+    Accepts POST & PUT requests with newline-delimited JSON messages, optionally gzip encoded
+    (Content-Encoding: gzip). The body is parsed as it is read and stored in transactions of
+    'batch' messages (db.INGEST_BATCH_SIZE by default, up to db.INGEST_MAX_BATCH_SIZE)
+    :return: JSON list of per-message results or html info
+    """
 
-    return "<h1>400</h1><p>Message already processed</p>", 400
+    batch_size = flask.request.args.get('batch', db.INGEST_BATCH_SIZE, type=int)
+    if not 1 <= batch_size <= db.INGEST_MAX_BATCH_SIZE:
+        return "<h1>400</h1><p>Bad request: bad argument</p>", 400
+
+    stream = flask.request.stream
+    if flask.request.headers.get('Content-Encoding', '').lower() == 'gzip':
+        stream = gzip.GzipFile(fileobj=stream, mode='rb')
+
+    try:
+        results = feed.ingest_stream(stream, batch_size)
+    except writer.QueueFull:
+        # Batches already written are reported as duplicates when the body is sent again
+        return "<h1>429</h1><p>Too many requests: ingest queue full</p>", 429, {'Retry-After': '1'}
+    except writer.WriterError:
+        return "<h1>503</h1><p>Ingest unavailable</p>", 503
+    except (OSError, EOFError, zlib.error):
+        return "<h1>400</h1><p>Bad request: bad gzip body</p>", 400
+
+    return _json_response(results)
 
 
 @app.route('/api/v1/resources/match/<int:match_id>', methods=['GET'])
@@ -52,13 +164,87 @@ def api_get_match_by_id(match_id):
     """
     Handler for get match by id
     Accepts GET requests
+    The match is served as serialized when it was last written, tagged with an ETag that changes
+    with every write to the match. Requests with a matching If-None-Match get an empty 304
     :param match_id: INT the match id
     :return: JSON match info or html info
     """
 
-    match_info = db.get_match_by_id(match_id)
-    return ("<h1>404</h1><p>The resource could not be found.</p>", 404) if (
-            len(match_info) == 0) else flask.jsonify(match_info)
+    try:
+        match_id = db.parse_match_id(match_id)
+    except ValueError:
+        return "<h1>404</h1><p>The resource could not be found.</p>", 404
+
+    snapshot = db.get_match_snapshot(match_id)
+    if snapshot is None:
+        return "<h1>404</h1><p>The resource could not be found.</p>", 404
+
+    if flask.request.if_none_match.contains_weak(snapshot.etag):
+        response = flask.Response(status=304)
+    else:
+        response = flask.Response(snapshot.body, mimetype='application/json')
+    response.set_etag(snapshot.etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+@app.route('/api/v1/resources/match/<int:match_id>/stream', methods=['GET'])
+def api_match_stream(match_id):
+    """
+    Handler for the odds stream of a match
+    Accepts GET requests
+    Server-sent events: 'snapshot' with the match data, then 'odds' with a JSON list of
+    {'market', 'selection', 'odds'} deltas as odds are updated. Deltas are coalesced for slow
+    clients; clients too far behind get an 'overflow' event and must reconnect
+    :param match_id: INT the match id
+    :return: event stream or html info
+    """
+
+    try:
+        match_id = db.parse_match_id(match_id)
+    except ValueError:
+        return "<h1>404</h1><p>The resource could not be found.</p>", 404
+
+    subscription = db.ODDS_STREAM.subscribe(match_id)
+    if subscription is None:
+        return "<h1>503</h1><p>Too many subscriptions</p>", 503
+
+    # Snapshot taken after subscribing so no update is missed in between
+    snapshot = db.get_match_snapshot(match_id)
+    if snapshot is None:
+        subscription.close()
+        return "<h1>404</h1><p>The resource could not be found.</p>", 404
+
+    return flask.Response(pubsub.iter_events(snapshot, subscription), mimetype='text/event-stream',
+                          headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/api/v1/resources/match/<int:match_id>/history', methods=['GET'])
+def api_match_history(match_id):
+    """
+    Handler for the odds history of a match
+    Accepts GET requests
+    Arguments: from & to times as "%Y-%m-%d %H:%M:%S" (from included, to excluded)
+    Every selection of the match comes with the times, as unix times, and odds of its changes
+    :param match_id: INT the match id
+    :return: JSON odds history or html info
+    """
+
+    try:
+        match_id = db.parse_match_id(match_id)
+    except ValueError:
+        return "<h1>404</h1><p>The resource could not be found.</p>", 404
+
+    try:
+        start = db.parse_start_time(flask.request.args.get('from'))
+        end = db.parse_start_time(flask.request.args.get('to'))
+    except ValueError:
+        return "<h1>400</h1><p>Bad request: bad argument</p>", 400
+
+    odds_history = db.get_odds_history(match_id, start, end)
+    if odds_history is None:
+        return "<h1>404</h1><p>The resource could not be found.</p>", 404
+    return _json_response(odds_history)
 
 
 @app.route('/api/v1/resources/match/', methods=['GET'])
@@ -66,33 +252,162 @@ def api_get_match_by_name():
     """
     Handler for get match by name
     Accepts GET requests
+    Arguments: name for the exact match name or search for words of the name, prefixes included
+    (e.g. search=Real), best matches first; limit for the maximum number of matches
+    or ids for the matches with comma-separated ids, see api_get_matches_by_ids
     :return: JSON match info or html info
     """
 
     query_parameters = flask.request.args
+    if 'ids' in query_parameters.keys():
+        return _matches_by_ids(query_parameters['ids'].split(','), 'stream' in query_parameters.keys())
+
+    limit = query_parameters.get('limit', type=int)
+    if 'limit' in query_parameters.keys() and (limit is None or limit < 1):
+        return "<h1>400</h1><p>Bad request: bad argument</p>", 400
+
     if 'name' in query_parameters.keys():
-        match_info = db.get_match_by_name(query_parameters['name'])
+        match_info = db.get_match_by_name(query_parameters['name'], limit)
         return ("<h1>404</h1><p>The resource could not be found.</p>", 404) if (
-            len(match_info) == 0) else flask.jsonify(match_info)
+            len(match_info) == 0) else _json_response(match_info)
+
+    if 'search' in query_parameters.keys():
+        return _json_response(db.search_matches(query_parameters['search'], limit or db.SEARCH_LIMIT))
 
     return "<h1>400</h1><p>Bad request: bad argument</p>", 400
 
 
+@app.route('/api/v1/resources/match/', methods=['POST'])
+def api_get_matches_by_ids():
+    """
+    Handler for get matches by id in bulk
+    Accepts POST requests with a JSON list of match ids, or {"ids": [...]}, up to db.MATCHES_MAX_IDS
+    Matches come in the order of the ids, those not found are left out. Cached matches are served
+    as cached and the others read with a single query
+    Arguments: stream to stream the matches as they are read, db.MATCHES_FETCH_CHUNK at a time
+    :return: JSON matches info or html info
+    """
+
+    match_ids = flask.request.get_json(force=True, silent=True)
+    if isinstance(match_ids, dict):
+        match_ids = match_ids.get('ids')
+    return _matches_by_ids(match_ids, 'stream' in flask.request.args.keys())
+
+
+def _matches_by_ids(values, stream=False):
+    """
+    Builds the response of a bulk match fetch from the serialized matches
+    :param values: LIST of match ids as received
+    :param stream: BOOLEAN stream the matches as they are read
+    :return: JSON matches info or html info
+    """
+
+    try:
+        match_ids = db.parse_match_ids(values)
+    except ValueError:
+        return "<h1>400</h1><p>Bad request: bad argument</p>", 400
+
+    if stream:
+        return flask.Response(_stream_json_bodies(snapshot.body for snapshot in db.iter_match_snapshots(match_ids)),
+                              mimetype='application/json')
+    return flask.Response(b'[' + b','.join(snapshot.body for snapshot in db.get_match_snapshots(match_ids)) + b']',
+                          mimetype='application/json')
+
+
+def _stream_json_bodies(bodies):
+    """
+    Joins serialized JSON items into a list, item by item
+    :param bodies: ITERABLE of BYTES serialized items
+    :return: GENERATOR of BYTES chunks
+    """
+
+    yield b'['
+    for index, body in enumerate(bodies):
+        yield (b',' if index else b'') + body
+    yield b']'
+
+
+def _stream_json_list(items):
+    """
+    Serializes a JSON list item by item
+    :param items: ITERABLE of JSON serializable items
+    :return: GENERATOR of BYTES chunks
+    """
+
+    return _stream_json_bodies(serialize.dumps(item) for item in items)
+
+
 @app.route('/api/v1/resources/match/football/', methods=['GET'])
 def api_match_football():
     """
-    Handler for get matches ordered by start time
+    Handler for get football matches ordered by start time
     Accepts GET requests
     :return: JSON matches info or html info
     """
 
+    return api_match_sport('Football')
+
+
+@app.route('/api/v1/resources/match/sport/<sport_name>/', methods=['GET'])
+def api_match_sport(sport_name):
+    """
+    Handler for get matches of a sport ordered by start time
+    Accepts GET requests
+    Arguments: ordering=startTime (required), from & to start times as "%Y-%m-%d %H:%M:%S"
+    (from included, to excluded), limit to get a single page and cursor to get the next one,
+    given in the X-Next-Cursor header of the previous page. Without limit every match is streamed
+    :param sport_name: STR sport name
+    :return: JSON matches info or html info
+    """
+
     query_parameters = flask.request.args
-    if 'ordering' in query_parameters.keys():
-        if query_parameters['ordering'] == 'startTime':
-            matches = db.get_football_matches_by_start_time()
-            return flask.jsonify(matches)
+    if query_parameters.get('ordering') != 'startTime':
+        return "<h1>400</h1><p>Bad request: bad argument</p>", 400
 
-    return "<h1>400</h1><p>Bad request: bad argument</p>", 400
+    try:
+        start = db.parse_start_time(query_parameters.get('from'))
+        end = db.parse_start_time(query_parameters.get('to'))
+        cursor = query_parameters.get('cursor')
+        if cursor:
+            db.parse_cursor(cursor)
+        limit = query_parameters.get('limit', type=int)
+    except ValueError:
+        return "<h1>400</h1><p>Bad request: bad argument</p>", 400
+
+    if 'limit' in query_parameters.keys():
+        if limit is None or limit < 1:
+            return "<h1>400</h1><p>Bad request: bad argument</p>", 400
+        matches, next_cursor = db.get_matches_by_start_time(sport_name, start, end, cursor, limit)
+        response = _json_response(matches)
+        if next_cursor:
+            response.headers['X-Next-Cursor'] = next_cursor
+        return response
+
+    matches = db.iter_matches_by_start_time(sport_name, start, end, cursor)
+    return flask.Response(_stream_json_list(matches), mimetype='application/json')
+
+
+@app.route('/api/v1/resources/stats/', methods=['GET'])
+def api_stats():
+    """
+    Handler for data layer stats: connection pool and match cache counters, with the writer process ones
+    Accepts GET requests
+    :return: JSON stats
+    """
+
+    return _json_response(writer.stats())
+
+
+@app.route('/metrics', methods=['GET'])
+def api_metrics():
+    """
+    Handler for metrics in the Prometheus text format: request and database operation latency
+    histograms, ingest counters and data layer gauges
+    Accepts GET requests
+    :return: text metrics
+    """
+
+    return flask.Response(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
 
 
 @app.errorhandler(404)
@@ -105,4 +420,5 @@ def page_not_found():
 
 
 if __name__ == '__main__':
+    writer.start_worker()
     app.run()
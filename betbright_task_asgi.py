@@ -0,0 +1,531 @@
+# coding=utf-8
+# __author__ = 'Mario Romera Fernández'
+
+# Asyncio serving mode of the BetBright API, with the same routes as betbright_task-api.py
+# SQLite work runs in the bounded thread pool of aiodb, so slow provider posts and thousands of
+# polling clients overlap in a single process. Run with any ASGI server, e.g.:
+#     uvicorn betbright_task_asgi:app --host 127.0.0.1 --port 8000
+
+import asyncio
+import json
+import re
+import time
+import zlib
+from urllib.parse import parse_qs
+
+import aiodb
+import db
+import feed
+import metrics
+import provider
+import pubsub
+import serialize
+import writer
+
+
+NOT_FOUND = b"<h1>404</h1><p>The resource could not be found.</p>"
+BAD_ARGUMENT = b"<h1>400</h1><p>Bad request: bad argument</p>"
+QUEUE_FULL = b"<h1>429</h1><p>Too many requests: ingest queue full</p>"
+WRITER_UNAVAILABLE = b"<h1>503</h1><p>Ingest unavailable</p>"
+
+
+class Request(object):
+    """
+    Minimal view of an ASGI http request
+    """
+
+    def __init__(self, scope, receive):
+        """
+        :param scope: DICT ASGI connection scope
+        :param receive: ASYNC FUNCTION ASGI receive channel
+        """
+
+        self.method = scope['method']
+        self.path = scope['path']
+        self.args = {name: values[0] for name, values in
+                     parse_qs(scope.get('query_string', b'').decode('latin-1'), keep_blank_values=True).items()}
+        self.headers = {name.decode('latin-1').lower(): value.decode('latin-1')
+                        for name, value in scope.get('headers', [])}
+        self.receive = receive
+
+    async def chunks(self):
+        """
+        Reads the request body as it arrives
+        :return: ASYNC GENERATOR of BYTES chunks
+        """
+
+        while True:
+            message = await self.receive()
+            if message['type'] == 'http.disconnect':
+                return
+            if message.get('body'):
+                yield message['body']
+            if not message.get('more_body'):
+                return
+
+    async def body(self):
+        """
+        Reads the whole request body
+        :return: BYTES body
+        """
+
+        return b''.join([chunk async for chunk in self.chunks()])
+
+
+async def respond(send, status, body, content_type='text/html; charset=utf-8', headers=()):
+    """
+    Sends a complete response
+    :param send: ASYNC FUNCTION ASGI send channel
+    :param status: INT status code
+    :param body: BYTES body
+    :param content_type: STR content type
+    :param headers: ITERABLE of (STR name, STR value) extra headers
+    :return: None
+    """
+
+    await send({'type': 'http.response.start',
+                'status': status,
+                'headers': [(b'content-type', content_type.encode('latin-1')),
+                            (b'content-length', str(len(body)).encode('latin-1'))] +
+                           [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def respond_json(send, data, headers=()):
+    """
+    Sends a JSON response
+    :param send: ASYNC FUNCTION ASGI send channel
+    :param data: JSON serializable data
+    :param headers: ITERABLE of (STR name, STR value) extra headers
+    :return: None
+    """
+
+    await respond(send, 200, serialize.dumps(data), 'application/json', headers)
+
+
+async def send_not_modified(send, headers):
+    """
+    Sends an empty 304 response
+    :param send: ASYNC FUNCTION ASGI send channel
+    :param headers: ITERABLE of (STR name, STR value) headers
+    :return: None
+    """
+
+    await send({'type': 'http.response.start',
+                'status': 304,
+                'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]})
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+def etag_matches(if_none_match, etag):
+    """
+    Checks an If-None-Match header against an entity tag, with weak comparison
+    :param if_none_match: STR header value or None
+    :param etag: STR entity tag, without quotes
+    :return: BOOLEAN True if the client already has this version
+    """
+
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == '*' or tag.strip('"') == etag:
+            return True
+    return False
+
+
+async def home(request, send):
+    """
+    Handler for base url
+    """
+
+    await respond(send, 200, '''<h1>BetBright API by Mario Romera Fernández</h1>
+<p>A prototype API for BetBright.</p>'''.encode('utf-8'))
+
+
+async def api_external_providers(request, send):
+    """
+    Handler for external data providers, see betbright_task-api.py
+    """
+
+    try:
+        message = provider.validate(serialize.loads(await request.body()))
+    except provider.MessageTypeError:
+        return await respond(send, 400, b"<h1>400</h1><p>Bad request: bad message_type</p>")
+    except provider.MessageError:
+        return await respond(send, 400, b"<h1>400</h1><p>Bad request: bad message</p>")
+    except ValueError:
+        return await respond(send, 400, b"<h1>400</h1><p>Bad request: bad JSON</p>")
+
+    result = {}
+    try:
+        processed = await aiodb.ingest(message, result)
+    except writer.MessageError:
+        return await respond(send, 400, b"<h1>400</h1><p>Bad request: bad message</p>")
+    except writer.QueueFull:
+        return await respond(send, 429, QUEUE_FULL, headers=[('Retry-After', '1')])
+    except writer.WriterError:
+        return await respond(send, 503, WRITER_UNAVAILABLE)
+
+    if processed:
+        headers = [('X-Odds-Changed', str(result['changed'])),
+                   ('X-Odds-Unchanged', str(result['unchanged'])),
+                   ('X-Odds-Unknown', str(result['unknown']))] if 'changed' in result else []
+        return await respond(send, 200, b"<p>200</p>", headers=headers)
+
+    await respond(send, 400, b"<h1>400</h1><p>Message already processed</p>")
+
+
+def inflate(decoder, chunk):
+    """
+    Decompresses a body chunk in pieces of at most feed.READ_SIZE bytes, so a small, highly
+    compressed body never expands in memory at once
+    :param decoder: zlib decompress object
+    :param chunk: BYTES compressed data
+    :return: GENERATOR of BYTES data
+    """
+
+    data = decoder.decompress(chunk, feed.READ_SIZE)
+    while data:
+        yield data
+        data = decoder.decompress(decoder.unconsumed_tail, feed.READ_SIZE) if decoder.unconsumed_tail else b''
+
+
+async def api_external_providers_bulk(request, send):
+    """
+    Handler for external data providers sending messages in bulk, see betbright_task-api.py
+    Lines are parsed as body chunks arrive and each batch is stored while the next one is read
+    """
+
+    try:
+        batch_size = int(request.args.get('batch', db.INGEST_BATCH_SIZE))
+    except ValueError:
+        batch_size = 0
+    if not 1 <= batch_size <= db.INGEST_MAX_BATCH_SIZE:
+        return await respond(send, 400, BAD_ARGUMENT)
+
+    decoder = None
+    if request.headers.get('content-encoding', '').lower() == 'gzip':
+        decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    results = []
+    batch = []
+    splitter = feed.LineSplitter()
+    line_number = 0
+    try:
+        async for chunk in request.chunks():
+            for data in inflate(decoder, chunk) if decoder else (chunk,):
+                for line in splitter.split(data):
+                    line_number += 1
+                    parsed = feed.parse_line(line)
+                    if parsed is not None:
+                        batch.append((line_number,) + parsed)
+                    if len(batch) >= batch_size:
+                        results.extend(await aiodb.ingest_parsed(batch))
+                        batch = []
+        if decoder:
+            for line in splitter.split(decoder.flush()):
+                line_number += 1
+                parsed = feed.parse_line(line)
+                if parsed is not None:
+                    batch.append((line_number,) + parsed)
+            if not decoder.eof:
+                raise zlib.error('Truncated gzip body')
+        for line in splitter.finish():
+            line_number += 1
+            parsed = feed.parse_line(line)
+            if parsed is not None:
+                batch.append((line_number,) + parsed)
+        for last_batch in feed.iter_batches(batch, batch_size):
+            results.extend(await aiodb.ingest_parsed(last_batch))
+    except zlib.error:
+        return await respond(send, 400, b"<h1>400</h1><p>Bad request: bad gzip body</p>")
+    except writer.QueueFull:
+        # Batches already written are reported as duplicates when the body is sent again
+        return await respond(send, 429, QUEUE_FULL, headers=[('Retry-After', '1')])
+    except writer.WriterError:
+        return await respond(send, 503, WRITER_UNAVAILABLE)
+
+    await respond_json(send, results)
+
+
+async def api_get_match_by_id(request, send, match_id):
+    """
+    Handler for get match by id
+    """
+
+    try:
+        match_id = db.parse_match_id(match_id)
+    except ValueError:
+        return await respond(send, 404, NOT_FOUND)
+
+    snapshot = await aiodb.get_match_snapshot(match_id)
+    if snapshot is None:
+        return await respond(send, 404, NOT_FOUND)
+
+    headers = [('ETag', '"%s"' % snapshot.etag), ('Cache-Control', 'no-cache')]
+    if etag_matches(request.headers.get('if-none-match'), snapshot.etag):
+        return await send_not_modified(send, headers)
+    await respond(send, 200, snapshot.body, 'application/json', headers)
+
+
+async def api_match_stream(request, send, match_id):
+    """
+    Handler for the odds stream of a match, see betbright_task-api.py
+    """
+
+    try:
+        match_id = db.parse_match_id(match_id)
+    except ValueError:
+        return await respond(send, 404, NOT_FOUND)
+
+    subscription = db.ODDS_STREAM.subscribe(match_id)
+    if subscription is None:
+        return await respond(send, 503, b"<h1>503</h1><p>Too many subscriptions</p>")
+
+    snapshot = await aiodb.get_match_snapshot(match_id)
+    if snapshot is None:
+        subscription.close()
+        return await respond(send, 404, NOT_FOUND)
+
+    await send({'type': 'http.response.start',
+                'status': 200,
+                'headers': [(b'content-type', b'text/event-stream'),
+                            (b'cache-control', b'no-cache'),
+                            (b'x-accel-buffering', b'no')]})
+
+    # Stop streaming as soon as the client goes away
+    async def disconnected():
+        while (await request.receive())['type'] != 'http.disconnect':
+            pass
+        subscription.close()
+
+    watcher = asyncio.ensure_future(disconnected())
+    events = pubsub.aiter_events(snapshot, subscription)
+    try:
+        async for event in events:
+            await send({'type': 'http.response.body', 'body': event, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        watcher.cancel()
+        await events.aclose()
+
+
+async def api_match_history(request, send, match_id):
+    """
+    Handler for the odds history of a match, see betbright_task-api.py
+    """
+
+    try:
+        match_id = db.parse_match_id(match_id)
+    except ValueError:
+        return await respond(send, 404, NOT_FOUND)
+
+    try:
+        start = db.parse_start_time(request.args.get('from'))
+        end = db.parse_start_time(request.args.get('to'))
+    except ValueError:
+        return await respond(send, 400, BAD_ARGUMENT)
+
+    odds_history = await aiodb.get_odds_history(match_id, start, end)
+    if odds_history is None:
+        return await respond(send, 404, NOT_FOUND)
+    await respond_json(send, odds_history)
+
+
+async def api_get_match_by_name(request, send):
+    """
+    Handler for get match by name, search or ids, see betbright_task-api.py
+    """
+
+    if 'ids' in request.args:
+        return await send_matches_by_ids(send, request.args['ids'].split(','), 'stream' in request.args)
+
+    limit = None
+    if 'limit' in request.args:
+        try:
+            limit = int(request.args['limit'])
+        except ValueError:
+            limit = 0
+        if limit < 1:
+            return await respond(send, 400, BAD_ARGUMENT)
+
+    if 'name' in request.args:
+        match_info = await aiodb.get_match_by_name(request.args['name'], limit)
+        if not match_info:
+            return await respond(send, 404, NOT_FOUND)
+        return await respond_json(send, match_info)
+
+    if 'search' in request.args:
+        return await respond_json(send, await aiodb.search_matches(request.args['search'], limit or db.SEARCH_LIMIT))
+
+    await respond(send, 400, BAD_ARGUMENT)
+
+
+async def api_get_matches_by_ids(request, send):
+    """
+    Handler for get matches by id in bulk, see betbright_task-api.py
+    """
+
+    try:
+        match_ids = json.loads(await request.body())
+    except ValueError:
+        return await respond(send, 400, BAD_ARGUMENT)
+    if isinstance(match_ids, dict):
+        match_ids = match_ids.get('ids')
+    await send_matches_by_ids(send, match_ids, 'stream' in request.args)
+
+
+async def send_matches_by_ids(send, values, stream=False):
+    """
+    Sends the serialized matches of a bulk match fetch
+    :param send: ASYNC FUNCTION ASGI send channel
+    :param values: LIST of match ids as received
+    :param stream: BOOLEAN stream the matches as they are read
+    :return: None
+    """
+
+    try:
+        match_ids = db.parse_match_ids(values)
+    except ValueError:
+        return await respond(send, 400, BAD_ARGUMENT)
+
+    if not stream:
+        snapshots = await aiodb.get_match_snapshots(match_ids)
+        return await respond(send, 200, b'[' + b','.join(snapshot.body for snapshot in snapshots) + b']',
+                             'application/json')
+
+    await send({'type': 'http.response.start',
+                'status': 200,
+                'headers': [(b'content-type', b'application/json')]})
+    separator = b'['
+    async for snapshot in aiodb.iter_match_snapshots(match_ids):
+        await send({'type': 'http.response.body', 'body': separator + snapshot.body, 'more_body': True})
+        separator = b','
+    await send({'type': 'http.response.body', 'body': b'[]' if separator == b'[' else b']'})
+
+
+async def api_match_football(request, send):
+    """
+    Handler for get football matches ordered by start time
+    """
+
+    await api_match_sport(request, send, 'Football')
+
+
+async def api_match_sport(request, send, sport_name):
+    """
+    Handler for get matches of a sport ordered by start time, see betbright_task-api.py
+    Without limit every match is streamed as it is read
+    """
+
+    if request.args.get('ordering') != 'startTime':
+        return await respond(send, 400, BAD_ARGUMENT)
+
+    try:
+        start = db.parse_start_time(request.args.get('from'))
+        end = db.parse_start_time(request.args.get('to'))
+        cursor = request.args.get('cursor')
+        if cursor:
+            db.parse_cursor(cursor)
+        limit = int(request.args['limit']) if 'limit' in request.args else None
+    except ValueError:
+        return await respond(send, 400, BAD_ARGUMENT)
+
+    if limit is not None:
+        if limit < 1:
+            return await respond(send, 400, BAD_ARGUMENT)
+        matches, next_cursor = await aiodb.get_matches_by_start_time(sport_name, start, end, cursor, limit)
+        return await respond_json(send, matches, [('X-Next-Cursor', next_cursor)] if next_cursor else [])
+
+    await send({'type': 'http.response.start',
+                'status': 200,
+                'headers': [(b'content-type', b'application/json')]})
+    separator = b'['
+    async for match in aiodb.iter_matches_by_start_time(sport_name, start, end, cursor):
+        await send({'type': 'http.response.body', 'body': separator + serialize.dumps(match),
+                    'more_body': True})
+        separator = b','
+    await send({'type': 'http.response.body', 'body': b'[]' if separator == b'[' else b']'})
+
+
+async def api_stats(request, send):
+    """
+    Handler for data layer stats
+    """
+
+    await respond_json(send, await aiodb.stats())
+
+
+async def api_metrics(request, send):
+    """
+    Handler for metrics in the Prometheus text format, see betbright_task-api.py
+    """
+
+    await respond(send, 200, metrics.REGISTRY.render().encode('utf-8'), metrics.CONTENT_TYPE)
+
+
+# (method set, path regex, handler) in matching order
+ROUTES = [({'GET'}, re.compile(r'^/$'), home),
+          ({'POST', 'PUT'}, re.compile(r'^/api/v1/resources/external/$'), api_external_providers),
+          ({'POST', 'PUT'}, re.compile(r'^/api/v1/resources/external/bulk/$'), api_external_providers_bulk),
+          ({'GET'}, re.compile(r'^/api/v1/resources/match/(\d+)$'), api_get_match_by_id),
+          ({'GET'}, re.compile(r'^/api/v1/resources/match/(\d+)/stream$'), api_match_stream),
+          ({'GET'}, re.compile(r'^/api/v1/resources/match/(\d+)/history$'), api_match_history),
+          ({'GET'}, re.compile(r'^/api/v1/resources/match/$'), api_get_match_by_name),
+          ({'POST'}, re.compile(r'^/api/v1/resources/match/$'), api_get_matches_by_ids),
+          ({'GET'}, re.compile(r'^/api/v1/resources/match/football/$'), api_match_football),
+          ({'GET'}, re.compile(r'^/api/v1/resources/match/sport/([^/]+)/$'), api_match_sport),
+          ({'GET'}, re.compile(r'^/api/v1/resources/stats/$'), api_stats),
+          ({'GET'}, re.compile(r'^/metrics$'), api_metrics)]
+
+
+async def lifespan(receive, send):
+    """
+    Handles ASGI lifespan events: upgrades the database and starts its maintenance on startup, or
+    subscribes to the commits of the writer process if there is one; waits for SQLite work on shutdown
+    """
+
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await aiodb.run(writer.start_worker)
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            aiodb.shutdown()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    """
+    ASGI application
+    """
+
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+
+    request = Request(scope, receive)
+    path_matched = False
+    for methods, path, handler in ROUTES:
+        match = path.match(request.path)
+        if match is None:
+            continue
+        if request.method not in methods:
+            # Another route may take the method for the same path
+            path_matched = True
+            continue
+        # Requests share the event loop thread, so only their time is recorded, stacks are not sampled
+        start = time.perf_counter()
+        try:
+            return await handler(request, send, *match.groups())
+        finally:
+            metrics.REQUEST_SECONDS.observe(time.perf_counter() - start, (handler.__name__,))
+
+    if path_matched:
+        return await respond(send, 405, b"<h1>405</h1><p>Method not allowed</p>")
+    await respond(send, 404, NOT_FOUND)
@@ -0,0 +1,249 @@
+# coding=utf-8
+# __author__ = 'Mario Romera Fernández'
+
+import os
+import threading
+from collections import OrderedDict
+
+import serialize
+
+
+class Snapshot(object):
+    """
+    Fully built match document together with its JSON serialization and entity tag
+    Snapshots are never modified once cached: patching odds builds a new one, so readers holding
+    a snapshot always see a consistent document
+    """
+
+    __slots__ = ('document', 'body', 'etag', 'positions')
+
+    def __init__(self, document, etag=None, positions=None):
+        """
+        :param document: DICT match data as returned by db.get_match_by_id
+        :param etag: STR entity tag of this version of the document, without quotes
+        :param positions: DICT selection id -> (market index, selection index), built if not given
+        """
+
+        self.document = document
+        self.body = serialize.dumps(document)
+        self.etag = etag
+        if positions is None:
+            positions = {selection['id']: (market_index, selection_index)
+                         for market_index, market in enumerate(document['markets'])
+                         for selection_index, selection in enumerate(market['selections'])}
+        self.positions = positions
+
+    def patch_odds(self, odds, etag=None):
+        """
+        Builds a new snapshot with updated odds, copying only the markets that change
+        :param odds: ITERABLE of (INT market id, INT selection id, FLOAT odds)
+        :param etag: STR entity tag of the new snapshot
+        :return: Snapshot or None if nothing changed
+        """
+
+        markets = list(self.document['markets'])
+        copied = set()
+        for market_id, selection_id, value in odds:
+            position = self.positions.get(selection_id)
+            if position is None:
+                continue
+            market_index, selection_index = position
+            market = markets[market_index]
+            if market['id'] != market_id or market['selections'][selection_index]['odds'] == value:
+                continue
+            if market_index not in copied:
+                market = dict(market, selections=list(market['selections']))
+                markets[market_index] = market
+                copied.add(market_index)
+            market['selections'][selection_index] = dict(market['selections'][selection_index], odds=value)
+        if not copied:
+            return None
+        return Snapshot(dict(self.document, markets=markets), etag, self.positions)
+
+
+class MatchCache(object):
+    """
+    LRU cache of match snapshots keyed by event id, bounded by entries and serialized bytes
+
+    Loads from the database are bracketed by begin_load/end_load: a write to the same event
+    while it is being loaded discards the loaded document, so a stale read never gets cached.
+
+    Every write bumps the version of the cache, one counter for all events. Snapshots are tagged
+    with the version they were read at and the generation of the cache, random per process and per
+    clear(), so a tag is never reused for different content after a restart or by another process.
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=64 * 1024 * 1024):
+        """
+        :param max_entries: INT maximum number of cached matches
+        :param max_bytes: INT maximum size of cached JSON documents
+        """
+
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._loading = {}
+        self._version = 0
+        self._generation = os.urandom(4).hex()
+        self._lock = threading.Lock()
+
+        # Stats
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._invalidations = 0
+        self._patches = 0
+
+    def get(self, event_id):
+        """
+        Gets a cached snapshot, marking it as recently used
+        :param event_id: INT event id
+        :return: Snapshot or None
+        """
+
+        with self._lock:
+            snapshot = self._entries.get(event_id)
+            if snapshot is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(event_id)
+            self._hits += 1
+            return snapshot
+
+    def begin_load(self, event_id):
+        """
+        Registers a database load of an event
+        :param event_id: INT event id
+        :return: TUPLE token to pass to end_load
+        """
+
+        with self._lock:
+            loading = self._loading.setdefault(event_id, [0, 0])
+            loading[0] += 1
+            return loading[1], self._etag()
+
+    def end_load(self, event_id, token, document=None):
+        """
+        Finishes a database load, caching the document unless the event was written meanwhile
+        :param event_id: INT event id
+        :param token: TUPLE token returned by begin_load
+        :param document: DICT match data or None if the load failed
+        :return: Snapshot or None
+        """
+
+        writes, etag = token
+        snapshot = Snapshot(document, etag) if document else None
+        with self._lock:
+            loading = self._loading[event_id]
+            loading[0] -= 1
+            if loading[0] == 0:
+                del self._loading[event_id]
+            if snapshot is not None and loading[1] == writes:
+                self._store(event_id, snapshot)
+        return snapshot
+
+    def _store(self, event_id, snapshot):
+        """
+        Stores a snapshot and evicts least recently used ones over the limits. Lock must be held
+        :param event_id: INT event id
+        :param snapshot: Snapshot
+        :return: None
+        """
+
+        previous = self._entries.pop(event_id, None)
+        if previous is not None:
+            self._bytes -= len(previous.body)
+        self._entries[event_id] = snapshot
+        self._bytes += len(snapshot.body)
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= len(evicted.body)
+            self._evictions += 1
+
+    def _etag(self):
+        """
+        Entity tag of the current version of the cache. Lock must be held
+        :return: STR entity tag, without quotes
+        """
+
+        return '%s-%i' % (self._generation, self._version)
+
+    def _written(self, event_id):
+        """
+        Bumps the version of the cache and marks the in-flight loads of an event as stale. Lock must be held
+        :param event_id: INT event id
+        :return: None
+        """
+
+        self._version += 1
+        loading = self._loading.get(event_id)
+        if loading is not None:
+            loading[1] += 1
+
+    def invalidate(self, event_id):
+        """
+        Drops an event from the cache
+        :param event_id: INT event id
+        :return: None
+        """
+
+        with self._lock:
+            self._written(event_id)
+            snapshot = self._entries.pop(event_id, None)
+            if snapshot is not None:
+                self._bytes -= len(snapshot.body)
+                self._invalidations += 1
+
+    def patch_odds(self, event_id, odds):
+        """
+        Applies committed odds to a cached event in place of invalidating it
+        Patches must be applied in commit order, db does it under its commit lock
+        :param event_id: INT event id
+        :param odds: LIST of (INT market id, INT selection id, FLOAT odds)
+        :return: None
+        """
+
+        with self._lock:
+            self._written(event_id)
+            snapshot = self._entries.get(event_id)
+            etag = self._etag()
+        if snapshot is None:
+            return
+        patched = snapshot.patch_odds(odds, etag)
+        if patched is None:
+            return
+        with self._lock:
+            # A load finished meanwhile already has these odds
+            if self._entries.get(event_id) is snapshot:
+                self._bytes += len(patched.body) - len(snapshot.body)
+                self._entries[event_id] = patched
+                self._patches += 1
+
+    def clear(self):
+        """
+        Drops every cached event
+        :return: None
+        """
+
+        with self._lock:
+            for event_id in self._loading:
+                self._written(event_id)
+            self._entries.clear()
+            self._generation = os.urandom(4).hex()
+            self._bytes = 0
+
+    def stats(self):
+        """
+        Cache usage counters
+        :return: DICT cache stats
+        """
+
+        with self._lock:
+            return {'entries': len(self._entries),
+                    'bytes': self._bytes,
+                    'hits': self._hits,
+                    'misses': self._misses,
+                    'evictions': self._evictions,
+                    'invalidations': self._invalidations,
+                    'patches': self._patches}
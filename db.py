@@ -1,19 +1,497 @@
 # coding=utf-8
 # __author__ = 'Mario Romera Fernández'
 
+import atexit
+import logging
 import sqlite3
 import datetime
-from contextlib import closing
+import functools
+import itertools
+import json
+import threading
+import time
+from contextlib import closing, contextmanager, nullcontext
+
+import cache
+import dedup
+import history
+import metrics
+import oddsbook
+import pool
+import provider
+import pubsub
+import search
+import snapshot
+import statements
 
 
 DB_NAME = 'BetBright.db'
 MATCH_URL = 'http://127.0.0.1:5000/api/v1/resources/match/'
 
+# Messages per transaction on bulk ingest, by default and at most: a batch is held in memory
+INGEST_BATCH_SIZE = 500
+INGEST_MAX_BATCH_SIZE = 4 * INGEST_BATCH_SIZE
+
+# Matches listing page sizes
+MATCHES_PAGE_SIZE = 500
+MATCHES_MAX_LIMIT = 1000
+
+# Matches per bulk fetch, and per database query when streamed
+MATCHES_MAX_IDS = 500
+MATCHES_FETCH_CHUNK = 50
+
+# Match search result sizes
+SEARCH_LIMIT = 10
+SEARCH_MAX_LIMIT = 100
+
+# Connection pool settings
+POOL_SIZE = 8
+POOL_TIMEOUT = 30.0
+POOL_CACHED_STATEMENTS = 256
+POOL_PRAGMAS = dict(pool.DEFAULT_PRAGMAS)
+
+# Match snapshot cache settings
+MATCH_CACHE_SIZE = 1024
+MATCH_CACHE_BYTES = 64 * 1024 * 1024
+
+# Odds book settings
+# With write-behind, odds updates are applied in memory and written to SELECTIONS in batches every
+# ODDS_FLUSH_INTERVAL seconds instead of in the message transaction: much lower update latency, but
+# odds applied since the last flush are lost if the process dies
+ODDS_WRITE_BEHIND = False
+ODDS_FLUSH_INTERVAL = 0.25
+
+# Processed message ids settings
+# Ids are kept in MESSAGES for DEDUP_RETENTION seconds, pruned every DEDUP_PRUNE_INTERVAL seconds
+# in transactions of DEDUP_PRUNE_BATCH ids. Those within DEDUP_RETENTION are also kept in memory in
+# two Bloom filter generations of DEDUP_RETENTION seconds each, sized for DEDUP_CAPACITY ids, so
+# checking a new id needs no database lookup
+DEDUP_RETENTION = 7 * 24 * 3600
+DEDUP_PRUNE_INTERVAL = 60.0
+DEDUP_PRUNE_BATCH = 1000
+DEDUP_CAPACITY = 1000000
+DEDUP_ERROR_RATE = 0.01
+
+# Odds history settings
+# Every odds change is kept as a tick in ODDS_TICKS. Every HISTORY_ROLL_INTERVAL seconds the ticks of
+# selections with HISTORY_BLOCK_SIZE of them, or with ticks older than HISTORY_ROLL_AGE seconds, are
+# compressed into ODDS_BLOCKS, HISTORY_ROLL_BATCH selections per transaction
+HISTORY_BLOCK_SIZE = 256
+HISTORY_ROLL_AGE = 3600
+HISTORY_ROLL_INTERVAL = 60.0
+HISTORY_ROLL_BATCH = 100
+
+# Archive settings, off unless ARCHIVE_HORIZON is set
+# Events that started more than ARCHIVE_HORIZON seconds ago are moved with their markets, selections
+# and odds history to the ARCHIVE_DB_NAME database every ARCHIVE_INTERVAL seconds, in transactions
+# of ARCHIVE_BATCH events
+ARCHIVE_DB_NAME = 'BetBright-archive.db'
+ARCHIVE_HORIZON = None
+ARCHIVE_INTERVAL = 300.0
+ARCHIVE_BATCH = 100
+
+# Tables in snapshots, see export_snapshot
+SNAPSHOT_TABLES = ('SPORTS', 'EVENTS', 'MARKETS', 'SELECTIONS', 'MESSAGES', 'ODDS_TICKS', 'ODDS_BLOCKS')
+
+_pool = None
+_pool_lock = threading.Lock()
+_commit_lock = threading.RLock()
+_periodic = {}
+
+MATCH_CACHE = cache.MatchCache(MATCH_CACHE_SIZE, MATCH_CACHE_BYTES)
+ODDS_BOOK = oddsbook.OddsBook()
+ODDS_STREAM = pubsub.Broker()
+MESSAGE_IDS = dedup.MessageIdFilter(DEDUP_CAPACITY, DEDUP_ERROR_RATE, DEDUP_RETENTION)
+
+logger = logging.getLogger(__name__)
+
+# Metrics of the data layer, see metrics.REGISTRY
+MESSAGES_INGESTED = metrics.counter('betbright_messages_ingested', 'Provider messages committed', ('message_type',))
+MESSAGES_DUPLICATE = metrics.counter('betbright_messages_duplicate', 'Provider messages rejected as already processed')
+ARCHIVED_ROWS = metrics.counter('betbright_archived_rows', 'Rows moved to the archive database', ('table',))
+ODDS_SELECTIONS = metrics.counter('betbright_odds_selections',
+                                  'Selections of committed odds updates: changed, unchanged (write skipped) or '
+                                  'unknown (ignored)',
+                                  ('result',))
+metrics.gauge('betbright_match_cache_entries', 'Matches in the match cache', lambda: MATCH_CACHE.stats()['entries'])
+metrics.gauge('betbright_match_cache_bytes', 'Serialized bytes in the match cache', lambda: MATCH_CACHE.stats()['bytes'])
+metrics.gauge('betbright_pool_open_connections', 'Open pooled database connections', lambda: pool_stats()['open'])
+metrics.gauge('betbright_odds_stream_subscriptions', 'Open odds stream subscriptions',
+              lambda: ODDS_STREAM.stats()['subscriptions'])
+
+# Statements of the data layer: fixed SQL text with bound parameters, so each one is prepared once
+# per pooled connection and reused from its statement cache afterwards
+SELECT_ODDS = statements.register('select_odds', '''
+    SELECT Se_ID, Se_MARKETID, Se_EVENTID, Se_ODDS FROM SELECTIONS;''')
+SELECT_MESSAGE_IDS = statements.register('select_message_ids', '''
+    SELECT Me_ID FROM MESSAGES WHERE Me_TIME >= ? ORDER BY Me_TIME;''')
+SELECT_MESSAGE = statements.register('select_message', '''
+    SELECT Me_ID FROM MESSAGES WHERE Me_ID = ?;''')
+INSERT_MESSAGE = statements.register('insert_message', '''
+    INSERT INTO MESSAGES VALUES(?, ?) ON CONFLICT(Me_ID) DO NOTHING;''')
+DELETE_MESSAGES = statements.register('delete_messages', '''
+    DELETE FROM MESSAGES WHERE Me_ID IN (SELECT Me_ID FROM MESSAGES WHERE Me_TIME < ? LIMIT ?);''')
+INSERT_SPORT = statements.register('insert_sport', '''
+    INSERT OR IGNORE INTO SPORTS VALUES(?, ?);''')
+INSERT_EVENT = statements.register('insert_event', '''
+    INSERT INTO EVENTS VALUES(?, ?, ?, ?);''')
+INSERT_MARKET = statements.register('insert_market', '''
+    INSERT INTO MARKETS VALUES(?, ?, ?);''')
+INSERT_SELECTION = statements.register('insert_selection', '''
+    INSERT INTO SELECTIONS VALUES(?, ?, ?, ?, ?);''')
+UPDATE_ODDS = statements.register('update_odds', '''
+    UPDATE SELECTIONS SET Se_ODDS = ?1
+    WHERE Se_ID = ?2 AND Se_MARKETID = ?3 AND Se_EVENTID = ?4 AND Se_ODDS IS NOT ?1;''')
+SELECT_MATCHES_BY_NAME = statements.register('select_matches_by_name', '''
+    SELECT Ev_ID, Ev_NAME, Ev_STARTTIME FROM EVENTS WHERE Ev_NAME = ? LIMIT ?;''')
+SELECT_MATCH = statements.register('select_match', '''
+    SELECT Ev_ID, Ev_NAME, Ev_STARTTIME, Ev_SPORTID, Sp_NAME, Ma_ID, Ma_NAME, Se_ID, Se_NAME, Se_ODDS
+    FROM EVENTS
+    INNER JOIN SPORTS ON SPORTS.Sp_ID = EVENTS.Ev_SPORTID
+    INNER JOIN MARKETS ON MARKETS.Ma_EVENTID = EVENTS.Ev_ID
+    INNER JOIN SELECTIONS ON SELECTIONS.Se_EVENTID = EVENTS.Ev_ID
+                         AND SELECTIONS.Se_MARKETID = MARKETS.Ma_ID
+    WHERE Ev_ID = ?
+    ORDER BY Ma_ID, Se_ID;''')
+SELECT_EXPIRED_EVENTS = statements.register('select_expired_events', '''
+    SELECT Ev_ID, Ev_NAME FROM EVENTS
+    WHERE Ev_SPORTID IN (SELECT Sp_ID FROM SPORTS) AND Ev_STARTTIME < ?
+    LIMIT ?;''')
+SELECT_FREE_PAGES = statements.register('select_free_pages', '''
+    SELECT freelist_count FROM pragma_freelist_count;''')
+SELECT_EVENT_SELECTIONS = statements.register('select_event_selections', '''
+    SELECT Se_ID, Se_MARKETID FROM EVENTS
+    LEFT JOIN SELECTIONS ON SELECTIONS.Se_EVENTID = EVENTS.Ev_ID
+    WHERE Ev_ID = ?
+    ORDER BY Se_MARKETID, Se_ID;''')
+SELECT_MATCHES_EVENTS = statements.register('select_matches_events', '''
+    SELECT Ev_ID, Ev_NAME, Ev_STARTTIME, Ev_SPORTID, Sp_NAME
+    FROM EVENTS
+    INNER JOIN SPORTS ON SPORTS.Sp_ID = EVENTS.Ev_SPORTID
+    WHERE Ev_ID IN (SELECT value FROM json_each(?));''')
+SELECT_MATCHES_MARKETS = statements.register('select_matches_markets', '''
+    SELECT Ma_EVENTID, Ma_ID, Ma_NAME FROM MARKETS
+    WHERE Ma_EVENTID IN (SELECT value FROM json_each(?))
+    ORDER BY Ma_EVENTID, Ma_ID;''')
+SELECT_MATCHES_SELECTIONS = statements.register('select_matches_selections', '''
+    SELECT Se_EVENTID, Se_MARKETID, Se_ID, Se_NAME, Se_ODDS FROM SELECTIONS
+    WHERE Se_EVENTID IN (SELECT value FROM json_each(?))
+    ORDER BY Se_EVENTID, Se_ID;''')
+SELECT_MATCHES_BY_START_TIME = statements.register('select_matches_by_start_time', '''
+    SELECT Ev_ID, Ev_NAME, Ev_STARTTIME FROM EVENTS
+    WHERE Ev_SPORTID = (SELECT Sp_ID FROM SPORTS WHERE Sp_NAME = ?)
+      AND Ev_STARTTIME >= ? AND Ev_STARTTIME < ?
+      AND (Ev_STARTTIME, Ev_ID) > (?, ?)
+    ORDER BY Ev_STARTTIME ASC, Ev_ID ASC
+    LIMIT ?;''')
+
+
+def _archive_statements(table, column):
+    """
+    Registers the statements moving the rows of events in a table to the archive database: deleting
+    rows left in the archive by an interrupted run, copying them and deleting them
+    :param table: STR table name
+    :param column: STR event id column
+    :return: TUPLE (STR table name, statements.Statement clear, statements.Statement copy,
+    statements.Statement delete)
+    """
+
+    return (table,
+            statements.register('unarchive_' + table.lower(), '''
+    DELETE FROM archive.%s WHERE %s = ?;''' % (table, column)),
+            statements.register('archive_' + table.lower(), '''
+    INSERT INTO archive.%s SELECT * FROM main.%s WHERE %s = ?;''' % (table, table, column)),
+            statements.register('delete_' + table.lower(), '''
+    DELETE FROM main.%s WHERE %s = ?;''' % (table, column)))
+
+
+# Tables with rows of an event, archived in this order
+ARCHIVED_TABLES = [_archive_statements('EVENTS', 'Ev_ID'),
+                   _archive_statements('MARKETS', 'Ma_EVENTID'),
+                   _archive_statements('SELECTIONS', 'Se_EVENTID'),
+                   _archive_statements('ODDS_TICKS', 'Ot_EVENTID'),
+                   _archive_statements('ODDS_BLOCKS', 'Ob_EVENTID')]
+
+
+def get_pool():
+    """
+    Returns the connection pool for DB_NAME, creating it on first use or when DB_NAME changes
+    :return: pool.ConnectionPool
+    """
+
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.database != DB_NAME:
+            if _pool is not None:
+                _pool.close()
+            _pool = pool.ConnectionPool(DB_NAME,
+                                        size=POOL_SIZE,
+                                        pragmas=POOL_PRAGMAS,
+                                        cached_statements=POOL_CACHED_STATEMENTS,
+                                        timeout=POOL_TIMEOUT)
+        return _pool
+
+
+def pool_stats():
+    """
+    Connection pool stats: checkouts, waits, time spent waiting and open connections
+    :return: DICT pool stats
+    """
+
+    return get_pool().stats()
+
+
+def stats():
+    """
+    Stats of the data layer: connection pool, match cache, odds book, odds stream, message ids and
+    statements
+    :return: DICT stats by component
+    """
+
+    return {'pool': pool_stats(),
+            'match_cache': MATCH_CACHE.stats(),
+            'odds_book': ODDS_BOOK.stats(),
+            'odds_stream': ODDS_STREAM.stats(),
+            'message_ids': MESSAGE_IDS.stats(),
+            'statements': statements.REGISTRY.stats()}
+
+
+def get_odds_book(conn=None):
+    """
+    Returns the odds book, loading it from SELECTIONS on first use or when DB_NAME changes
+    :param conn: sqlite3.Connection to load it with, held by the caller, or None to take a pooled one
+    :return: oddsbook.OddsBook
+    """
+
+    if ODDS_BOOK.database != DB_NAME:
+        # Loading under the commit lock so no commit is missed by the book
+        with _commit_lock:
+            if ODDS_BOOK.database != DB_NAME:
+                with get_pool().connection() if conn is None else nullcontext(conn) as conn:
+                    ODDS_BOOK.load(SELECT_ODDS.fetchall(conn.cursor()), DB_NAME)
+    return ODDS_BOOK
+
+
+def flush_odds():
+    """
+    Writes odds applied with write-behind to SELECTIONS in a single transaction
+    :return: INT number of selections written
+    """
+
+    dirty = ODDS_BOOK.take_dirty()
+    if not dirty:
+        return 0
+    try:
+        with get_pool().connection() as conn:
+            with transaction(conn) as cur:
+                UPDATE_ODDS.executemany(cur, dirty)
+    except Exception:
+        ODDS_BOOK.mark_dirty([selection_id for _, selection_id, _, _ in dirty])
+        raise
+    return len(dirty)
+
+
+def _run_periodically(stop, interval, function):
+    """
+    Runs a function every interval() seconds until 'stop' is set, logging its errors
+    :param stop: threading.Event
+    :param interval: FUNCTION returning the seconds to wait before each run
+    :param function: FUNCTION to run
+    :return: None
+    """
+
+    while not stop.wait(interval()):
+        try:
+            function()
+        except Exception:
+            logger.exception('%s failed, retrying in %s seconds', function.__name__, interval())
+
+
+def start_periodic(function, interval, run_at_exit=False):
+    """
+    Starts a daemon thread running a function periodically, unless it is already running
+    :param function: FUNCTION to run
+    :param interval: FUNCTION returning the seconds to wait before each run
+    :param run_at_exit: BOOLEAN run the function a last time when the interpreter exits
+    :return: None
+    """
+
+    with _pool_lock:
+        if function in _periodic:
+            return
+        stop = threading.Event()
+        thread = threading.Thread(target=_run_periodically, args=(stop, interval, function),
+                                  name=function.__name__, daemon=True)
+        _periodic[function] = stop
+        thread.start()
+
+    def stop_periodic():
+        stop.set()
+        if run_at_exit:
+            function()
+
+    atexit.register(stop_periodic)
+
+
+def start_odds_flusher():
+    """
+    Starts the write-behind odds flusher thread if it is not running
+    Pending odds are flushed as well when the interpreter exits
+    :return: None
+    """
+
+    start_periodic(flush_odds, lambda: ODDS_FLUSH_INTERVAL, run_at_exit=True)
+
+
+def get_message_ids(conn=None):
+    """
+    Returns the in-memory filter of processed message ids, loading it from MESSAGES on first use or
+    when DB_NAME changes
+    :param conn: sqlite3.Connection to load it with, held by the caller, or None to take a pooled one
+    :return: dedup.MessageIdFilter
+    """
+
+    if MESSAGE_IDS.database != DB_NAME:
+        with _commit_lock:
+            if MESSAGE_IDS.database != DB_NAME:
+                with get_pool().connection() if conn is None else nullcontext(conn) as conn:
+                    results = SELECT_MESSAGE_IDS.fetchall(conn.cursor(), (int(time.time()) - DEDUP_RETENTION,))
+                    MESSAGE_IDS.period = DEDUP_RETENTION
+                    MESSAGE_IDS.load((message_id for message_id, in results), DB_NAME)
+    return MESSAGE_IDS
+
+
+def prune_messages():
+    """
+    Deletes message ids older than DEDUP_RETENTION from MESSAGES, in small transactions so
+    ingest is never blocked for long
+    :return: INT number of message ids deleted
+    """
+
+    deleted = 0
+    oldest = int(time.time()) - DEDUP_RETENTION
+    while True:
+        with get_pool().connection() as conn:
+            with transaction(conn) as cur:
+                count = DELETE_MESSAGES.execute(cur, (oldest, DEDUP_PRUNE_BATCH))
+        deleted += count
+        if count < DEDUP_PRUNE_BATCH:
+            return deleted
+
+
+def roll_odds_history():
+    """
+    Compresses odds history ticks into blocks, in small transactions so ingest is never blocked for long
+    :return: INT number of selections rolled over
+    """
+
+    rolled = 0
+    oldest = time.time() - HISTORY_ROLL_AGE
+    while True:
+        with get_pool().connection() as conn:
+            with transaction(conn) as cur:
+                count = history.roll_over(cur, HISTORY_BLOCK_SIZE, oldest, HISTORY_ROLL_BATCH)
+        rolled += count
+        if count < HISTORY_ROLL_BATCH:
+            return rolled
+
+
+def _create_archive():
+    """
+    Creates the archive database tables if missing, with event id indexes only
+    :return: None
+    """
+
+    with closing(sqlite3.connect(ARCHIVE_DB_NAME)) as conn:
+        cur = conn.cursor()
+        _create_tables(cur)
+
+        # Indexes finding the rows of an event, to replace those copied by an interrupted run
+        cur.execute('''CREATE INDEX IF NOT EXISTS maev_in ON MARKETS(Ma_EVENTID);''')
+        cur.execute('''CREATE INDEX IF NOT EXISTS seev_in ON SELECTIONS(Se_EVENTID);''')
+        cur.execute('''CREATE INDEX IF NOT EXISTS otev_in ON ODDS_TICKS(Ot_EVENTID, Ot_TIME);''')
+        cur.execute('''CREATE INDEX IF NOT EXISTS obev_in ON ODDS_BLOCKS(Ob_EVENTID, Ob_START);''')
+        conn.commit()
+
+
+def _archive_batch(cur, oldest):
+    """
+    Moves a batch of events to the attached archive database
+    :param cur: sqlite3.Cursor in a write transaction
+    :param oldest: INT timestamp, events that started before it are archived
+    :return: TUPLE (LIST of INT event ids, DICT table -> INT rows, INT pages freed)
+    """
+
+    events = SELECT_EXPIRED_EVENTS.fetchall(cur, (oldest, ARCHIVE_BATCH))
+    if not events:
+        return [], {}, 0
+    free_pages, = SELECT_FREE_PAGES.fetchone(cur)
+    for event_id, name in events:
+        search.unindex_event(cur, event_id, name)
+    parameters = [(event_id,) for event_id, _ in events]
+    rows = {}
+    for table, clear, archive, delete in ARCHIVED_TABLES:
+        clear.executemany(cur, parameters)
+        archive.executemany(cur, parameters)
+        rows[table] = delete.executemany(cur, parameters)
+    return [event_id for event_id, _ in events], rows, SELECT_FREE_PAGES.fetchone(cur)[0] - free_pages
+
+
+def archive_events():
+    """
+    Moves events older than ARCHIVE_HORIZON with their markets, selections and odds history to the
+    ARCHIVE_DB_NAME database, in small transactions so ingest is never blocked for long
+    Archived events are dropped from the odds book and the match cache of this process
+    Both databases commit separately: after a crash in between, archived rows are replaced by a new copy
+    :return: DICT {'events', 'rows': {table: INT rows}, 'pages'} rows and database pages freed
+    """
+
+    report = {'events': 0, 'rows': {table: 0 for table, _, _, _ in ARCHIVED_TABLES}, 'pages': 0}
+    if ARCHIVE_HORIZON is None:
+        return report
+    _create_archive()
+    oldest = int(time.time() - ARCHIVE_HORIZON)
+    with get_pool().connection() as conn:
+        conn.execute('''ATTACH DATABASE ? AS archive;''', (ARCHIVE_DB_NAME,))
+        try:
+            while True:
+                with transaction(conn) as cur:
+                    event_ids, rows, pages = _archive_batch(cur, oldest)
+                with _commit_lock:
+                    for event_id in event_ids:
+                        ODDS_BOOK.remove_event(event_id)
+                        MATCH_CACHE.invalidate(event_id)
+                report['events'] += len(event_ids)
+                report['pages'] += pages
+                for table, count in rows.items():
+                    report['rows'][table] += count
+                    ARCHIVED_ROWS.inc(count, (table,))
+                if len(event_ids) < ARCHIVE_BATCH:
+                    break
+        finally:
+            conn.execute('''DETACH DATABASE archive;''')
+    if report['events']:
+        logger.info('Archived %i events to %s: %s rows, %i pages freed', report['events'], ARCHIVE_DB_NAME,
+                    report['rows'], report['pages'])
+    return report
+
+
+def start_maintenance():
+    """
+    Starts the periodic maintenance jobs of the database: pruning old message ids, compressing
+    odds history and archiving old events
+    :return: None
+    """
+
+    start_periodic(prune_messages, lambda: DEDUP_PRUNE_INTERVAL)
+    start_periodic(roll_odds_history, lambda: HISTORY_ROLL_INTERVAL)
+    start_periodic(archive_events, lambda: ARCHIVE_INTERVAL)
+
 
 def create_db():
     """
     Creates sqlite3 database
-    Tables: SPORTS, EVENTS, MARKETS, SELECTIONS, MESSAGES
+    Tables: SPORTS, EVENTS, MARKETS, SELECTIONS, MESSAGES, ODDS_TICKS, ODDS_BLOCKS
 
     SPORTS
     ------
@@ -23,8 +501,8 @@ def create_db():
     EVENTS
     ------
     Ev_ID: INT PRIMARY KEY event id
-    Ev_NAME: STR event name
-    Ev_STARTTIME: INT event start timestamp
+    Ev_NAME: STR INDEX event name, also in EVENTS_FTS full text index
+    Ev_STARTTIME: INT INDEX (with Ev_SPORTID) event start timestamp
     Ev_SPORTID: INT INDEX sport id -> SPORTS.Sp_ID
 
     MARKETS
@@ -44,71 +522,187 @@ def create_db():
     MESSAGES
     --------
     Me_ID: INT PRIMARY KEY message id
+    Me_TIME: INT INDEX timestamp the message was processed at, for retention
+
+    ODDS_TICKS
+    ----------
+    Ot_SELECTIONID: INT INDEX (with Ot_TIME) selection id -> SELECTIONS.Se_ID
+    Ot_EVENTID: INT INDEX (with Ot_TIME) event id -> EVENTS.Ev_ID
+    Ot_TIME: FLOAT time the odds were set at
+    Ot_ODDS: FLOAT odds, inserted by triggers on SELECTIONS
+
+    ODDS_BLOCKS
+    -----------
+    Ob_SELECTIONID: INT selection id -> SELECTIONS.Se_ID
+    Ob_EVENTID: INT INDEX (with Ob_START) event id -> EVENTS.Ev_ID
+    Ob_START: FLOAT time of the first tick of the block
+    Ob_END: FLOAT time of the last tick of the block
+    Ob_COUNT: INT number of ticks
+    Ob_DATA: BLOB compressed ticks, see history.pack
 
     :return: None
     """
 
-    with closing(sqlite3.connect(DB_NAME)) as conn:
+    with get_pool().connection() as conn:
         cur = conn.cursor()
-
-        # Drop tables
-        cur.execute('''DROP TABLE IF EXISTS SPORTS;''')
-        cur.execute('''DROP TABLE IF EXISTS EVENTS;''')
-        cur.execute('''DROP TABLE IF EXISTS MARKETS;''')
-        cur.execute('''DROP TABLE IF EXISTS SELECTIONS;''')
-        cur.execute('''DROP TABLE IF EXISTS MESSAGES;''')
-
-        # Create tables
-
-        # Create table MESSAGES
-        cur.execute('''CREATE TABLE IF NOT EXISTS MESSAGES
-                       (Me_ID INTEGER PRIMARY KEY);''')
-
-        # Create table SPORTS
-        cur.execute('''CREATE TABLE IF NOT EXISTS SPORTS
-                       (Sp_ID INTEGER PRIMARY KEY,
-                        Sp_NAME text);''')
-
-        # Create table EVENTS
-        cur.execute('''CREATE TABLE IF NOT EXISTS EVENTS
-                       (Ev_ID INTEGER PRIMARY KEY,
-                        Ev_NAME text,
-                        Ev_STARTTIME INTEGER,
-                        Ev_SPORTID INTEGER,
-                        FOREIGN KEY (Ev_SPORTID) REFERENCES SPORTS(Sp_ID));''')
-
-        # Create table MARKETS
-        cur.execute('''CREATE TABLE IF NOT EXISTS MARKETS
-                       (Ma_ID INTEGER PRIMARY KEY,
-                        Ma_NAME text,
-                        Ma_EVENTID INTEGER,
-                        FOREIGN KEY (Ma_EVENTID) REFERENCES EVENTS(Ev_ID));''')
-
-        # Create table SELECTIONS
-        cur.execute('''CREATE TABLE IF NOT EXISTS SELECTIONS
-                       (Se_ID INTEGER PRIMARY KEY,
-                        Se_NAME text,
-                        Se_ODDS FLOAT,
-                        Se_MARKETID INTEGER,
-                        Se_EVENTID INTEGER,
-                        FOREIGN KEY (Se_MARKETID) REFERENCES MARKETS(Ma_ID),
-                        FOREIGN KEY (Se_EVENTID) REFERENCES EVENTS(Ev_ID));''')
-
-        # Create indexes
-
-        # Create index on ENVENTS(Ev_SPORTID)
-        cur.execute('''CREATE INDEX IF NOT EXISTS evsp_in ON EVENTS(Ev_SPORTID);''')
-
-        # Create index on MARKETS(Ma_EVENTID)
-        cur.execute('''CREATE INDEX IF NOT EXISTS maev_in ON MARKETS(Ma_EVENTID);''')
-
-        # Creater indexes on SELECTIONS(Se_MARKETID, Se_EVENTID)
-        cur.execute('''CREATE INDEX IF NOT EXISTS sema_in ON SELECTIONS(Se_MARKETID);''')
-        cur.execute('''CREATE INDEX IF NOT EXISTS seev_in ON SELECTIONS(Se_EVENTID);''')
+        _drop_tables(cur)
+        _create_tables(cur)
+        _create_indexes(cur)
 
         # Commit
         conn.commit()
 
+    MATCH_CACHE.clear()
+    with _commit_lock:
+        ODDS_BOOK.clear(DB_NAME)
+        MESSAGE_IDS.clear(DB_NAME)
+
+
+def _drop_tables(cur):
+    """
+    Drops every table, their indexes with them
+    :param cur: sqlite3.Cursor
+    :return: None
+    """
+
+    cur.execute('''DROP TABLE IF EXISTS SPORTS;''')
+    cur.execute('''DROP TABLE IF EXISTS EVENTS;''')
+    cur.execute('''DROP TABLE IF EXISTS MARKETS;''')
+    cur.execute('''DROP TABLE IF EXISTS SELECTIONS;''')
+    cur.execute('''DROP TABLE IF EXISTS MESSAGES;''')
+    search.drop_index(cur)
+    history.drop_tables(cur)
+
+
+def _create_tables(cur):
+    """
+    Creates the tables, without indexes, see create_db
+    :param cur: sqlite3.Cursor
+    :return: None
+    """
+
+    # Create table MESSAGES
+    cur.execute('''CREATE TABLE IF NOT EXISTS MESSAGES
+                   (Me_ID INTEGER PRIMARY KEY,
+                    Me_TIME INTEGER);''')
+
+    # Create table SPORTS
+    cur.execute('''CREATE TABLE IF NOT EXISTS SPORTS
+                   (Sp_ID INTEGER PRIMARY KEY,
+                    Sp_NAME text);''')
+
+    # Create table EVENTS
+    cur.execute('''CREATE TABLE IF NOT EXISTS EVENTS
+                   (Ev_ID INTEGER PRIMARY KEY,
+                    Ev_NAME text,
+                    Ev_STARTTIME INTEGER,
+                    Ev_SPORTID INTEGER,
+                    FOREIGN KEY (Ev_SPORTID) REFERENCES SPORTS(Sp_ID));''')
+
+    # Create table MARKETS
+    cur.execute('''CREATE TABLE IF NOT EXISTS MARKETS
+                   (Ma_ID INTEGER PRIMARY KEY,
+                    Ma_NAME text,
+                    Ma_EVENTID INTEGER,
+                    FOREIGN KEY (Ma_EVENTID) REFERENCES EVENTS(Ev_ID));''')
+
+    # Create table SELECTIONS
+    cur.execute('''CREATE TABLE IF NOT EXISTS SELECTIONS
+                   (Se_ID INTEGER PRIMARY KEY,
+                    Se_NAME text,
+                    Se_ODDS FLOAT,
+                    Se_MARKETID INTEGER,
+                    Se_EVENTID INTEGER,
+                    FOREIGN KEY (Se_MARKETID) REFERENCES MARKETS(Ma_ID),
+                    FOREIGN KEY (Se_EVENTID) REFERENCES EVENTS(Ev_ID));''')
+
+    # Create odds history tables
+    history.create_tables(cur)
+
+
+def _create_indexes(cur):
+    """
+    Creates the indexes missing in the database, filling them if they are new, and the triggers
+    :param cur: sqlite3.Cursor
+    :return: None
+    """
+
+    # Create index on EVENTS(Ev_SPORTID, Ev_STARTTIME), replacing the former one on EVENTS(Ev_SPORTID)
+    cur.execute('''DROP INDEX IF EXISTS evsp_in;''')
+    cur.execute('''CREATE INDEX IF NOT EXISTS evspst_in ON EVENTS(Ev_SPORTID, Ev_STARTTIME);''')
+
+    # Create index on EVENTS(Ev_NAME) and full text index of names
+    cur.execute('''CREATE INDEX IF NOT EXISTS evna_in ON EVENTS(Ev_NAME);''')
+    search.create_index(cur)
+
+    # Create index on MARKETS(Ma_EVENTID)
+    cur.execute('''CREATE INDEX IF NOT EXISTS maev_in ON MARKETS(Ma_EVENTID);''')
+
+    # Creater indexes on SELECTIONS(Se_MARKETID, Se_EVENTID)
+    cur.execute('''CREATE INDEX IF NOT EXISTS sema_in ON SELECTIONS(Se_MARKETID);''')
+    cur.execute('''CREATE INDEX IF NOT EXISTS seev_in ON SELECTIONS(Se_EVENTID);''')
+
+    # Create index on MESSAGES(Me_TIME)
+    cur.execute('''CREATE INDEX IF NOT EXISTS metm_in ON MESSAGES(Me_TIME);''')
+
+    # Create odds history indexes and the triggers recording odds changes
+    history.create_indexes(cur)
+
+
+def upgrade_db():
+    """
+    Brings a database created by a former version up to date, keeping its data
+    :return: None
+    """
+
+    with get_pool().connection() as conn:
+        with transaction(conn) as cur:
+            # Add MESSAGES.Me_TIME, retaining former message ids from now on
+            cur.execute('''SELECT name FROM pragma_table_info('MESSAGES');''')
+            if ('Me_TIME',) not in cur.fetchall():
+                cur.execute('''ALTER TABLE MESSAGES ADD COLUMN Me_TIME INTEGER;''')
+                cur.execute('''UPDATE MESSAGES SET Me_TIME = ?;''', (int(time.time()),))
+
+            # Add odds history, recorded from now on
+            history.create_tables(cur)
+
+            _create_indexes(cur)
+
+
+def export_snapshot(path):
+    """
+    Writes every table to a snapshot file, as of a single commit, see snapshot.py
+    :param path: STR file path
+    :return: DICT table name -> INT rows written
+    """
+
+    with get_pool().connection() as conn:
+        cur = conn.cursor()
+        cur.execute('''BEGIN;''')
+        try:
+            return snapshot.export(cur, SNAPSHOT_TABLES, path)
+        finally:
+            conn.rollback()
+
+
+def import_snapshot(path):
+    """
+    Replaces the database content with a snapshot file, in a single transaction
+    Tables are created without indexes and triggers, which are created once the rows are in: building
+    an index from the loaded rows is much faster than updating it on every insert
+    :param path: STR file path
+    :return: DICT table name -> INT rows inserted
+    """
+
+    with get_pool().connection() as conn:
+        with transaction(conn) as cur:
+            _drop_tables(cur)
+            _create_tables(cur)
+            counts = snapshot.load(cur, path)
+            _create_indexes(cur)
+    reset_memory()
+    return counts
+
 
 def show_db():
     """
@@ -116,7 +710,7 @@ def show_db():
     :return: None
     """
 
-    with closing(sqlite3.connect(DB_NAME)) as conn:
+    with get_pool().connection() as conn:
         cur = conn.cursor()
         cur.execute('''SELECT name FROM sqlite_master WHERE type='table';''')
         tables = cur.fetchall()
@@ -130,15 +724,19 @@ def show_db():
 def message_processed(message_id):
     """
     Checks if a message has been already processed
+    Ids not processed within DEDUP_RETENTION are answered from memory; only possible duplicates are
+    looked up in the database. Older ids due to be pruned, and ids processed by other processes
+    since the filter was loaded, may be answered as not processed, so ingest relies on the
+    MESSAGES primary key instead
     :param message_id: INT message id
     :return: BOOLEAN True if it has been processed, False if not
     """
 
-    with closing(sqlite3.connect(DB_NAME)) as conn:
-        cur = conn.cursor()
-        cur.execute('''SELECT Me_ID FROM MESSAGES
-                       WHERE Me_ID = '%i';''' % message_id)
-        results = cur.fetchall()
+    if message_id not in get_message_ids():
+        return False
+
+    with get_pool().connection() as conn:
+        results = SELECT_MESSAGE.fetchall(conn.cursor(), (message_id,))
     if len(results) == 1:
         return True
     else:
@@ -152,147 +750,714 @@ def insert_processed_message(message_id):
     :return: None
     """
 
-    with closing(sqlite3.connect(DB_NAME)) as conn:
+    with get_pool().connection() as conn:
         cur = conn.cursor()
 
-        # Insert message_id in messages table
-        cur.execute('''INSERT INTO MESSAGES VALUES('%i');''' % message_id)
+        # Insert message_id in messages table, ignoring ids already there
+        _claim_message(cur, message_id)
 
         # Commit
         conn.commit()
 
 
-def new_event(full_event_info):
+@contextmanager
+def transaction(conn, committed=None):
     """
-    Populates database tables with the new event data provided by external data provider
-    :param full_event_info: DICT event data received from external provider
+    Runs a block inside a single write transaction
+    The write lock is taken up front (BEGIN IMMEDIATE) so concurrent writers queue on it instead
+    of failing when upgrading from a read lock. Commits on success, rolls back on error
+    :param conn: sqlite3.Connection
+    :param committed: LIST of (provider.Message, DICT) written by the block, filled by it; in-memory
+                      state is updated for them right after the commit, in commit order, and the
+                      DICTs filled with the selection counts of 'UpdateOdds' messages
+    :return: sqlite3.Cursor
+    """
+
+    start = time.perf_counter()
+    conn.execute('''BEGIN IMMEDIATE;''')
+    metrics.DB_SECONDS.observe(time.perf_counter() - start, ('begin', ''))
+    try:
+        yield conn.cursor()
+    except BaseException:
+        conn.rollback()
+        raise
+    with _commit_lock:
+        start = time.perf_counter()
+        conn.commit()
+        metrics.DB_SECONDS.observe(time.perf_counter() - start, ('commit', ''))
+        for message, result in committed or ():
+            result.update(_message_committed(message, conn=conn))
+
+
+def reset_memory():
+    """
+    Forgets the in-memory state mirrored from the database, reloaded from it on next use
+    Used by worker processes when they may have missed commits of the writer process
     :return: None
     """
 
-    event = full_event_info['event']
-    with closing(sqlite3.connect(DB_NAME)) as conn:
-        cur = conn.cursor()
+    MATCH_CACHE.clear()
+    with _commit_lock:
+        ODDS_BOOK.clear()
+        MESSAGE_IDS.clear()
 
-        # Insert sport
-        cur.execute('''INSERT OR IGNORE INTO SPORTS VALUES('%i', '%s');''' %
-                    (event['sport']['id'], event['sport']['name']))
 
-        # Insert event
-        event_time = datetime.datetime.strptime(event['startTime'], "%Y-%m-%d %H:%M:%S").timestamp()
-        cur.execute('''INSERT INTO EVENTS VALUES('%i', '%s', '%i', '%i');''' %
-                    (event['id'], event['name'], event_time, event['sport']['id']))
+def apply_committed(messages):
+    """
+    Updates in-memory state after messages have been committed by another process
+    :param messages: LIST of provider.Message committed, in commit order
+    :return: None
+    """
 
-        # Insert markets
-        for market in event['markets']:
-            cur.execute('''INSERT INTO MARKETS VALUES('%i', '%s', '%i');''' %
-                        (market['id'], market['name'], event['id']))
+    with _commit_lock:
+        for message in messages:
+            _message_committed(message, local=False)
 
-            # Insert selections
-            for selection in market['selections']:
-                cur.execute('''INSERT INTO SELECTIONS VALUES('%i', '%s', '%f', '%i', '%i');''' %
-                            (selection['id'], selection['name'], selection['odds'], market['id'], event['id']))
 
-        # Commit
-        conn.commit()
+def _message_committed(message, local=True, conn=None):
+    """
+    Updates in-memory state after a message has been committed
+    State not loaded yet, e.g. after reset_memory, is loaded with the connection of the commit, as
+    taking another one while holding it could wait for a free connection forever
+    :param message: provider.Message committed
+    :param local: BOOLEAN True if committed by this process, which then owns write-behind odds
+    :param conn: sqlite3.Connection that committed the message, or None
+    :return: DICT {'changed', 'unchanged', 'unknown'} number of selections of 'UpdateOdds' messages,
+             empty for other messages
+    """
 
-    # Insert message id in messages table
-    insert_processed_message(full_event_info['id'])
+    get_message_ids(conn).add(message.id)
+    if local:
+        MESSAGES_INGESTED.inc(labels=(message.message_type,))
+    event = message.event
+    odds = event.odds()
+    if message.message_type == provider.UPDATE_ODDS:
+        # Only changed odds patch the cache and reach the stream. Applied in commit order, so the
+        # counts see earlier messages of the same transaction. A book loaded after the commit, e.g.
+        # in a worker process after reset_memory, already has them, so all are taken as changed
+        loaded = ODDS_BOOK.database == DB_NAME
+        changed, unknown = get_odds_book(conn).apply(event.id, odds, dirty=ODDS_WRITE_BEHIND and local)
+        if not loaded:
+            changed, unknown = odds, 0
+        if changed:
+            MATCH_CACHE.patch_odds(event.id, changed)
+            ODDS_STREAM.publish(event.id, [{'market': market_id, 'selection': selection_id, 'odds': value}
+                                              for market_id, selection_id, value in changed])
+            if ODDS_WRITE_BEHIND and local:
+                start_odds_flusher()
+        return {'changed': len(changed), 'unchanged': len(odds) - len(changed) - unknown, 'unknown': unknown}
+
+    get_odds_book(conn).add_event(event.id, odds)
+    MATCH_CACHE.invalidate(event.id)
+    return {}
+
+
+def _claim_message(cur, message_id):
+    """
+    Inserts a message id in messages table unless it is already there
+    :param cur: sqlite3.Cursor
+    :param message_id: INT message id
+    :return: BOOLEAN True if the id was inserted, False if it had been already processed
+    """
+
+    return INSERT_MESSAGE.execute(cur, (message_id, int(time.time()))) == 1
+
+
+def _write_new_event(cur, event):
+    """
+    Inserts sport, event, markets and selections of a 'NewEvent' message
+    :param cur: sqlite3.Cursor
+    :param event: provider.Event of the message
+    :return: None
+    """
+
+    # Insert sport
+    INSERT_SPORT.execute(cur, (event.sport.id, event.sport.name))
+
+    # Insert event
+    INSERT_EVENT.execute(cur, (event.id, event.name, event.start_time, event.sport.id))
+    search.index_event(cur, event.id, event.name)
+
+    # Insert markets
+    INSERT_MARKET.executemany(cur, [(market.id, market.name, event.id) for market in event.markets])
+
+    # Insert selections
+    INSERT_SELECTION.executemany(cur, [(selection.id, selection.name, selection.odds, market.id, event.id)
+                                       for market in event.markets for selection in market.selections])
+
+
+def _write_update_odds(cur, event):
+    """
+    Updates selection odds of an 'UpdateOdds' message, skipping the selections whose odds did not change
+    Providers resend whole markets for a single changed price, so most selections are usually unchanged
+    With ODDS_WRITE_BEHIND odds are only applied to the odds book once the message is committed
+    and written later by the odds flusher. Either way selections are counted as the book applies
+    the commit, see _message_committed
+    :param cur: sqlite3.Cursor
+    :param event: provider.Event of the message
+    :return: None
+    """
+
+    if not ODDS_WRITE_BEHIND:
+        UPDATE_ODDS.executemany(cur, [(selection.odds, selection.id, market.id, event.id)
+                                      for market in event.markets for selection in market.selections])
+
+
+def _count_odds(results):
+    """
+    Adds the changed, unchanged and unknown selections of committed odds updates to ODDS_SELECTIONS
+    :param results: ITERABLE of DICT results of committed messages
+    :return: None
+    """
+
+    counts = dict.fromkeys(('changed', 'unchanged', 'unknown'), 0)
+    for result in results:
+        for key in counts:
+            counts[key] += result.get(key, 0)
+    if any(counts.values()):
+        for key, count in counts.items():
+            ODDS_SELECTIONS.inc(count, (key,))
+
+
+class MessageWriteError(ValueError):
+    """
+    Raised for valid messages whose data can not be written, e.g. with ids used by another event
+    """
+
+
+# Errors of message writes reported as bad messages, by ingest and by ingest_batch per message.
+# Other database errors, e.g. locked or full, fail the whole call: the message can be sent again
+_WRITE_ERRORS = (sqlite3.IntegrityError, ValueError)
+
+
+def _ingest(message, writer, result=None):
+    """
+    Claims the message id and applies its data in one transaction
+    If the id had been already processed nothing is written, so duplicated deliveries are safe even
+    when several workers get the same message at once. On error nothing is written either, the
+    message id included, so the message can be delivered again
+    :param message: provider.Message received from external provider
+    :param writer: FUNCTION writing the message event with a cursor
+    :param result: DICT filled with the selection counts of 'UpdateOdds' messages
+    :return: BOOLEAN True if the message has been processed, False if it had been already processed
+    :raises MessageWriteError: if the message data could not be written
+    """
+
+    # Known duplicates are answered without taking the write lock
+    if message_processed(message.id):
+        MESSAGES_DUPLICATE.inc()
+        return False
+
+    # In-memory state is loaded before taking a connection, see _message_committed
+    get_odds_book()
+    committed = []
+    counts = {}
+    with get_pool().connection() as conn:
+        with transaction(conn, committed) as cur:
+            if not _claim_message(cur, message.id):
+                MESSAGES_DUPLICATE.inc()
+                return False
+            try:
+                writer(cur, message.event)
+            except _WRITE_ERRORS as error:
+                raise MessageWriteError(str(error)) from error
+            committed.append((message, counts))
+    _count_odds([counts])
+    if result is not None:
+        result.update(counts)
+    return True
+
+
+def new_event(full_event_info):
+    """
+    Populates database tables with the new event data provided by external data provider
+    :param full_event_info: DICT or provider.Message event data received from external provider
+    :return: BOOLEAN True if the message has been processed, False if it had been already processed
+    :raises provider.MessageError: if the message is not valid
+    """
+
+    return _ingest(provider.validate(full_event_info), _write_new_event)
 
 
 def update_odds(update_event_info):
     """
     Updates odds from data received from external data provider
-    :param update_event_info: DICT update odds data from external provider
-    :return: None
+    :param update_event_info: DICT or provider.Message update odds data from external provider
+    :return: BOOLEAN True if the message has been processed, False if it had been already processed
+    :raises provider.MessageError: if the message is not valid
     """
 
-    event = update_event_info['event']
-    with closing(sqlite3.connect(DB_NAME)) as conn:
-        cur = conn.cursor()
-        for market in event['markets']:
-            for selection in market['selections']:
-                cur.execute('''UPDATE SELECTIONS SET Se_ODDS = '%f' WHERE
-                            Se_ID = '%i' AND Se_MARKETID = '%i' AND Se_EVENTID = '%i';''' %
-                            (selection['odds'], selection['id'], market['id'], event['id']))
+    return _ingest(provider.validate(update_event_info), _write_update_odds)
 
-        # Commit
-        conn.commit()
 
-    # Insert message id in messages table
-    insert_processed_message(update_event_info['id'])
+MESSAGE_WRITERS = {provider.NEW_EVENT: _write_new_event,
+                   provider.UPDATE_ODDS: _write_update_odds}
+
+# Message statuses reported by ingest_batch
+PROCESSED = 'processed'
+DUPLICATE = 'duplicate'
+ERROR = 'error'
+
+
+def ingest(message, result=None):
+    """
+    Processes a message from external data provider: dedup check, data writes and message id insert
+    are done in a single transaction
+    Messages are validated first, bad ones are rejected before any database work
+    :param message: DICT or provider.Message received from external provider
+    :param result: DICT filled with 'changed', 'unchanged' and 'unknown' selections for 'UpdateOdds' messages
+    :return: BOOLEAN True if the message has been processed, False if it had been already processed
+    :raises provider.MessageTypeError: if the message type is unknown
+    :raises provider.MessageError: if the message is not valid otherwise
+    :raises MessageWriteError: if the message data could not be written
+    """
+
+    message = provider.validate(message)
+    return _ingest(message, MESSAGE_WRITERS[message.message_type], result)
+
 
+def ingest_batch(messages):
+    """
+    Processes several messages from external data provider in a single transaction
+    Messages are validated first: bad ones are reported without any database work, and a batch
+    without valid messages does not open a transaction. Every valid message runs inside its own
+    savepoint, so a message failing to write is rolled back and reported without affecting the rest
+    of the batch
+    :param messages: LIST of DICT or provider.Message received from external provider
+    :return: LIST of DICT {'id', 'status', ['error'], ['changed', 'unchanged', 'unknown']} per message, in the
+             same order, with the changed, unchanged and unknown selections of 'UpdateOdds' messages
+    """
 
-def get_match_by_name(match_name):
+    results = []
+    valid = []
+    for message in messages:
+        try:
+            message = provider.validate(message)
+        except provider.MessageError as error:
+            results.append({'id': error.message_id, 'status': ERROR, 'error': str(error)})
+        else:
+            results.append({'id': message.id})
+            valid.append((message, results[-1]))
+
+    committed = []
+    if valid:
+        # In-memory state is loaded before taking a connection, see _message_committed
+        get_message_ids()
+        get_odds_book()
+        with get_pool().connection() as conn:
+            with transaction(conn, committed) as cur:
+                for message, result in valid:
+                    cur.execute('''SAVEPOINT message;''')
+                    try:
+                        if _claim_message(cur, message.id):
+                            MESSAGE_WRITERS[message.message_type](cur, message.event)
+                            result['status'] = PROCESSED
+                            committed.append((message, result))
+                        else:
+                            result['status'] = DUPLICATE
+                    except _WRITE_ERRORS as error:
+                        cur.execute('''ROLLBACK TO message;''')
+                        result['status'] = ERROR
+                        result['error'] = str(error)
+                    cur.execute('''RELEASE message;''')
+    MESSAGES_DUPLICATE.inc(sum(result['status'] == DUPLICATE for result in results))
+    _count_odds(result for result in results if result['status'] == PROCESSED)
+    return results
+
+
+def get_match_by_name(match_name, limit=None):
     """
     Get match data by name
     :param match_name: STR match name
+    :param limit: INT maximum number of matches or None for every match
     :return: DICT match data
     """
 
-    matches = []
-    with closing(sqlite3.connect(DB_NAME)) as conn:
+    with get_pool().connection() as conn:
+        results = SELECT_MATCHES_BY_NAME.fetchall(conn.cursor(), (match_name, -1 if limit is None else limit))
+    return [_match_summary(*match) for match in results]
+
+
+def search_matches(text, limit=SEARCH_LIMIT):
+    """
+    Search matches by words of their name, prefixes included, e.g. 'Real' or 'real mad'
+    :param text: STR search text
+    :param limit: INT maximum number of matches, up to SEARCH_MAX_LIMIT
+    :return: LIST of DICT matches data, best matches first
+    """
+
+    with get_pool().connection() as conn:
+        results = search.search(conn.cursor(), text, min(limit, SEARCH_MAX_LIMIT))
+    return [_match_summary(*match) for match in results]
+
+
+def get_match_snapshot(match_id):
+    """
+    Get match data by id from the match cache, loading it from database on a miss
+    :param match_id: INT match id
+    :return: cache.Snapshot with match data and its JSON serialization or None if not found
+    """
+
+    snapshot = MATCH_CACHE.get(match_id)
+    if snapshot is not None:
+        return snapshot
+
+    token = MATCH_CACHE.begin_load(match_id)
+    match_info = None
+    try:
+        match_info = _load_match_by_id(match_id)
+    finally:
+        snapshot = MATCH_CACHE.end_load(match_id, token, match_info)
+    return snapshot
+
+
+def get_odds_history(match_id, start=None, end=None):
+    """
+    Get the odds history of a match
+    :param match_id: INT the match id
+    :param start: FLOAT unix time, changes from it included, or None from the first one
+    :param end: FLOAT unix time, changes from it excluded, or None up to the last one
+    :return: DICT {'id', 'selections': [{'id', 'market', 'times', 'odds'}]} or None if the match does not exist
+    """
+
+    with get_pool().connection() as conn:
         cur = conn.cursor()
-        cur.execute('''SELECT Ev_ID, Ev_STARTTIME FROM EVENTS WHERE Ev_NAME = '%s';''' % match_name)
-        results = cur.fetchall()
-    for match in results:
-        match_info = {'id': match[0],
-                      'url': 'http://127.0.0.1:5000/api/v1/resources/match/%i' % match[0],
-                      'name': match_name,
-                      'startTime': datetime.datetime.fromtimestamp(match[1]).strftime("%Y-%m-%d %H:%M:%S")}
-        matches.append(match_info)
-    return matches
+        selections = SELECT_EVENT_SELECTIONS.fetchall(cur, (match_id,))
+        if not selections:
+            return None
+        changes = history.event_history(cur, match_id, float('-inf') if start is None else start,
+                                         float('inf') if end is None else end)
+
+    results = []
+    for selection_id, market_id in selections:
+        if selection_id is None:
+            continue
+        times, odds = changes.get(selection_id, ((), ()))
+        results.append({'id': selection_id, 'market': market_id, 'times': list(times), 'odds': list(odds)})
+    return {'id': match_id, 'selections': results}
 
 
 def get_match_by_id(match_id):
     """
     Get match data by id
+    The DICT is shared with the match cache and must not be modified
     :param match_id: INT match id
+    :return: DICT match data, empty if not found
+    """
+
+    snapshot = get_match_snapshot(match_id)
+    return {} if snapshot is None else snapshot.document
+
+
+def _group_markets(results, odds=None):
+    """
+    Groups joined event rows into markets with their selections in a single pass
+    Rows must be ordered by market, so markets and selections keep the order of the query
+    :param results: LIST of rows (..., Ma_ID, Ma_NAME, Se_ID, Se_NAME, Se_ODDS) as the last five columns
+    :param odds: DICT selection id -> FLOAT odds taking precedence over Se_ODDS
+    :return: LIST of DICT markets data
+    """
+
+    markets_list = []
+    market_id = None
+    selection_list = None
+    for row in results:
+        if row[-5] != market_id:
+            market_id = row[-5]
+            selection_list = []
+            markets_list.append({'id': market_id,
+                                 'name': row[-4],
+                                 'selections': selection_list})
+        selection_list.append({'id': row[-3],
+                               'name': row[-2],
+                               'odds': odds.get(row[-3], row[-1]) if odds else row[-1]})
+    return markets_list
+
+
+def _load_match_by_id(match_id):
+    """
+    Get match data by id from database, with odds from the odds book
+    Markets are ordered by id and so are selections within a market
+    :param match_id: INT match id
+    :return: DICT match data, empty if not found
+    """
+
+    with get_pool().connection() as conn:
+        results = SELECT_MATCH.fetchall(conn.cursor(), (match_id,))
+
+    if not results:
+        return {}
+    return _match_document(match_id, results)
+
+
+def _match_document(match_id, results):
+    """
+    Builds the data of a match from its joined rows
+    :param match_id: INT match id
+    :param results: LIST of rows of the match as returned by SELECT_MATCH, not empty
+    :return: DICT match data
+    """
+
+    return _match_info(results[0][:5], _group_markets(results, get_odds_book().event_odds(match_id)))
+
+
+def _match_info(event, markets_list):
+    """
+    Builds the data of a match
+    :param event: TUPLE (Ev_ID, Ev_NAME, Ev_STARTTIME, Ev_SPORTID, Sp_NAME)
+    :param markets_list: LIST of DICT markets data
     :return: DICT match data
     """
 
-    with closing(sqlite3.connect(DB_NAME)) as conn:
+    match_id, match_name, match_starttime, match_sport_id, match_sport_name = event
+    return {'id': match_id,
+            'url': '%s%i' % (MATCH_URL, match_id),
+            'name': match_name,
+            'startTime': format_start_time(match_starttime),
+            'sport': {'id': match_sport_id,
+                      'name': match_sport_name},
+            'markets': markets_list
+            }
+
+
+def _load_matches_by_ids(match_ids):
+    """
+    Get the data of several matches from database, with odds from the odds book
+    Events, markets and selections are read with one query each, in index order so none of them
+    sorts, instead of joining them: joined rows repeat the event and market of every selection.
+    Matches are built as SELECT_MATCH would: markets without selections and matches without
+    markets are left out
+    :param match_ids: LIST of INT match ids
+    :return: DICT match id -> DICT match data, only for found matches
+    """
+
+    ids = (json.dumps(match_ids),)
+    with get_pool().connection() as conn:
         cur = conn.cursor()
-        cur.execute('''SELECT Ev_ID, Ev_NAME, Ev_STARTTIME, Ev_SPORTID, Sp_NAME, Ma_ID, Ma_NAME, Se_ID, Se_NAME, Se_ODDS
-                       FROM EVENTS
-                       INNER JOIN SPORTS ON SPORTS.Sp_ID = EVENTS.Ev_SPORTID
-                       INNER JOIN MARKETS ON MARKETS.Ma_EVENTID = EVENTS.Ev_ID
-                       INNER JOIN SELECTIONS ON SELECTIONS.Se_EVENTID = EVENTS.Ev_ID
-                                            AND SELECTIONS.Se_MARKETID = MARKETS.Ma_ID
-                       WHERE Ev_ID = '%i';''' % match_id)
-        results = cur.fetchall()
-
-    # Common data to every result from database
-    match_name = results[0][1]
-    match_starttime = results[0][2]
-    match_sport_id = results[0][3]
-    match_sport_name = results[0][4]
-    markets_list = []
+        events = SELECT_MATCHES_EVENTS.fetchall(cur, ids)
+        markets = SELECT_MATCHES_MARKETS.fetchall(cur, ids)
+        selections = SELECT_MATCHES_SELECTIONS.fetchall(cur, ids)
+
+    event_markets = {}
+    selection_lists = {}
+    for event_id, market_id, market_name in markets:
+        selection_list = selection_lists[event_id, market_id] = []
+        event_markets.setdefault(event_id, []).append({'id': market_id,
+                                                       'name': market_name,
+                                                       'selections': selection_list})
+    book = get_odds_book()
+    for event_id, rows in itertools.groupby(selections, key=lambda row: row[0]):
+        odds = book.event_odds(event_id)
+        for _, market_id, selection_id, selection_name, selection_odds in rows:
+            selection_list = selection_lists.get((event_id, market_id))
+            if selection_list is not None:
+                selection_list.append({'id': selection_id,
+                                       'name': selection_name,
+                                       'odds': odds.get(selection_id, selection_odds) if odds else selection_odds})
+
+    documents = {}
+    for event in events:
+        markets_list = [market for market in event_markets.get(event[0], ()) if market['selections']]
+        if markets_list:
+            documents[event[0]] = _match_info(event, markets_list)
+    return documents
+
+
+def parse_match_ids(values):
+    """
+    Parses the ids of a bulk match fetch
+    :param values: LIST of STR or INT match ids
+    :return: LIST of INT match ids
+    :raises ValueError: if an id is not an integer, or there are none or more than MATCHES_MAX_IDS
+    """
+
+    if not isinstance(values, list) or not 0 < len(values) <= MATCHES_MAX_IDS:
+        raise ValueError('Between 1 and %i match ids expected' % MATCHES_MAX_IDS)
+    match_ids = []
+    for value in values:
+        if not isinstance(value, (int, str)) or isinstance(value, bool):
+            raise ValueError('Bad match id: %r' % (value,))
+        match_ids.append(parse_match_id(value))
+    return match_ids
+
+
+def parse_match_id(value):
+    """
+    Parses a match id, which must fit in an SQLite integer
+    :param value: STR or INT match id
+    :return: INT match id
+    :raises ValueError: if the id is not an integer or out of range
+    """
+
+    match_id = int(value)
+    if not provider.MIN_INTEGER <= match_id <= provider.MAX_INTEGER:
+        raise ValueError('Bad match id: %r' % (value,))
+    return match_id
+
+
+def get_match_snapshots(match_ids):
+    """
+    Get the data of several matches by id: cached matches from the match cache and the others from
+    database in one go, then cached
+    :param match_ids: ITERABLE of INT match ids
+    :return: LIST of cache.Snapshot in the order of the ids, without repeated or not found matches
+    """
+
+    match_ids = list(dict.fromkeys(match_ids))
+    snapshots = {}
+    for match_id in match_ids:
+        snapshot = MATCH_CACHE.get(match_id)
+        if snapshot is not None:
+            snapshots[match_id] = snapshot
+
+    missing = [match_id for match_id in match_ids if match_id not in snapshots]
+    if missing:
+        tokens = [(match_id, MATCH_CACHE.begin_load(match_id)) for match_id in missing]
+        documents = {}
+        try:
+            documents = _load_matches_by_ids(missing)
+        finally:
+            for match_id, token in tokens:
+                snapshot = MATCH_CACHE.end_load(match_id, token, documents.get(match_id))
+                if snapshot is not None:
+                    snapshots[match_id] = snapshot
+
+    return [snapshots[match_id] for match_id in match_ids if match_id in snapshots]
+
+
+def iter_match_snapshots(match_ids):
+    """
+    Get the data of several matches by id, MATCHES_FETCH_CHUNK matches at a time
+    :param match_ids: LIST of INT match ids
+    :return: GENERATOR of cache.Snapshot in the order of the ids, see get_match_snapshots
+    """
+
+    match_ids = list(dict.fromkeys(match_ids))
+    for index in range(0, len(match_ids), MATCHES_FETCH_CHUNK):
+        for snapshot in get_match_snapshots(match_ids[index:index + MATCHES_FETCH_CHUNK]):
+            yield snapshot
 
-    # Set of markets
-    markets = set([(x[5], x[6]) for x in results])
-    for market in markets:
-        selection_list = []
-
-        # List of selections
-        selections = [(x[7], x[8], x[9]) for x in results if (x[5], x[6]) == market]
-        for selection in selections:
-            selection_list.append({'id': selection[0],
-                                   'name': selection[1],
-                                   'odds': selection[2]})
-        markets_list.append({'id': market[0],
-                             'name': market[1],
-                             'selections': selection_list})
-
-    # Populate DICT with match data
-    match_info = {'id': match_id,
-                  'url': '%s%i' % (MATCH_URL, match_id),
-                  'name': match_name,
-                  'startTime': datetime.datetime.fromtimestamp(match_starttime).strftime("%Y-%m-%d %H:%M:%S"),
-                  'sport': {'id': match_sport_id,
-                            'name': match_sport_name},
-                  'markets': markets_list
-                  }
-    return match_info
+
+def parse_start_time(value):
+    """
+    Parses a start time as given by providers and returned by the API
+    :param value: STR time as "%Y-%m-%d %H:%M:%S" or None
+    :return: INT timestamp or None
+    """
+
+    if value is None:
+        return None
+    return provider.parse_start_time(value)
+
+
+@functools.lru_cache(maxsize=provider.START_TIME_CACHE_SIZE)
+def format_start_time(timestamp):
+    """
+    Formats a start timestamp as given by providers and returned by the API
+    :param timestamp: INT timestamp
+    :return: STR time as "%Y-%m-%d %H:%M:%S"
+    """
+
+    return datetime.datetime.fromtimestamp(timestamp).strftime(provider.START_TIME_FORMAT)
+
+
+def parse_cursor(cursor):
+    """
+    Parses a cursor returned by get_matches_by_start_time
+    :param cursor: STR cursor
+    :return: TUPLE (INT start timestamp, INT event id)
+    :raises ValueError: if the cursor is not two integers stored as SQLite INTEGER
+    """
+
+    start_time, _, event_id = cursor.partition(':')
+    after = int(start_time), int(event_id)
+    if not all(provider.MIN_INTEGER <= value <= provider.MAX_INTEGER for value in after):
+        raise ValueError('Bad cursor: %r' % (cursor,))
+    return after
+
+
+def _query_matches_by_start_time(cur, sport_name, start, end, after, limit):
+    """
+    Gets one page of matches of a sport ordered by start time and id
+    Uses the (Ev_SPORTID, Ev_STARTTIME) index for both the filter and the order, so the cost of
+    a page does not depend on how many events come before it
+    :param cur: sqlite3.Cursor
+    :param sport_name: STR sport name
+    :param start: INT minimum start timestamp, included, or None
+    :param end: INT maximum start timestamp, excluded, or None
+    :param after: TUPLE (INT start timestamp, INT event id) of the last match of the previous page or None
+    :param limit: INT maximum number of matches
+    :return: LIST of (Ev_ID, Ev_NAME, Ev_STARTTIME)
+    """
+
+    after_time, after_id = after if after is not None else (provider.MIN_INTEGER, provider.MIN_INTEGER)
+    # The cursor time is also the lower bound of the index range, so SQLite seeks past the events
+    # of previous pages instead of reading and filtering them out
+    start = provider.MIN_INTEGER if start is None else start
+    return SELECT_MATCHES_BY_START_TIME.fetchall(cur, (sport_name, max(start, after_time),
+                                                       provider.MAX_INTEGER if end is None else end,
+                                                       after_time, after_id, limit))
+
+
+def _match_summary(match_id, match_name, match_start_time):
+    """
+    Builds the match data of listings
+    :param match_id: INT match id
+    :param match_name: STR match name
+    :param match_start_time: INT match start timestamp
+    :return: DICT match data
+    """
+
+    return {'id': match_id,
+            'url': '%s%i' % (MATCH_URL, match_id),
+            'name': match_name,
+            'startTime': format_start_time(match_start_time)}
+
+
+def get_matches_by_start_time(sport_name, start=None, end=None, cursor=None, limit=MATCHES_PAGE_SIZE):
+    """
+    Get a page of matches of a sport by start time
+    :param sport_name: STR sport name
+    :param start: INT minimum start timestamp, included, or None
+    :param end: INT maximum start timestamp, excluded, or None
+    :param cursor: STR cursor returned with the previous page or None for the first page
+    :param limit: INT maximum number of matches, up to MATCHES_MAX_LIMIT
+    :return: TUPLE (LIST of DICT matches data, STR cursor of the next page or None if it is the last one)
+    """
+
+    limit = min(limit, MATCHES_MAX_LIMIT)
+    with get_pool().connection() as conn:
+        results = _query_matches_by_start_time(conn.cursor(), sport_name, start, end,
+                                               parse_cursor(cursor) if cursor else None, limit + 1)
+
+    next_cursor = None
+    if len(results) > limit:
+        results = results[:limit]
+        next_cursor = '%i:%i' % (results[-1][2], results[-1][0])
+    return [_match_summary(*match) for match in results], next_cursor
+
+
+def iter_matches_by_start_time(sport_name, start=None, end=None, cursor=None):
+    """
+    Get every match of a sport by start time, lazily
+    Matches are read in pages of MATCHES_PAGE_SIZE, each with its own short read, so a slow
+    consumer does not keep a connection or a read transaction open
+    :param sport_name: STR sport name
+    :param start: INT minimum start timestamp, included, or None
+    :param end: INT maximum start timestamp, excluded, or None
+    :param cursor: STR cursor to start after or None to start from the first match
+    :return: GENERATOR of DICT matches data
+    """
+
+    after = parse_cursor(cursor) if cursor else None
+    while True:
+        with get_pool().connection() as conn:
+            results = _query_matches_by_start_time(conn.cursor(), sport_name, start, end, after, MATCHES_PAGE_SIZE)
+        for match in results:
+            yield _match_summary(*match)
+        if len(results) < MATCHES_PAGE_SIZE:
+            return
+        after = (results[-1][2], results[-1][0])
 
 
 def get_football_matches_by_start_time():
@@ -301,24 +1466,7 @@ def get_football_matches_by_start_time():
     :return: DICT macthes data
     """
 
-    with closing(sqlite3.connect(DB_NAME)) as conn:
-        cur = conn.cursor()
-        cur.execute('''SELECT Sp_ID FROM SPORTS WHERE Sp_NAME = 'Football';''')
-        sport_id = cur.fetchall()[0]
-        cur.execute('''SELECT Ev_ID, Ev_NAME, Ev_STARTTIME FROM EVENTS
-                       WHERE Ev_SPORTID = '%i' ORDER BY Ev_STARTTIME ASC;''' % sport_id)
-        results = cur.fetchall()
-
-    # Populate list with matches data
-    matches = []
-    for match in results:
-        match_id, match_name, match_start_time = match
-        match_info = {'id': match_id,
-                      'url': '%s%i' % (MATCH_URL, match_id),
-                      'name': match_name,
-                      'startTime': datetime.datetime.fromtimestamp(match_start_time).strftime("%Y-%m-%d %H:%M:%S")}
-        matches.append(match_info)
-    return matches
+    return list(iter_matches_by_start_time('Football'))
 
 if __name__ == '__main__':
 
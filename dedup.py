@@ -0,0 +1,178 @@
+# coding=utf-8
+# __author__ = 'Mario Romera Fernández'
+
+import math
+import threading
+import time
+
+
+_MASK64 = 0xFFFFFFFFFFFFFFFF
+
+
+def _mix(key):
+    """
+    Spreads the bits of a key over 64 bits (splitmix64 finalizer), so sequential ids hash well
+    :param key: INT key, other types are hashed first
+    :return: INT 64 bits hash
+    """
+
+    if not isinstance(key, int):
+        key = hash(key)
+    key = (key ^ (key >> 30)) * 0xBF58476D1CE4E5B9 & _MASK64
+    key = (key ^ (key >> 27)) * 0x94D049BB133111EB & _MASK64
+    return key ^ (key >> 31)
+
+
+class BloomFilter(object):
+    """
+    Bloom filter: a key not in the filter is never reported as present, a key reported as present
+    may not be in it with probability 'error_rate' once 'capacity' keys have been added
+    """
+
+    __slots__ = ('capacity', 'size', 'hashes', 'bits', 'count')
+
+    def __init__(self, capacity, error_rate):
+        """
+        :param capacity: INT number of keys the filter is sized for
+        :param error_rate: FLOAT false positive rate at capacity
+        """
+
+        self.capacity = capacity
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        """
+        Bit positions of a key, by double hashing
+        :param key: INT key
+        :return: GENERATOR of INT bit positions
+        """
+
+        mixed = _mix(key)
+        first = mixed & 0xFFFFFFFF
+        second = (mixed >> 32) | 1
+        size = self.size
+        return ((first + index * second) % size for index in range(self.hashes))
+
+    def add(self, key):
+        """
+        Adds a key
+        :param key: INT key
+        :return: None
+        """
+
+        bits = self.bits
+        for position in self._positions(key):
+            bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        bits = self.bits
+        for position in self._positions(key):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+class MessageIdFilter(object):
+    """
+    Recently processed message ids, as two generations of Bloom filters
+
+    Ids are added to the current generation; once it is 'period' seconds old it becomes the previous
+    one and the former previous one is dropped, so only ids added over 'period' seconds ago are ever
+    forgotten and memory stays flat whatever the uptime. A negative answer is definitive for ids
+    added in the last 'period' seconds; a positive one has to be confirmed against the MESSAGES
+    table. A generation is sized for 'capacity' ids: past it the filter still never forgets an id,
+    but positives get more frequent and need more confirmations.
+    """
+
+    def __init__(self, capacity=1000000, error_rate=0.01, period=7 * 24 * 3600):
+        """
+        :param capacity: INT ids per generation the filters are sized for
+        :param error_rate: FLOAT false positive rate of each generation when full
+        :param period: INT seconds covered by each generation
+        """
+
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.period = period
+        self.database = None
+        self._current = BloomFilter(capacity, error_rate)
+        self._previous = BloomFilter(capacity, error_rate)
+        self._started = time.time()
+        self._lock = threading.Lock()
+
+        # Stats
+        self._negatives = 0
+        self._positives = 0
+        self._rotations = 0
+
+    def clear(self, database=None, now=None):
+        """
+        Forgets every id
+        :param database: STR database the filter mirrors from now on
+        :param now: FLOAT unix time the current generation starts at, now by default
+        :return: None
+        """
+
+        with self._lock:
+            self._current = BloomFilter(self.capacity, self.error_rate)
+            self._previous = BloomFilter(self.capacity, self.error_rate)
+            self._started = time.time() if now is None else now
+            self.database = database
+
+    def load(self, message_ids, database=None, now=None):
+        """
+        Replaces the filter content
+        Every id goes to the current generation, so ids must be at most 'period' seconds old
+        :param message_ids: ITERABLE of INT message ids
+        :param database: STR database the ids come from
+        :param now: FLOAT unix time the current generation starts at, now by default
+        :return: None
+        """
+
+        self.clear(now=now)
+        with self._lock:
+            for message_id in message_ids:
+                self._current.add(message_id)
+            self.database = database
+
+    def add(self, message_id, now=None):
+        """
+        Adds a processed message id, rotating generations when the current one is 'period' seconds old
+        :param message_id: INT message id
+        :param now: FLOAT unix time the id is added at, now by default
+        :return: None
+        """
+
+        now = time.time() if now is None else now
+        with self._lock:
+            if now - self._started >= self.period:
+                self._previous = self._current
+                self._current = BloomFilter(self.capacity, self.error_rate)
+                self._started = now
+                self._rotations += 1
+            self._current.add(message_id)
+
+    def __contains__(self, message_id):
+        current, previous = self._current, self._previous
+        if message_id in current or message_id in previous:
+            self._positives += 1
+            return True
+        self._negatives += 1
+        return False
+
+    def stats(self):
+        """
+        Filter counters
+        :return: DICT filter stats
+        """
+
+        with self._lock:
+            return {'ids': self._current.count + self._previous.count,
+                    'bytes': len(self._current.bits) + len(self._previous.bits),
+                    'negatives': self._negatives,
+                    'positives': self._positives,
+                    'rotations': self._rotations}
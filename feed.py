@@ -0,0 +1,190 @@
+# coding=utf-8
+# __author__ = 'Mario Romera Fernández'
+
+from itertools import islice
+
+import db
+import provider
+import writer
+
+
+READ_SIZE = 65536
+
+# Longest line parsed, longer lines are skipped while read and reported as bad messages
+MAX_LINE_SIZE = 1048576
+
+LINE_TOO_LONG = 'Bad message: line longer than %i bytes' % MAX_LINE_SIZE
+
+
+class LineSplitter(object):
+    """
+    Splits data into lines as it arrives, holding at most MAX_LINE_SIZE bytes of a line being read
+    Each part of a line is copied once, however small the chunks, and over-long lines are dropped
+    as they are read: they come out as None
+    """
+
+    __slots__ = ('max_size', 'parts', 'size')
+
+    def __init__(self, max_size=MAX_LINE_SIZE):
+        """
+        :param max_size: INT longest line, in bytes
+        """
+
+        self.max_size = max_size
+        self.parts = []
+        # Bytes of the line being read, None once it is too long
+        self.size = 0
+
+    def _append(self, part):
+        """
+        Adds data to the line being read
+        :param part: BYTES data without line terminator
+        :return: None
+        """
+
+        if self.size is not None and part:
+            self.size += len(part)
+            if self.size > self.max_size:
+                self.parts = []
+                self.size = None
+            else:
+                self.parts.append(part)
+
+    def _pop(self):
+        """
+        Ends the line being read
+        :return: BYTES line, or None if it was too long
+        """
+
+        line = None if self.size is None else b''.join(self.parts)
+        self.parts = []
+        self.size = 0
+        return line
+
+    def split(self, data):
+        """
+        Adds data and gets the lines it completes
+        :param data: BYTES data
+        :return: LIST of BYTES lines without line terminator, or None for over-long lines
+        """
+
+        lines = data.split(b'\n')
+        if len(lines) == 1:
+            self._append(data)
+            return []
+        self._append(lines[0])
+        lines[0] = self._pop()
+        self._append(lines.pop())
+        return [line if line is None or len(line) <= self.max_size else None for line in lines]
+
+    def finish(self):
+        """
+        Gets the last line, when the data has no final line terminator
+        :return: LIST with the BYTES last line or None if it was too long, empty if there is none
+        """
+
+        if self.size == 0:
+            return []
+        return [self._pop()]
+
+
+def iter_lines(stream, read_size=READ_SIZE):
+    """
+    Splits a binary stream into lines without reading it whole into memory
+    :param stream: binary file-like object
+    :param read_size: INT bytes read from the stream at a time
+    :return: GENERATOR of BYTES lines, without line terminator, or None for lines over MAX_LINE_SIZE
+    """
+
+    splitter = LineSplitter()
+    while True:
+        chunk = stream.read(read_size)
+        if not chunk:
+            break
+        for line in splitter.split(chunk):
+            yield line
+    for line in splitter.finish():
+        yield line
+
+
+def parse_line(line):
+    """
+    Parses and validates a newline-delimited JSON message
+    :param line: BYTES line, or None for a line over MAX_LINE_SIZE
+    :return: TUPLE (provider.Message or None, provider.MessageError or None), None for blank lines
+    """
+
+    if line is None:
+        return None, provider.MessageError(LINE_TOO_LONG)
+    line = line.strip()
+    if not line:
+        return None
+    try:
+        return provider.decode(line), None
+    except provider.MessageError as error:
+        return None, error
+
+
+def iter_messages(stream):
+    """
+    Parses newline-delimited JSON messages from a binary stream as they arrive
+    Blank lines are skipped
+    :param stream: binary file-like object
+    :return: GENERATOR of (INT line number, provider.Message or None, provider.MessageError or None)
+    """
+
+    for line_number, line in enumerate(iter_lines(stream), 1):
+        parsed = parse_line(line)
+        if parsed is not None:
+            yield (line_number,) + parsed
+
+
+def iter_batches(iterable, size):
+    """
+    Groups an iterable into lists of at most 'size' items
+    :param iterable: ITERABLE items
+    :param size: INT batch size
+    :return: GENERATOR of LIST items
+    """
+
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def ingest_parsed(batch):
+    """
+    Ingests a batch of parsed messages in one transaction, through the writer process if there is one
+    Messages that could not be parsed are reported without being sent
+    :param batch: LIST of (INT line number, provider.Message or None, provider.MessageError or None)
+    :return: LIST of DICT {'line', 'id', 'status', ['error']} per message, in batch order
+    """
+
+    results = []
+    messages = [message for _, message, error in batch if error is None]
+    processed = iter(writer.ingest_batch(messages) if messages else [])
+    for line_number, message, error in batch:
+        if error is None:
+            result = next(processed)
+        else:
+            result = {'id': error.message_id, 'status': db.ERROR, 'error': str(error)}
+        result['line'] = line_number
+        results.append(result)
+    return results
+
+
+def ingest_stream(stream, batch_size=None):
+    """
+    Ingests a newline-delimited JSON stream of provider messages, one transaction per batch
+    :param stream: binary file-like object
+    :param batch_size: INT messages per transaction, db.INGEST_BATCH_SIZE by default
+    :return: LIST of DICT {'line', 'id', 'status', ['error']} per message, in stream order
+    """
+
+    results = []
+    for batch in iter_batches(iter_messages(stream), batch_size or db.INGEST_BATCH_SIZE):
+        results.extend(ingest_parsed(batch))
+    return results
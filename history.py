@@ -0,0 +1,197 @@
+# coding=utf-8
+# __author__ = 'Mario Romera Fernández'
+
+import itertools
+import sys
+import zlib
+from array import array
+
+import statements
+
+# Recent odds changes are kept as ticks, one row each, in ODDS_TICKS. Roll-over moves the ticks of
+# a selection into ODDS_BLOCKS rows holding up to a block of ticks as two compressed columns:
+# millisecond time deltas and odds. Only the last block of a selection may be partial, later
+# roll-overs fill it up before starting a new one. Ticks are recorded by triggers on SELECTIONS, so every write
+# path records them in its own transaction, write-behind odds flushes included.
+
+# Time of a tick: unix time in seconds, millisecond precision
+_NOW = '''round((julianday('now') - 2440587.5) * 86400.0, 3)'''
+
+SELECT_ROLL_SELECTIONS = statements.register('select_roll_selections', '''
+    SELECT Ot_SELECTIONID FROM ODDS_TICKS
+    GROUP BY Ot_SELECTIONID
+    HAVING COUNT(*) >= ? OR MIN(Ot_TIME) < ?
+    LIMIT ?;''')
+SELECT_SELECTION_TICKS = statements.register('select_selection_ticks', '''
+    SELECT Ot_EVENTID, Ot_TIME, Ot_ODDS FROM ODDS_TICKS
+    WHERE Ot_SELECTIONID = ?
+    ORDER BY Ot_TIME, rowid;''')
+DELETE_SELECTION_TICKS = statements.register('delete_selection_ticks', '''
+    DELETE FROM ODDS_TICKS WHERE Ot_SELECTIONID = ?;''')
+INSERT_BLOCK = statements.register('insert_block', '''
+    INSERT INTO ODDS_BLOCKS VALUES(?, ?, ?, ?, ?, ?);''')
+SELECT_LAST_BLOCK = statements.register('select_last_block', '''
+    SELECT rowid, Ob_START, Ob_COUNT, Ob_DATA FROM ODDS_BLOCKS
+    WHERE Ob_SELECTIONID = ?
+    ORDER BY Ob_START DESC
+    LIMIT 1;''')
+DELETE_BLOCK = statements.register('delete_block', '''
+    DELETE FROM ODDS_BLOCKS WHERE rowid = ?;''')
+SELECT_EVENT_BLOCKS = statements.register('select_event_blocks', '''
+    SELECT Ob_SELECTIONID, Ob_START, Ob_COUNT, Ob_DATA FROM ODDS_BLOCKS
+    WHERE Ob_EVENTID = ? AND Ob_START < ? AND Ob_END >= ?
+    ORDER BY Ob_SELECTIONID, Ob_START;''')
+SELECT_EVENT_TICKS = statements.register('select_event_ticks', '''
+    SELECT Ot_SELECTIONID, Ot_TIME, Ot_ODDS FROM ODDS_TICKS
+    WHERE Ot_EVENTID = ? AND Ot_TIME >= ? AND Ot_TIME < ?
+    ORDER BY Ot_SELECTIONID, Ot_TIME, rowid;''')
+
+
+def create_tables(cur):
+    """
+    Creates the odds history tables, if missing
+    :param cur: sqlite3.Cursor
+    :return: None
+    """
+
+    cur.execute('''CREATE TABLE IF NOT EXISTS ODDS_TICKS
+                   (Ot_SELECTIONID INTEGER,
+                    Ot_EVENTID INTEGER,
+                    Ot_TIME FLOAT,
+                    Ot_ODDS FLOAT);''')
+    cur.execute('''CREATE TABLE IF NOT EXISTS ODDS_BLOCKS
+                   (Ob_SELECTIONID INTEGER,
+                    Ob_EVENTID INTEGER,
+                    Ob_START FLOAT,
+                    Ob_END FLOAT,
+                    Ob_COUNT INTEGER,
+                    Ob_DATA BLOB);''')
+
+
+def create_indexes(cur):
+    """
+    Creates the odds history indexes and the triggers recording odds changes, if missing
+    Triggers come last so that bulk loads of SELECTIONS do not record ticks
+    :param cur: sqlite3.Cursor
+    :return: None
+    """
+
+    cur.execute('''CREATE INDEX IF NOT EXISTS otev_in ON ODDS_TICKS(Ot_EVENTID, Ot_TIME);''')
+    cur.execute('''CREATE INDEX IF NOT EXISTS otse_in ON ODDS_TICKS(Ot_SELECTIONID, Ot_TIME);''')
+    cur.execute('''CREATE INDEX IF NOT EXISTS obev_in ON ODDS_BLOCKS(Ob_EVENTID, Ob_START);''')
+    cur.execute('''CREATE INDEX IF NOT EXISTS obse_in ON ODDS_BLOCKS(Ob_SELECTIONID, Ob_START);''')
+    cur.execute('''CREATE TRIGGER IF NOT EXISTS seod_insert_tr AFTER INSERT ON SELECTIONS
+                   BEGIN
+                       INSERT INTO ODDS_TICKS VALUES(NEW.Se_ID, NEW.Se_EVENTID, %s, NEW.Se_ODDS);
+                   END;''' % _NOW)
+    cur.execute('''CREATE TRIGGER IF NOT EXISTS seod_update_tr AFTER UPDATE OF Se_ODDS ON SELECTIONS
+                   WHEN OLD.Se_ODDS IS NOT NEW.Se_ODDS
+                   BEGIN
+                       INSERT INTO ODDS_TICKS VALUES(NEW.Se_ID, NEW.Se_EVENTID, %s, NEW.Se_ODDS);
+                   END;''' % _NOW)
+
+
+def drop_tables(cur):
+    """
+    Drops the odds history tables, their triggers go with SELECTIONS
+    :param cur: sqlite3.Cursor
+    :return: None
+    """
+
+    cur.execute('''DROP TABLE IF EXISTS ODDS_TICKS;''')
+    cur.execute('''DROP TABLE IF EXISTS ODDS_BLOCKS;''')
+
+
+def pack(times, odds):
+    """
+    Encodes a block of ticks: time deltas in milliseconds and odds as little-endian arrays, compressed
+    :param times: LIST of FLOAT unix times, ascending
+    :param odds: LIST of FLOAT odds
+    :return: BYTES block data
+    """
+
+    milliseconds = [int(round(value * 1000)) for value in times]
+    deltas = array('q', [later - earlier for earlier, later in zip(milliseconds, milliseconds[1:])])
+    values = array('d', odds)
+    if sys.byteorder == 'big':
+        deltas.byteswap()
+        values.byteswap()
+    return zlib.compress(deltas.tobytes() + values.tobytes())
+
+
+def unpack(start, count, data):
+    """
+    Decodes a block of ticks
+    :param start: FLOAT unix time of the first tick
+    :param count: INT number of ticks
+    :param data: BYTES block data
+    :return: TUPLE (LIST of FLOAT unix times, array of FLOAT odds)
+    """
+
+    raw = zlib.decompress(data)
+    deltas = array('q')
+    deltas.frombytes(raw[:(count - 1) * deltas.itemsize])
+    values = array('d')
+    values.frombytes(raw[(count - 1) * deltas.itemsize:])
+    if sys.byteorder == 'big':
+        deltas.byteswap()
+        values.byteswap()
+    first = int(round(start * 1000))
+    return [milliseconds / 1000.0 for milliseconds in itertools.accumulate(deltas, initial=first)], values
+
+
+def roll_over(cur, block_size, oldest, limit):
+    """
+    Moves the ticks of selections with a full block of them, or with ticks older than 'oldest',
+    into compressed blocks, filling up the last block of the selection first if it is partial
+    :param cur: sqlite3.Cursor
+    :param block_size: INT maximum number of ticks per block
+    :param oldest: FLOAT unix time, older ticks are rolled over even if their block is not full
+    :param limit: INT maximum number of selections rolled over
+    :return: INT number of selections rolled over
+    """
+
+    selections = SELECT_ROLL_SELECTIONS.fetchall(cur, (block_size, oldest, limit))
+    for selection_id, in selections:
+        ticks = SELECT_SELECTION_TICKS.fetchall(cur, (selection_id,))
+        event_id = ticks[0][0]
+        times = [tick_time for _, tick_time, _ in ticks]
+        odds = [value for _, _, value in ticks]
+        for rowid, start, count, data in SELECT_LAST_BLOCK.fetchall(cur, (selection_id,)):
+            if count < block_size:
+                block_times, block_odds = unpack(start, count, data)
+                times[:0] = block_times
+                odds[:0] = block_odds
+                DELETE_BLOCK.execute(cur, (rowid,))
+        for index in range(0, len(times), block_size):
+            block_times = times[index:index + block_size]
+            INSERT_BLOCK.execute(cur, (selection_id, event_id, block_times[0], block_times[-1], len(block_times),
+                                       pack(block_times, odds[index:index + block_size])))
+        DELETE_SELECTION_TICKS.execute(cur, (selection_id,))
+    return len(selections)
+
+
+def event_history(cur, event_id, start, end):
+    """
+    Gets the odds changes of the selections of an event in a time range
+    Only the blocks overlapping the range are decoded
+    :param cur: sqlite3.Cursor
+    :param event_id: INT event id
+    :param start: FLOAT unix time, included
+    :param end: FLOAT unix time, excluded
+    :return: DICT selection id -> TUPLE (LIST of FLOAT unix times, LIST of FLOAT odds), ascending
+    """
+
+    history = {}
+    for selection_id, block_start, count, data in SELECT_EVENT_BLOCKS.fetchall(cur, (event_id, end, start)):
+        times, odds = history.setdefault(selection_id, ([], []))
+        for tick_time, value in zip(*unpack(block_start, count, data)):
+            if start <= tick_time < end:
+                times.append(tick_time)
+                odds.append(value)
+    # Ticks are newer than the blocks of their selection
+    for selection_id, tick_time, value in SELECT_EVENT_TICKS.fetchall(cur, (event_id, start, end)):
+        times, odds = history.setdefault(selection_id, ([], []))
+        times.append(tick_time)
+        odds.append(value)
+    return history
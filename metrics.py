@@ -0,0 +1,380 @@
+# coding=utf-8
+# __author__ = 'Mario Romera Fernández'
+
+import bisect
+import collections
+import logging
+import sys
+import threading
+import time
+import traceback
+
+
+# Latency buckets in seconds, from a cached read to a slow bulk ingest
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Slow request sampler settings, off unless SLOW_REQUEST_SECONDS is set
+# Requests running for longer than SLOW_REQUEST_SECONDS get their stack sampled every
+# SAMPLE_INTERVAL seconds and the SLOW_REQUEST_STACKS most frequent stacks are logged when they end
+SLOW_REQUEST_SECONDS = None
+SAMPLE_INTERVAL = 0.005
+SLOW_REQUEST_STACKS = 5
+SLOW_REQUEST_DEPTH = 30
+
+logger = logging.getLogger(__name__)
+
+
+def _escape(value):
+    """
+    Escapes a label value for the text exposition format
+    :param value: label value
+    :return: STR escaped value
+    """
+
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=''):
+    """
+    Formats label pairs
+    :param names: TUPLE of STR label names
+    :param values: TUPLE of label values
+    :param extra: STR label pair appended to the others, e.g. 'le="0.1"'
+    :return: STR labels with braces or empty
+    """
+
+    pairs = ['%s="%s"' % (name, _escape(value)) for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{%s}' % ','.join(pairs) if pairs else ''
+
+
+def _number(value):
+    """
+    Formats a sample value
+    :param value: INT or FLOAT
+    :return: STR value
+    """
+
+    if isinstance(value, float):
+        if value == float('inf'):
+            return '+Inf'
+        return repr(value)
+    return str(value)
+
+
+class Counter(object):
+    """
+    Monotonic counter, one value per combination of label values
+    """
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        """
+        :param name: STR metric name, without the _total suffix
+        :param documentation: STR help text
+        :param labels: TUPLE of STR label names
+        """
+
+        self.name = name
+        self.family = name + '_total'
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, labels=()):
+        """
+        Adds to the counter
+        :param amount: INT or FLOAT amount, not negative
+        :param labels: TUPLE of label values, in the order of the label names
+        :return: None
+        """
+
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, labels=()):
+        """
+        :param labels: TUPLE of label values
+        :return: INT or FLOAT current value
+        """
+
+        with self._lock:
+            return self._values.get(labels, 0)
+
+    def samples(self):
+        """
+        :return: LIST of STR exposition lines
+        """
+
+        with self._lock:
+            values = sorted(self._values.items(), key=lambda item: tuple(map(str, item[0])))
+        return ['%s%s %s' % (self.family, _labels(self.labels, labels), _number(value))
+                for labels, value in values]
+
+
+class Histogram(object):
+    """
+    Distribution of durations in fixed buckets, one per combination of label values
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=BUCKETS):
+        """
+        :param name: STR metric name
+        :param documentation: STR help text
+        :param labels: TUPLE of STR label names
+        :param buckets: TUPLE of FLOAT bucket upper bounds, ascending
+        """
+
+        self.name = name
+        self.family = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, labels=()):
+        """
+        Adds an observation
+        :param value: FLOAT observed value, e.g. seconds
+        :param labels: TUPLE of label values, in the order of the label names
+        :return: None
+        """
+
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                # Counts per bucket, +Inf last, then sum
+                state = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            state[index] += 1
+            state[-1] += value
+
+    def count(self, labels=()):
+        """
+        :param labels: TUPLE of label values
+        :return: INT number of observations
+        """
+
+        with self._lock:
+            state = self._values.get(labels)
+            return sum(state[:-1]) if state else 0
+
+    def samples(self):
+        """
+        :return: LIST of STR exposition lines, with cumulative buckets
+        """
+
+        with self._lock:
+            values = sorted(((labels, list(state)) for labels, state in self._values.items()),
+                            key=lambda item: tuple(map(str, item[0])))
+        lines = []
+        for labels, state in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), state[:-1]):
+                cumulative += count
+                lines.append('%s_bucket%s %i' % (self.name, _labels(self.labels, labels, 'le="%s"' % _number(bound)),
+                                                 cumulative))
+            lines.append('%s_sum%s %s' % (self.name, _labels(self.labels, labels), _number(state[-1])))
+            lines.append('%s_count%s %i' % (self.name, _labels(self.labels, labels), cumulative))
+        return lines
+
+
+class Gauge(object):
+    """
+    Value read when metrics are collected, e.g. the size of a cache
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, function):
+        """
+        :param name: STR metric name
+        :param documentation: STR help text
+        :param function: FUNCTION returning the current INT or FLOAT value
+        """
+
+        self.name = name
+        self.family = name
+        self.documentation = documentation
+        self.function = function
+
+    def samples(self):
+        """
+        :return: LIST of STR exposition lines
+        """
+
+        return ['%s %s' % (self.name, _number(self.function()))]
+
+
+class Registry(object):
+    """
+    Metrics exposed by the API, in the Prometheus text format
+    """
+
+    def __init__(self):
+        self._metrics = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        """
+        Registers a metric
+        :param metric: Counter, Histogram or Gauge
+        :return: the metric
+        """
+
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError('Metric %r already registered' % metric.name)
+            self._metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        """
+        Renders every metric
+        :return: STR text exposition format version 0.0.4
+        """
+
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append('# HELP %s %s' % (metric.family, metric.documentation.replace('\n', ' ')))
+            lines.append('# TYPE %s %s' % (metric.family, metric.kind))
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+# Content type of REGISTRY.render()
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def counter(name, documentation, labels=()):
+    """
+    Creates and registers a counter
+    :param name: STR metric name, without the _total suffix
+    :param documentation: STR help text
+    :param labels: TUPLE of STR label names
+    :return: Counter
+    """
+
+    return REGISTRY.register(Counter(name, documentation, labels))
+
+
+def histogram(name, documentation, labels=(), buckets=BUCKETS):
+    """
+    Creates and registers a histogram
+    :param name: STR metric name
+    :param documentation: STR help text
+    :param labels: TUPLE of STR label names
+    :param buckets: TUPLE of FLOAT bucket upper bounds
+    :return: Histogram
+    """
+
+    return REGISTRY.register(Histogram(name, documentation, labels, buckets))
+
+
+def gauge(name, documentation, function):
+    """
+    Creates and registers a gauge
+    :param name: STR metric name
+    :param documentation: STR help text
+    :param function: FUNCTION returning the current value
+    :return: Gauge
+    """
+
+    return REGISTRY.register(Gauge(name, documentation, function))
+
+
+REQUEST_SECONDS = histogram('betbright_request_seconds', 'Time spent handling requests', ('route',))
+DB_SECONDS = histogram('betbright_db_operation_seconds',
+                       'Time spent in database operations: connect, acquire, begin, execute, fetch and commit',
+                       ('operation', 'statement'))
+SLOW_REQUESTS = counter('betbright_slow_requests', 'Requests slower than the slow request threshold', ('route',))
+
+
+class StackSampler(object):
+    """
+    Sampling profiler for slow requests
+
+    Requests register the thread running them. A daemon thread samples the stacks of requests
+    that have been running for longer than the threshold, and when such a request ends its most
+    frequent stacks are logged. Requests under the threshold cost a dict insert and delete.
+    """
+
+    def __init__(self):
+        self._active = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def begin(self):
+        """
+        Registers the request running in the current thread
+        :return: None
+        """
+
+        if SLOW_REQUEST_SECONDS is None:
+            return
+        with self._lock:
+            self._active[threading.get_ident()] = (time.perf_counter(), collections.Counter())
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+                self._thread.start()
+
+    def end(self, route):
+        """
+        Unregisters the request running in the current thread, logging its hot stacks if it was slow
+        :param route: STR route name
+        :return: None
+        """
+
+        with self._lock:
+            state = self._active.pop(threading.get_ident(), None)
+        if state is None:
+            return
+        start, stacks = state
+        elapsed = time.perf_counter() - start
+        if SLOW_REQUEST_SECONDS is None or elapsed < SLOW_REQUEST_SECONDS:
+            return
+        SLOW_REQUESTS.inc(labels=(route,))
+        total = sum(stacks.values())
+        logger.warning('Slow request %s: %.3f seconds, %i stack samples%s', route, elapsed, total,
+                       ''.join('\n--- %i samples (%.0f%%)\n%s' % (count, 100.0 * count / total, stack)
+                               for stack, count in stacks.most_common(SLOW_REQUEST_STACKS)))
+
+    def _run(self):
+        """
+        Samples the stacks of slow requests until the process exits
+        :return: None
+        """
+
+        while True:
+            time.sleep(SAMPLE_INTERVAL)
+            threshold = SLOW_REQUEST_SECONDS
+            if threshold is None:
+                continue
+            now = time.perf_counter()
+            with self._lock:
+                slow = [thread_id for thread_id, (start, _) in self._active.items() if now - start >= threshold]
+            if not slow:
+                continue
+            frames = sys._current_frames()
+            stacks = [(thread_id, ''.join(traceback.format_stack(frames[thread_id], SLOW_REQUEST_DEPTH)))
+                      for thread_id in slow if thread_id in frames]
+            del frames
+            with self._lock:
+                # Requests that ended meanwhile are not sampled
+                for thread_id, stack in stacks:
+                    state = self._active.get(thread_id)
+                    if state is not None:
+                        state[1][stack] += 1
+
+
+SAMPLER = StackSampler()
@@ -0,0 +1,216 @@
+# coding=utf-8
+# __author__ = 'Mario Romera Fernández'
+
+import threading
+from array import array
+
+
+class OddsBook(object):
+    """
+    In-memory odds of every selection, event -> market -> selection -> odds
+
+    Odds and their owner market and event ids live in flat arrays indexed by a slot, with a dict
+    from selection id to slot, so applying an odds update is a dict lookup and an array write.
+    Slots of removed events are reused. Updates can be marked dirty to be written to the
+    database later in batches (write-behind).
+    """
+
+    def __init__(self):
+        self.database = None
+        self._odds = array('d')
+        self._markets = array('q')
+        self._events = array('q')
+        self._slots = {}
+        self._selections = []
+        self._by_event = {}
+        self._free = []
+        self._dirty = set()
+        self._lock = threading.Lock()
+
+        # Stats
+        self._updates = 0
+        self._misses = 0
+
+    def __len__(self):
+        return len(self._slots)
+
+    def clear(self, database=None):
+        """
+        Empties the book
+        :param database: STR database the book mirrors from now on
+        :return: None
+        """
+
+        with self._lock:
+            self.database = database
+            del self._odds[:]
+            del self._markets[:]
+            del self._events[:]
+            self._slots.clear()
+            del self._selections[:]
+            self._by_event.clear()
+            del self._free[:]
+            self._dirty.clear()
+
+    def load(self, rows, database=None):
+        """
+        Replaces the book content
+        :param rows: ITERABLE of (INT selection id, INT market id, INT event id, FLOAT odds)
+        :param database: STR database the rows come from
+        :return: None
+        """
+
+        self.clear()
+        with self._lock:
+            for selection_id, market_id, event_id, odds in rows:
+                self._add(selection_id, market_id, event_id, odds)
+            self.database = database
+
+    def _add(self, selection_id, market_id, event_id, odds):
+        """
+        Adds or replaces a selection. Lock must be held
+        :param selection_id: INT selection id
+        :param market_id: INT market id
+        :param event_id: INT event id
+        :param odds: FLOAT odds
+        :return: None
+        """
+
+        slot = self._slots.get(selection_id)
+        if slot is not None:
+            self._by_event[self._events[slot]].remove(slot)
+            self._odds[slot] = odds
+            self._markets[slot] = market_id
+            self._events[slot] = event_id
+        elif self._free:
+            slot = self._free.pop()
+            self._odds[slot] = odds
+            self._markets[slot] = market_id
+            self._events[slot] = event_id
+            self._selections[slot] = selection_id
+        else:
+            slot = len(self._odds)
+            self._odds.append(odds)
+            self._markets.append(market_id)
+            self._events.append(event_id)
+            self._selections.append(selection_id)
+        self._slots[selection_id] = slot
+        self._by_event.setdefault(event_id, []).append(slot)
+
+    def add_event(self, event_id, selections):
+        """
+        Adds the selections of a new event
+        :param event_id: INT event id
+        :param selections: ITERABLE of (INT market id, INT selection id, FLOAT odds)
+        :return: None
+        """
+
+        with self._lock:
+            for market_id, selection_id, odds in selections:
+                self._add(selection_id, market_id, event_id, odds)
+
+    def remove_event(self, event_id):
+        """
+        Removes every selection of an event, pending writes included
+        :param event_id: INT event id
+        :return: INT number of selections removed
+        """
+
+        with self._lock:
+            slots = self._by_event.pop(event_id, [])
+            for slot in slots:
+                del self._slots[self._selections[slot]]
+                self._selections[slot] = None
+                self._dirty.discard(slot)
+                self._free.append(slot)
+            return len(slots)
+
+    def apply(self, event_id, odds, dirty=False):
+        """
+        Applies odds updates of an event
+        Selections not in the book or belonging to another market or event are ignored, as the
+        database update would ignore them, and so are selections whose odds did not change
+        :param event_id: INT event id
+        :param odds: ITERABLE of (INT market id, INT selection id, FLOAT odds)
+        :param dirty: BOOLEAN mark updated selections to be written by take_dirty
+        :return: TUPLE (LIST of (INT market id, INT selection id, FLOAT odds) updated, INT selections ignored
+                 as not in the book)
+        """
+
+        updated = []
+        unknown = 0
+        with self._lock:
+            for market_id, selection_id, value in odds:
+                slot = self._slots.get(selection_id)
+                if slot is None or self._markets[slot] != market_id or self._events[slot] != event_id:
+                    unknown += 1
+                    continue
+                if self._odds[slot] == value:
+                    continue
+                self._odds[slot] = value
+                if dirty:
+                    self._dirty.add(slot)
+                updated.append((market_id, selection_id, value))
+            self._updates += len(updated)
+            self._misses += unknown
+        return updated, unknown
+
+    def get(self, selection_id, default=None):
+        """
+        Gets the odds of a selection
+        :param selection_id: INT selection id
+        :param default: value returned if the selection is not in the book
+        :return: FLOAT odds
+        """
+
+        slot = self._slots.get(selection_id)
+        return default if slot is None else self._odds[slot]
+
+    def event_odds(self, event_id):
+        """
+        Gets the odds of every selection of an event
+        :param event_id: INT event id
+        :return: DICT selection id -> FLOAT odds
+        """
+
+        with self._lock:
+            return {self._selections[slot]: self._odds[slot] for slot in self._by_event.get(event_id, ())}
+
+    def take_dirty(self):
+        """
+        Gets and clears the selections updated with dirty=True since the last call
+        :return: LIST of (FLOAT odds, INT selection id, INT market id, INT event id)
+        """
+
+        with self._lock:
+            dirty = [(self._odds[slot], self._selections[slot], self._markets[slot], self._events[slot])
+                     for slot in self._dirty]
+            self._dirty.clear()
+        return dirty
+
+    def mark_dirty(self, selection_ids):
+        """
+        Marks selections to be written again, after a failed write
+        :param selection_ids: ITERABLE of INT selection id
+        :return: None
+        """
+
+        with self._lock:
+            for selection_id in selection_ids:
+                slot = self._slots.get(selection_id)
+                if slot is not None:
+                    self._dirty.add(slot)
+
+    def stats(self):
+        """
+        Odds book counters
+        :return: DICT odds book stats
+        """
+
+        with self._lock:
+            return {'selections': len(self._slots),
+                    'events': len(self._by_event),
+                    'slots': len(self._odds),
+                    'dirty': len(self._dirty),
+                    'updates': self._updates,
+                    'misses': self._misses}
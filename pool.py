@@ -0,0 +1,164 @@
+# coding=utf-8
+# __author__ = 'Mario Romera Fernández'
+
+import sqlite3
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import metrics
+
+
+DEFAULT_PRAGMAS = {'journal_mode': 'WAL',
+                   'synchronous': 'NORMAL',
+                   'mmap_size': 268435456,
+                   'cache_size': -16384,
+                   'temp_store': 'MEMORY'}
+
+
+class ConnectionPool(object):
+    """
+    Pool of long-lived sqlite3 connections shared between threads
+
+    Connections are opened lazily up to 'size', tuned with 'pragmas' once when opened and
+    reused afterwards so connection setup, schema parsing and the sqlite3 statement cache
+    survive between calls. A thread asking for a connection while all of them are checked
+    out waits until one is returned.
+    """
+
+    def __init__(self, database, size=5, pragmas=None, cached_statements=256, timeout=30.0):
+        """
+        :param database: STR sqlite3 database path
+        :param size: INT maximum number of open connections
+        :param pragmas: DICT pragma name -> value applied to every new connection
+        :param cached_statements: INT size of the per-connection prepared statement cache
+        :param timeout: FLOAT seconds to wait for a free connection or a database lock
+        """
+
+        self.database = database
+        self.size = size
+        self.pragmas = DEFAULT_PRAGMAS if pragmas is None else pragmas
+        self.cached_statements = cached_statements
+        self.timeout = timeout
+
+        self._idle = deque()
+        self._opened = 0
+        self._closed = False
+        self._cond = threading.Condition(threading.Lock())
+
+        # Stats
+        self._checkouts = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._connects = 0
+
+    def _connect(self):
+        """
+        Opens a new connection and applies the configured pragmas
+        :return: sqlite3.Connection
+        """
+
+        start = time.perf_counter()
+        conn = sqlite3.connect(self.database,
+                               timeout=self.timeout,
+                               check_same_thread=False,
+                               cached_statements=self.cached_statements)
+        for name, value in self.pragmas.items():
+            conn.execute('''PRAGMA %s = %s;''' % (name, value))
+        metrics.DB_SECONDS.observe(time.perf_counter() - start, ('connect', ''))
+        return conn
+
+    def acquire(self):
+        """
+        Checks out a connection, opening a new one if the pool is not full or waiting for one
+        to be released otherwise
+        :return: sqlite3.Connection
+        """
+
+        with self._cond:
+            if self._closed:
+                raise sqlite3.ProgrammingError('Connection pool is closed')
+            self._checkouts += 1
+            if not self._idle and self._opened >= self.size:
+                self._waits += 1
+                start = time.perf_counter()
+                if not self._cond.wait_for(lambda: self._idle or self._closed, self.timeout):
+                    raise sqlite3.OperationalError('Timed out waiting for a pooled connection')
+                waited = time.perf_counter() - start
+                self._wait_time += waited
+                metrics.DB_SECONDS.observe(waited, ('acquire', ''))
+                if self._closed:
+                    raise sqlite3.ProgrammingError('Connection pool is closed')
+            if self._idle:
+                return self._idle.pop()
+            self._opened += 1
+
+        try:
+            conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._opened -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._connects += 1
+        return conn
+
+    def release(self, conn):
+        """
+        Returns a connection to the pool, rolling back any transaction left open
+        :param conn: sqlite3.Connection previously returned by acquire
+        :return: None
+        """
+
+        if conn.in_transaction:
+            conn.rollback()
+        with self._cond:
+            if self._closed:
+                self._opened -= 1
+                conn.close()
+                return
+            self._idle.append(conn)
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """
+        Context manager checking out a connection and releasing it afterwards
+        :return: sqlite3.Connection
+        """
+
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        """
+        Closes idle connections; checked out ones are closed when released
+        :return: None
+        """
+
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                self._idle.pop().close()
+                self._opened -= 1
+            self._cond.notify_all()
+
+    def stats(self):
+        """
+        Pool usage counters
+        :return: DICT pool stats
+        """
+
+        with self._cond:
+            return {'size': self.size,
+                    'open': self._opened,
+                    'idle': len(self._idle),
+                    'connects': self._connects,
+                    'checkouts': self._checkouts,
+                    'waits': self._waits,
+                    'wait_time': self._wait_time}
@@ -0,0 +1,373 @@
+# coding=utf-8
+# __author__ = 'Mario Romera Fernández'
+
+import datetime
+import functools
+import math
+
+import serialize
+
+# Provider messages are decoded and checked against the message schema before any database work,
+# into records with fixed attributes. Bad messages are rejected with the path of the first bad field:
+#     {"id": INT, "message_type": "NewEvent" | "UpdateOdds",
+#      "event": {"id": INT, "name": STR, "startTime": "%Y-%m-%d %H:%M:%S",
+#                "sport": {"id": INT, "name": STR},
+#                "markets": [{"id": INT, "name": STR,
+#                             "selections": [{"id": INT, "name": STR, "odds": NUMBER}]}]}}
+# 'UpdateOdds' messages only need the ids of the event, markets and selections, and the odds.
+
+START_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Distinct start times kept parsed, and formatted by db.format_start_time: many events share the same start time
+START_TIME_CACHE_SIZE = 4096
+
+NEW_EVENT = 'NewEvent'
+UPDATE_ODDS = 'UpdateOdds'
+
+# Ids are stored as SQLite INTEGER
+MIN_INTEGER = -2 ** 63
+MAX_INTEGER = 2 ** 63 - 1
+
+
+class MessageError(ValueError):
+    """
+    Raised for provider messages that do not follow the message schema
+    """
+
+    # INT id of the message, if it could be read
+    message_id = None
+
+
+class MessageTypeError(MessageError):
+    """
+    Raised for messages with an unknown 'message_type'
+    """
+
+
+# Records pickle as their constructor arguments, which keeps them small on writer connections
+class Sport(object):
+    """
+    Sport of a 'NewEvent' event
+    """
+
+    __slots__ = ('id', 'name')
+
+    def __init__(self, sport_id, name):
+        self.id = sport_id
+        self.name = name
+
+    def __reduce__(self):
+        return Sport, (self.id, self.name)
+
+
+class Selection(object):
+    """
+    Selection of a market, with its odds
+    """
+
+    __slots__ = ('id', 'name', 'odds')
+
+    def __init__(self, selection_id, name, odds):
+        self.id = selection_id
+        self.name = name
+        self.odds = odds
+
+    def __reduce__(self):
+        return Selection, (self.id, self.name, self.odds)
+
+
+class Market(object):
+    """
+    Market of an event, with its selections
+    """
+
+    __slots__ = ('id', 'name', 'selections')
+
+    def __init__(self, market_id, name, selections):
+        self.id = market_id
+        self.name = name
+        self.selections = selections
+
+    def __reduce__(self):
+        return Market, (self.id, self.name, self.selections)
+
+
+class Event(object):
+    """
+    Event of a message; 'UpdateOdds' events have no name, start time or sport, and their markets
+    and selections no names
+    """
+
+    __slots__ = ('id', 'name', 'start_time', 'sport', 'markets')
+
+    def __init__(self, event_id, name, start_time, sport, markets):
+        """
+        :param event_id: INT event id
+        :param name: STR event name or None
+        :param start_time: INT start timestamp or None
+        :param sport: Sport or None
+        :param markets: LIST of Market
+        """
+
+        self.id = event_id
+        self.name = name
+        self.start_time = start_time
+        self.sport = sport
+        self.markets = markets
+
+    def __reduce__(self):
+        return Event, (self.id, self.name, self.start_time, self.sport, self.markets)
+
+    def odds(self):
+        """
+        Gets the odds of every selection
+        :return: LIST of (INT market id, INT selection id, FLOAT odds)
+        """
+
+        return [(market.id, selection.id, selection.odds) for market in self.markets for selection in market.selections]
+
+
+class Message(object):
+    """
+    Provider message, validated
+    """
+
+    __slots__ = ('id', 'message_type', 'event')
+
+    def __init__(self, message_id, message_type, event):
+        """
+        :param message_id: INT message id
+        :param message_type: STR NEW_EVENT or UPDATE_ODDS
+        :param event: Event
+        """
+
+        self.id = message_id
+        self.message_type = message_type
+        self.event = event
+
+    def __reduce__(self):
+        return Message, (self.id, self.message_type, self.event)
+
+
+@functools.lru_cache(maxsize=START_TIME_CACHE_SIZE)
+def parse_start_time(value):
+    """
+    Parses a start time as given by providers, cached since strptime is slow
+    :param value: STR time as START_TIME_FORMAT
+    :return: INT timestamp
+    :raises ValueError: if the time is not as START_TIME_FORMAT
+    """
+
+    return int(datetime.datetime.strptime(value, START_TIME_FORMAT).timestamp())
+
+
+class _FieldError(Exception):
+    """
+    Bad field of a message, its path is completed while the error goes up
+    """
+
+    def __init__(self, key, expected):
+        """
+        :param key: STR field name or None for the object itself
+        :param expected: STR expected JSON type
+        """
+
+        Exception.__init__(self, expected)
+        self.path = [] if key is None else [key]
+        self.expected = expected
+
+    def __str__(self):
+        path = ''.join('[%i]' % part if isinstance(part, int) else '.' + part for part in self.path)
+        return '%s: %s expected' % (path.lstrip('.'), self.expected)
+
+
+def _integer(data, key):
+    """
+    Gets an integer field
+    :param data: DICT JSON object
+    :param key: STR field name
+    :return: INT value
+    """
+
+    value = data.get(key)
+    if type(value) is not int or not MIN_INTEGER <= value <= MAX_INTEGER:
+        raise _FieldError(key, 'integer')
+    return value
+
+
+def _string(data, key):
+    """
+    Gets a string field
+    :param data: DICT JSON object
+    :param key: STR field name
+    :return: STR value
+    """
+
+    value = data.get(key)
+    if type(value) is not str:
+        raise _FieldError(key, 'string')
+    return value
+
+
+def _object(data, key=None):
+    """
+    Gets an object field
+    :param data: DICT JSON object, or the object itself without key
+    :param key: STR field name
+    :return: DICT value
+    """
+
+    value = data if key is None else data.get(key)
+    if type(value) is not dict:
+        raise _FieldError(key, 'object')
+    return value
+
+
+def _list(data, key):
+    """
+    Gets a list field
+    :param data: DICT JSON object
+    :param key: STR field name
+    :return: LIST value
+    """
+
+    value = data.get(key)
+    if type(value) is not list:
+        raise _FieldError(key, 'list')
+    return value
+
+
+def _odds(data):
+    """
+    Gets the odds of a selection
+    :param data: DICT selection JSON object
+    :return: FLOAT odds
+    """
+
+    value = data.get('odds')
+    if type(value) is float:
+        if math.isfinite(value):
+            return value
+    elif type(value) is int:
+        return float(value)
+    raise _FieldError('odds', 'number')
+
+
+def _selections(data, named):
+    """
+    Decodes the selections of a market
+    Valid selections are checked inline, the field helpers are only called to report a bad one
+    :param data: DICT market JSON object
+    :param named: BOOLEAN decode selection names
+    :return: LIST of Selection
+    """
+
+    selections = []
+    for index, selection in enumerate(_list(data, 'selections')):
+        if type(selection) is dict:
+            selection_id = selection.get('id')
+            name = selection.get('name') if named else None
+            odds = selection.get('odds')
+            if (type(selection_id) is int and MIN_INTEGER <= selection_id <= MAX_INTEGER
+                    and (type(name) is str or not named) and type(odds) is float and math.isfinite(odds)):
+                selections.append(Selection(selection_id, name, odds))
+                continue
+        try:
+            selection = _object(selection)
+            selections.append(Selection(_integer(selection, 'id'), _string(selection, 'name') if named else None,
+                                        _odds(selection)))
+        except _FieldError as error:
+            error.path[:0] = ['selections', index]
+            raise
+    return selections
+
+
+def _markets(data, named):
+    """
+    Decodes the markets of an event
+    :param data: DICT event JSON object
+    :param named: BOOLEAN decode market and selection names
+    :return: LIST of Market
+    """
+
+    markets = []
+    for index, market in enumerate(_list(data, 'markets')):
+        try:
+            market = _object(market)
+            markets.append(Market(_integer(market, 'id'), _string(market, 'name') if named else None,
+                                  _selections(market, named)))
+        except _FieldError as error:
+            error.path[:0] = ['markets', index]
+            raise
+    return markets
+
+
+def _event(data, message_type):
+    """
+    Decodes the event of a message
+    :param data: DICT message JSON object
+    :param message_type: STR NEW_EVENT or UPDATE_ODDS
+    :return: Event
+    """
+
+    event = _object(data, 'event')
+    try:
+        event_id = _integer(event, 'id')
+        if message_type == UPDATE_ODDS:
+            return Event(event_id, None, None, None, _markets(event, False))
+
+        try:
+            start_time = parse_start_time(_string(event, 'startTime'))
+        except ValueError:
+            raise _FieldError('startTime', 'time as %s' % START_TIME_FORMAT)
+        sport = _object(event, 'sport')
+        try:
+            sport = Sport(_integer(sport, 'id'), _string(sport, 'name'))
+        except _FieldError as error:
+            error.path.insert(0, 'sport')
+            raise
+        return Event(event_id, _string(event, 'name'), start_time, sport, _markets(event, True))
+    except _FieldError as error:
+        error.path.insert(0, 'event')
+        raise
+
+
+def validate(data):
+    """
+    Checks a provider message against the message schema and decodes it
+    :param data: DICT message as parsed from JSON, or Message already decoded
+    :return: Message
+    :raises MessageTypeError: if the message type is unknown
+    :raises MessageError: if any other field is missing or has the wrong type
+    """
+
+    if type(data) is Message:
+        return data
+    if type(data) is not dict:
+        raise MessageError('Bad message: object expected')
+    message_type = data.get('message_type')
+    if message_type != NEW_EVENT and message_type != UPDATE_ODDS:
+        error = MessageTypeError('Bad message_type: %r' % (message_type,))
+    else:
+        try:
+            return Message(_integer(data, 'id'), message_type, _event(data, message_type))
+        except _FieldError as field_error:
+            error = MessageError('Bad message: %s' % field_error)
+    if type(data.get('id')) is int:
+        error.message_id = data['id']
+    raise error
+
+
+def decode(data):
+    """
+    Parses and validates a provider message
+    :param data: BYTES or STR JSON message
+    :return: Message
+    :raises MessageError: if the message is not valid JSON or does not follow the message schema
+    """
+
+    try:
+        parsed = serialize.loads(data)
+    except ValueError as error:
+        raise MessageError('Bad JSON: %s' % error)
+    return validate(parsed)
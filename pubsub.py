@@ -0,0 +1,278 @@
+# coding=utf-8
+# __author__ = 'Mario Romera Fernández'
+
+import asyncio
+import threading
+from collections import OrderedDict
+
+import serialize
+
+
+# Seconds between keep-alive comments on idle server-sent event streams
+HEARTBEAT = 15.0
+
+
+class Subscription(object):
+    """
+    Odds deltas of one event pending delivery to one consumer
+
+    Deltas are coalesced by selection, so a slow consumer gets the latest odds of each selection
+    instead of every intermediate price and its backlog is bounded by the size of the event.
+    A consumer whose backlog still goes over 'max_pending' is closed and has to subscribe again.
+    Consumers wait with wait() from a thread or with wait_async() from an event loop.
+    """
+
+    def __init__(self, broker, event_id, max_pending):
+        """
+        :param broker: Broker the subscription belongs to
+        :param event_id: INT event id
+        :param max_pending: INT maximum number of pending selections
+        """
+
+        self.event_id = event_id
+        self.max_pending = max_pending
+        self.closed = False
+        self.overflowed = False
+        self._broker = broker
+        self._pending = OrderedDict()
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._loop = None
+        self._async_ready = None
+
+        # Stats
+        self.published = 0
+        self.coalesced = 0
+
+    def _put(self, deltas):
+        """
+        Adds deltas to the backlog. Called by the broker from the committing thread
+        :param deltas: LIST of DICT {'market', 'selection', 'odds'}
+        :return: BOOLEAN False if the subscription overflowed
+        """
+
+        with self._lock:
+            for delta in deltas:
+                if delta['selection'] in self._pending:
+                    self.coalesced += 1
+                    del self._pending[delta['selection']]
+                self._pending[delta['selection']] = delta
+            self.published += len(deltas)
+            if len(self._pending) > self.max_pending:
+                self.overflowed = True
+                self.closed = True
+                self._pending.clear()
+        self._wake()
+        return not self.overflowed
+
+    def _wake(self):
+        """
+        Wakes the consumer up
+        :return: None
+        """
+
+        self._ready.set()
+        if self._loop is not None:
+            try:
+                self._loop.call_soon_threadsafe(self._async_ready.set)
+            except RuntimeError:
+                # Event loop already closed
+                pass
+
+    def take(self):
+        """
+        Gets and clears the pending deltas, oldest first
+        :return: LIST of DICT {'market', 'selection', 'odds'}
+        """
+
+        with self._lock:
+            deltas = list(self._pending.values())
+            self._pending.clear()
+            self._ready.clear()
+            if self._async_ready is not None:
+                self._async_ready.clear()
+        return deltas
+
+    def wait(self, timeout=None):
+        """
+        Waits for pending deltas from a thread
+        :param timeout: FLOAT seconds or None to wait forever
+        :return: LIST of DICT deltas, empty on timeout or if the subscription is closed
+        """
+
+        if not self.closed:
+            self._ready.wait(timeout)
+        return self.take()
+
+    async def wait_async(self, timeout=None):
+        """
+        Waits for pending deltas from an event loop
+        :param timeout: FLOAT seconds or None to wait forever
+        :return: LIST of DICT deltas, empty on timeout or if the subscription is closed
+        """
+
+        if self._async_ready is None:
+            self._async_ready = asyncio.Event()
+            self._loop = asyncio.get_running_loop()
+            if self._pending or self.closed:
+                self._async_ready.set()
+        if not self.closed:
+            try:
+                await asyncio.wait_for(self._async_ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.take()
+
+    def close(self):
+        """
+        Unsubscribes
+        :return: None
+        """
+
+        self.closed = True
+        self._broker.unsubscribe(self)
+        self._wake()
+
+
+class Broker(object):
+    """
+    Fan-out of odds deltas to the subscriptions of each event
+    """
+
+    def __init__(self, max_pending=10000, max_subscriptions=10000):
+        """
+        :param max_pending: INT maximum number of pending selections per subscription
+        :param max_subscriptions: INT maximum number of subscriptions over every event
+        """
+
+        self.max_pending = max_pending
+        self.max_subscriptions = max_subscriptions
+        self._subscriptions = {}
+        self._count = 0
+        self._lock = threading.Lock()
+
+        # Stats
+        self._published = 0
+        self._overflows = 0
+
+    def subscribe(self, event_id):
+        """
+        Subscribes to the odds deltas of an event
+        :param event_id: INT event id
+        :return: Subscription or None if there are too many subscriptions
+        """
+
+        with self._lock:
+            if self._count >= self.max_subscriptions:
+                return None
+            subscription = Subscription(self, event_id, self.max_pending)
+            self._subscriptions.setdefault(event_id, set()).add(subscription)
+            self._count += 1
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """
+        Removes a subscription
+        :param subscription: Subscription
+        :return: None
+        """
+
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.event_id)
+            if subscriptions is None or subscription not in subscriptions:
+                return
+            subscriptions.discard(subscription)
+            self._count -= 1
+            if not subscriptions:
+                del self._subscriptions[subscription.event_id]
+
+    def publish(self, event_id, deltas):
+        """
+        Delivers odds deltas of an event to its subscriptions
+        :param event_id: INT event id
+        :param deltas: LIST of DICT {'market', 'selection', 'odds'}
+        :return: None
+        """
+
+        if not deltas:
+            return
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(event_id, ()))
+            self._published += len(deltas)
+        for subscription in subscriptions:
+            if not subscription._put(deltas):
+                with self._lock:
+                    self._overflows += 1
+                self.unsubscribe(subscription)
+
+    def stats(self):
+        """
+        Broker counters
+        :return: DICT broker stats
+        """
+
+        with self._lock:
+            return {'events': len(self._subscriptions),
+                    'subscriptions': self._count,
+                    'published': self._published,
+                    'overflows': self._overflows}
+
+
+def format_event(name, data):
+    """
+    Formats a server-sent event
+    :param name: STR event name
+    :param data: BYTES or STR event data, in a single line
+    :return: BYTES event
+    """
+
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return b'event: ' + name.encode('utf-8') + b'\ndata: ' + data + b'\n\n'
+
+
+def iter_events(snapshot, subscription, heartbeat=HEARTBEAT):
+    """
+    Server-sent events of a match: a 'snapshot' event with the whole match, then 'odds' events with
+    the deltas, and a last 'overflow' event if the consumer fell too far behind
+    :param snapshot: cache.Snapshot taken after subscribing
+    :param subscription: Subscription, closed when the generator is closed
+    :param heartbeat: FLOAT seconds between keep-alive comments
+    :return: GENERATOR of BYTES events
+    """
+
+    try:
+        yield format_event('snapshot', snapshot.body)
+        while not subscription.closed:
+            deltas = subscription.wait(heartbeat)
+            if deltas:
+                yield format_event('odds', serialize.dumps(deltas))
+            elif not subscription.closed:
+                yield b': keep-alive\n\n'
+        if subscription.overflowed:
+            yield format_event('overflow', '{}')
+    finally:
+        subscription.close()
+
+
+async def aiter_events(snapshot, subscription, heartbeat=HEARTBEAT):
+    """
+    Async iter_events, waiting on the event loop
+    :param snapshot: cache.Snapshot taken after subscribing
+    :param subscription: Subscription, closed when the generator is closed
+    :param heartbeat: FLOAT seconds between keep-alive comments
+    :return: ASYNC GENERATOR of BYTES events
+    """
+
+    try:
+        yield format_event('snapshot', snapshot.body)
+        while not subscription.closed:
+            deltas = await subscription.wait_async(heartbeat)
+            if deltas:
+                yield format_event('odds', serialize.dumps(deltas))
+            elif not subscription.closed:
+                yield b': keep-alive\n\n'
+        if subscription.overflowed:
+            yield format_event('overflow', '{}')
+    finally:
+        subscription.close()
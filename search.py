@@ -0,0 +1,129 @@
+# coding=utf-8
+# __author__ = 'Mario Romera Fernández'
+
+import re
+import sqlite3
+
+import statements
+
+
+def _fts5_available():
+    """
+    Checks if the sqlite3 library has been built with FTS5
+    :return: BOOLEAN
+    """
+
+    try:
+        sqlite3.connect(':memory:').execute('''CREATE VIRTUAL TABLE fts5_check USING fts5(name);''')
+    except sqlite3.OperationalError:
+        return False
+    return True
+
+
+FTS5 = _fts5_available()
+
+_TERM = re.compile(r'\w+', re.UNICODE)
+
+INDEX_EVENT = statements.register('index_event', '''
+    INSERT INTO EVENTS_FTS(rowid, Ev_NAME) VALUES(?, ?);''')
+UNINDEX_EVENT = statements.register('unindex_event', '''
+    INSERT INTO EVENTS_FTS(EVENTS_FTS, rowid, Ev_NAME) VALUES('delete', ?, ?);''')
+SEARCH_EVENTS = statements.register('search_events', '''
+    SELECT Ev_ID, EVENTS.Ev_NAME, Ev_STARTTIME FROM EVENTS_FTS
+    INNER JOIN EVENTS ON EVENTS.Ev_ID = EVENTS_FTS.rowid
+    WHERE EVENTS_FTS MATCH ?
+    ORDER BY rank, Ev_STARTTIME
+    LIMIT ?;''')
+
+
+def create_index(cur):
+    """
+    Creates the full text index of event names, filling it if it is new
+    Without FTS5 searches fall back to scanning EVENTS
+    :param cur: sqlite3.Cursor
+    :return: None
+    """
+
+    if not FTS5:
+        return
+    cur.execute('''SELECT name FROM sqlite_master WHERE name = 'EVENTS_FTS';''')
+    exists = cur.fetchone() is not None
+    cur.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS EVENTS_FTS
+                   USING fts5(Ev_NAME, content='EVENTS', content_rowid='Ev_ID',
+                              tokenize='unicode61 remove_diacritics 2', prefix='2 3');''')
+    if not exists:
+        cur.execute('''INSERT INTO EVENTS_FTS(EVENTS_FTS) VALUES('rebuild');''')
+
+
+def drop_index(cur):
+    """
+    Drops the full text index of event names
+    :param cur: sqlite3.Cursor
+    :return: None
+    """
+
+    if FTS5:
+        cur.execute('''DROP TABLE IF EXISTS EVENTS_FTS;''')
+
+
+def index_event(cur, event_id, name):
+    """
+    Adds an event name to the full text index, in the transaction inserting the event
+    :param cur: sqlite3.Cursor
+    :param event_id: INT event id
+    :param name: STR event name
+    :return: None
+    """
+
+    if FTS5:
+        INDEX_EVENT.execute(cur, (event_id, name))
+
+
+def unindex_event(cur, event_id, name):
+    """
+    Removes an event name from the full text index, in the transaction deleting the event
+    :param cur: sqlite3.Cursor
+    :param event_id: INT event id
+    :param name: STR event name as it was indexed
+    :return: None
+    """
+
+    if FTS5:
+        UNINDEX_EVENT.execute(cur, (event_id, name))
+
+
+def terms(text):
+    """
+    Splits a search text into words
+    :param text: STR search text
+    :return: LIST of STR words
+    """
+
+    return _TERM.findall(text)
+
+
+def search(cur, text, limit):
+    """
+    Finds events whose name has words starting with every word of the text, e.g. 'Real' or
+    'real mad' find 'Real Madrid vs Barcelona'. Best matches come first
+    :param cur: sqlite3.Cursor
+    :param text: STR search text
+    :param limit: INT maximum number of events
+    :return: LIST of (Ev_ID, Ev_NAME, Ev_STARTTIME)
+    """
+
+    words = terms(text)
+    if not words:
+        return []
+
+    if FTS5:
+        return SEARCH_EVENTS.fetchall(cur, (' '.join('"%s"*' % word.replace('"', '""') for word in words),
+                                            limit))
+
+    # Without FTS5: scan matching every word anywhere in the name
+    cur.execute('''SELECT Ev_ID, Ev_NAME, Ev_STARTTIME FROM EVENTS
+                   WHERE %s
+                   ORDER BY Ev_STARTTIME
+                   LIMIT ?;''' % ' AND '.join(['''Ev_NAME LIKE ? ESCAPE '\\' '''] * len(words)),
+                ['%%%s%%' % re.sub(r'([%_\\])', r'\\\1', word) for word in words] + [limit])
+    return cur.fetchall()
@@ -0,0 +1,38 @@
+# coding=utf-8
+# __author__ = 'Mario Romera Fernández'
+
+import json
+
+# orjson is optional: several times faster than json, with the same output for API documents
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+ORJSON = orjson is not None
+
+
+def dumps(data):
+    """
+    Serializes data to compact JSON
+    :param data: JSON serializable data, DICT keys may be INT
+    :return: BYTES JSON in utf-8
+    """
+
+    if ORJSON:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def loads(data):
+    """
+    Parses JSON
+    :param data: BYTES or STR JSON
+    :return: parsed data
+    :raises ValueError: if the data is not valid JSON
+    """
+
+    if ORJSON:
+        return orjson.loads(data)
+    return json.loads(data)
@@ -0,0 +1,255 @@
+# coding=utf-8
+# __author__ = 'Mario Romera Fernández'
+
+import json
+import mmap
+import os
+import sys
+from array import array
+
+import serialize
+
+# Snapshot file layout: MAGIC, the header length as a little-endian INT64, the JSON header, then the
+# column sections, each one aligned to 8 bytes. The header lists the tables with their row count
+# and columns; columns are stored whole, so a table is read without parsing rows:
+# - 'q' INT64 and 'd' FLOAT64 columns: little-endian array of values
+# - 't' text and 'b' blob columns: INT64 array of the row count + 1 value offsets, then the values
+# Columns with NULLs also have a section of one byte per row, 1 for NULL.
+MAGIC = b'BBSNAP01'
+
+# Snapshot column type by declared SQLite column type
+_TYPES = {'INTEGER': 'q', 'FLOAT': 'd', 'REAL': 'd', 'TEXT': 't', 'BLOB': 'b'}
+
+# Arrays are little-endian in snapshots, big-endian hosts swap them when reading and writing
+_SWAP = sys.byteorder == 'big'
+
+
+class SnapshotError(ValueError):
+    """
+    Raised for files that are not snapshots or do not match the database tables
+    """
+
+
+def _columns(cur, table):
+    """
+    Gets the columns of a table with their snapshot type
+    :param cur: sqlite3.Cursor
+    :param table: STR table name
+    :return: LIST of (STR column name, STR column type), empty if there is no such table
+    """
+
+    cur.execute('''SELECT name, type FROM pragma_table_info(?) ORDER BY cid;''', (table,))
+    return [(name, _TYPES[declared.upper()]) for name, declared in cur.fetchall()]
+
+
+def _array(kind, values):
+    """
+    Encodes numbers as a little-endian array
+    :param kind: STR 'q' or 'd'
+    :param values: ITERABLE of INT or FLOAT
+    :return: BYTES
+    """
+
+    numbers = array(kind, values)
+    if _SWAP:
+        numbers.byteswap()
+    return numbers.tobytes()
+
+
+def _encode(kind, values):
+    """
+    Encodes a column
+    :param kind: STR column type
+    :param values: LIST of values
+    :return: TUPLE (BYTES nulls section or None, BYTES data section)
+    """
+
+    nulls = bytes(value is None for value in values) if None in values else None
+    if kind in 'qd':
+        return nulls, _array(kind, [0 if value is None else value for value in values])
+    if kind == 't':
+        values = [b'' if value is None else value.encode('utf-8') for value in values]
+    else:
+        values = [b'' if value is None else bytes(value) for value in values]
+    offsets = [0]
+    for value in values:
+        offsets.append(offsets[-1] + len(value))
+    return nulls, _array('q', offsets) + b''.join(values)
+
+
+def export(cur, tables, path):
+    """
+    Writes the rows of some tables to a snapshot file, replacing the file once complete
+    Run it inside a read transaction so the tables are consistent with each other
+    :param cur: sqlite3.Cursor
+    :param tables: LIST of STR table names, missing ones are skipped
+    :param path: STR file path
+    :return: DICT table name -> INT rows written
+    """
+
+    header = []
+    sections = []
+    offset = 0
+    for table in tables:
+        columns = _columns(cur, table)
+        if not columns:
+            continue
+        cur.execute('''SELECT %s FROM %s ORDER BY rowid;''' % (', '.join(name for name, _ in columns), table))
+        rows = cur.fetchall()
+        described = []
+        for index, (name, kind) in enumerate(columns):
+            column = {'name': name, 'type': kind}
+            for key, data in zip(('nulls', 'data'), _encode(kind, [row[index] for row in rows])):
+                if data is None:
+                    continue
+                # Offsets are relative to the first section
+                column[key] = [offset, len(data)]
+                sections.append(data + b'\0' * (-len(data) % 8))
+                offset += len(sections[-1])
+            described.append(column)
+        header.append({'name': table, 'rows': len(rows), 'columns': described})
+
+    header_data = serialize.dumps(header)
+    prefix = MAGIC + _array('q', [len(header_data)]) + header_data
+    temporary = path + '.tmp'
+    with open(temporary, 'wb') as snapshot_file:
+        snapshot_file.write(prefix + b'\0' * (-len(prefix) % 8))
+        for data in sections:
+            snapshot_file.write(data)
+    os.replace(temporary, path)
+    return {table['name']: table['rows'] for table in header}
+
+
+class Snapshot(object):
+    """
+    Snapshot file opened for reading
+
+    The file is memory-mapped: columns are read in place from the page cache, so loading a
+    snapshot costs no reads into intermediate buffers and a snapshot read again is not read from disk.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: STR file path
+        """
+
+        with open(path, 'rb') as snapshot_file:
+            self._map = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if self._map[:len(MAGIC)] != MAGIC:
+                raise SnapshotError('Not a snapshot file: %s' % path)
+            length, = self._numbers('q', len(MAGIC), 8)
+            end = len(MAGIC) + 8 + length
+            self.tables = json.loads(self._map[len(MAGIC) + 8:end])
+            self._start = end + -end % 8
+        except Exception:
+            self._map.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Unmaps the file
+        :return: None
+        """
+
+        self._map.close()
+
+    def _numbers(self, kind, offset, length):
+        """
+        Reads an array
+        :param kind: STR 'q' or 'd'
+        :param offset: INT position in the file
+        :param length: INT length in bytes
+        :return: LIST of INT or FLOAT
+        """
+
+        if _SWAP:
+            numbers = array(kind, self._map[offset:offset + length])
+            numbers.byteswap()
+            return numbers.tolist()
+        with memoryview(self._map)[offset:offset + length] as section, section.cast(kind) as numbers:
+            return numbers.tolist()
+
+    def column(self, column, rows):
+        """
+        Reads the values of a column
+        :param column: DICT column as described in the header
+        :param rows: INT number of rows of the table
+        :return: LIST of values
+        """
+
+        offset, length = column['data']
+        offset += self._start
+        if column['type'] in 'qd':
+            values = self._numbers(column['type'], offset, length)
+        else:
+            ends = self._numbers('q', offset, 8 * (rows + 1))
+            offset += 8 * (rows + 1)
+            values = [self._map[offset + begin:offset + end] for begin, end in zip(ends, ends[1:])]
+            if column['type'] == 't':
+                values = [str(value, 'utf-8') for value in values]
+        if 'nulls' in column:
+            offset, length = column['nulls']
+            nulls = self._map[self._start + offset:self._start + offset + length]
+            values = [None if null else value for null, value in zip(nulls, values)]
+        return values
+
+    def rows(self, table):
+        """
+        Reads the rows of a table
+        :param table: DICT table as described in the header
+        :return: ITERATOR of TUPLE rows
+        """
+
+        return zip(*[self.column(column, table['rows']) for column in table['columns']])
+
+
+def load(cur, path):
+    """
+    Inserts the rows of a snapshot file into existing tables
+    :param cur: sqlite3.Cursor
+    :param path: STR file path
+    :return: DICT table name -> INT rows inserted
+    """
+
+    counts = {}
+    with Snapshot(path) as snapshot:
+        for table in snapshot.tables:
+            names = [column['name'] for column in table['columns']]
+            known = dict(_columns(cur, table['name']))
+            if not known or not set(names) <= set(known):
+                raise SnapshotError('Table %r does not match the database' % table['name'])
+            cur.executemany('''INSERT INTO %s (%s) VALUES (%s);''' % (table['name'], ', '.join(names),
+                                                                     ', '.join(['?'] * len(names))),
+                            snapshot.rows(table))
+            counts[table['name']] = table['rows']
+    return counts
+
+
+if __name__ == '__main__':
+
+    import argparse
+    import time
+    import db
+
+    parser = argparse.ArgumentParser(description='BetBright database snapshots')
+    parser.add_argument('command', choices=['export', 'import'])
+    parser.add_argument('file', help='snapshot file')
+    parser.add_argument('--db', default=db.DB_NAME, help='database file')
+    arguments = parser.parse_args()
+
+    db.DB_NAME = arguments.db
+    started = time.perf_counter()
+    if arguments.command == 'export':
+        tables = db.export_snapshot(arguments.file)
+    else:
+        tables = db.import_snapshot(arguments.file)
+    for name, rows in tables.items():
+        print('%-12s %10i rows' % (name, rows))
+    print('%s %s in %.3f seconds' % (arguments.command, arguments.file, time.perf_counter() - started))
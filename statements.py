@@ -0,0 +1,162 @@
+# coding=utf-8
+# __author__ = 'Mario Romera Fernández'
+
+import threading
+import time
+
+import metrics
+
+
+ROWS_WRITTEN = metrics.counter('betbright_db_rows_written', 'Rows written by data layer statements', ('statement',))
+
+
+class Statement(object):
+    """
+    SQL statement with bound parameters, registered once and run many times
+
+    The SQL text never changes, so every pooled connection prepares it once and reuses it from
+    its sqlite3 statement cache afterwards. Calls, rows and time spent are counted per statement
+    and timed in the metrics.DB_SECONDS histogram, execution and row fetching apart.
+    """
+
+    __slots__ = ('name', 'sql', 'calls', 'rows', 'seconds', '_lock')
+
+    def __init__(self, name, sql):
+        """
+        :param name: STR statement name
+        :param sql: STR SQL text with '?' placeholders
+        """
+
+        self.name = name
+        self.sql = sql
+        self.calls = 0
+        self.rows = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def _count(self, start, rows, fetch_start=None):
+        """
+        Adds a run to the counters
+        :param start: FLOAT perf_counter when the run started
+        :param rows: INT rows read or written
+        :param fetch_start: FLOAT perf_counter when rows started to be fetched, for queries
+        :return: None
+        """
+
+        end = time.perf_counter()
+        with self._lock:
+            self.calls += 1
+            self.rows += rows
+            self.seconds += end - start
+        if fetch_start is None:
+            metrics.DB_SECONDS.observe(end - start, ('execute', self.name))
+            ROWS_WRITTEN.inc(rows, (self.name,))
+        else:
+            metrics.DB_SECONDS.observe(fetch_start - start, ('execute', self.name))
+            metrics.DB_SECONDS.observe(end - fetch_start, ('fetch', self.name))
+
+    def execute(self, cur, parameters=()):
+        """
+        Runs the statement
+        :param cur: sqlite3.Cursor
+        :param parameters: TUPLE of parameters
+        :return: INT number of rows written
+        """
+
+        start = time.perf_counter()
+        cur.execute(self.sql, parameters)
+        self._count(start, max(cur.rowcount, 0))
+        return cur.rowcount
+
+    def executemany(self, cur, parameters):
+        """
+        Runs the statement once per parameters tuple
+        :param cur: sqlite3.Cursor
+        :param parameters: ITERABLE of TUPLE of parameters
+        :return: INT number of rows written
+        """
+
+        start = time.perf_counter()
+        cur.executemany(self.sql, parameters)
+        self._count(start, max(cur.rowcount, 0))
+        return cur.rowcount
+
+    def fetchall(self, cur, parameters=()):
+        """
+        Runs a query and reads every row
+        :param cur: sqlite3.Cursor
+        :param parameters: TUPLE of parameters
+        :return: LIST of rows
+        """
+
+        start = time.perf_counter()
+        cur.execute(self.sql, parameters)
+        fetch_start = time.perf_counter()
+        results = cur.fetchall()
+        self._count(start, len(results), fetch_start)
+        return results
+
+    def fetchone(self, cur, parameters=()):
+        """
+        Runs a query and reads its first row
+        :param cur: sqlite3.Cursor
+        :param parameters: TUPLE of parameters
+        :return: row or None
+        """
+
+        start = time.perf_counter()
+        cur.execute(self.sql, parameters)
+        fetch_start = time.perf_counter()
+        result = cur.fetchone()
+        self._count(start, 0 if result is None else 1, fetch_start)
+        return result
+
+    def stats(self):
+        """
+        Statement counters
+        :return: DICT {'calls', 'rows', 'seconds'}
+        """
+
+        with self._lock:
+            return {'calls': self.calls, 'rows': self.rows, 'seconds': self.seconds}
+
+
+class Registry(object):
+    """
+    Named statements of the data layer
+    """
+
+    def __init__(self):
+        self._statements = {}
+
+    def register(self, name, sql):
+        """
+        Registers a statement
+        :param name: STR unique statement name
+        :param sql: STR SQL text with '?' placeholders
+        :return: Statement
+        """
+
+        if name in self._statements:
+            raise ValueError('Statement %r already registered' % name)
+        statement = Statement(name, sql)
+        self._statements[name] = statement
+        return statement
+
+    def __getitem__(self, name):
+        return self._statements[name]
+
+    def __len__(self):
+        return len(self._statements)
+
+    def stats(self):
+        """
+        Counters of every statement
+        :return: DICT statement name -> DICT {'calls', 'rows', 'seconds'}
+        """
+
+        return {name: statement.stats() for name, statement in self._statements.items()}
+
+
+REGISTRY = Registry()
+register = REGISTRY.register
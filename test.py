@@ -1,15 +1,88 @@
 # coding=utf-8
 # __author__ = 'Mario Romera Fernández'
 
+import asyncio
+import gzip
+import json
+import multiprocessing
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
 import requests
 import sqlite3
-from contextlib import closing
+from contextlib import closing, contextmanager
+import betbright_task_asgi
+import cache
 import db
+import dedup
+import pool
+import pubsub
+import statements
+import writer
+
+
+def wait_for(condition, timeout=10.0):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+@contextmanager
+def temporary_directory(*settings):
+    """
+    Temporary directory for the databases of a test, removed on exit
+    db.DB_NAME and the db settings named are restored on exit, after closing the pool of the test
+    :param settings: STR names of db settings changed by the test
+    :return: STR directory path
+    """
+
+    saved = {name: getattr(db, name) for name in ('DB_NAME',) + settings}
+    with tempfile.TemporaryDirectory() as directory:
+        try:
+            yield directory
+        finally:
+            db.get_pool().close()
+            for name, value in saved.items():
+                setattr(db, name, value)
+
+
+def asgi_request(method, path, query_string='', headers=(), chunks=(b'',)):
+    """
+    Runs a request through the ASGI app in-process
+    :param method: STR http method
+    :param path: STR url path
+    :param query_string: STR query string
+    :param headers: ITERABLE of (STR name, STR value) request headers
+    :param chunks: ITERABLE of BYTES body chunks, received one by one
+    :return: TUPLE (INT status, DICT lower case headers, BYTES body)
+    """
+
+    scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query_string.encode('latin-1'),
+             'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]}
+    chunks = list(chunks)
+    messages = [{'type': 'http.request', 'body': chunk, 'more_body': index < len(chunks) - 1}
+                for index, chunk in enumerate(chunks)]
+    sent = []
+
+    async def receive():
+        return messages.pop(0) if messages else {'type': 'http.disconnect'}
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(betbright_task_asgi.app(scope, receive, send))
+    response_headers = {name.decode('latin-1'): value.decode('latin-1') for name, value in sent[0]['headers']}
+    return sent[0]['status'], response_headers, b''.join(message.get('body', b'') for message in sent[1:])
 
 
 class TestCase(unittest.TestCase):
-    def test_0_create_database(self):
+    def test_00_create_database(self):
         db.create_db()
         with closing(sqlite3.connect(db.DB_NAME)) as conn:
             cur = conn.cursor()
@@ -17,14 +90,14 @@ class TestCase(unittest.TestCase):
             tables = cur.fetchall()
         assert ('MESSAGES',) and ('SPORTS',) and ('EVENTS',) and ('MARKETS',) and ('SELECTIONS',) in tables
 
-    def test_1_new_event(self):
+    def test_01_new_event(self):
         url = 'http://127.0.0.1:5000/api/v1/resources/external/'
         headers = {'Content-Type': 'application/json'}
         data = open('newevent.json', 'rb').read()
         response = requests.post(url=url, data=data, headers=headers)
         with closing(sqlite3.connect(db.DB_NAME)) as conn:
             cur = conn.cursor()
-            cur.execute('''SELECT * FROM MESSAGES;''')
+            cur.execute('''SELECT Me_ID FROM MESSAGES;''')
             messages = cur.fetchall()
             cur.execute('''SELECT * FROM SPORTS;''')
             sports = cur.fetchall()
@@ -47,14 +120,14 @@ class TestCase(unittest.TestCase):
                 6737666888266680000, 'Draw', 2.0, 385086549360973400, 994839351740) and (
                 8243901714083343000, 'Real Madrid', 1.01, 385086549360973400, 994839351740) in selections
 
-    def test_2_update_odds(self):
+    def test_02_update_odds(self):
         url = 'http://127.0.0.1:5000/api/v1/resources/external/'
         headers = {'Content-Type': 'application/json'}
         data = open('updateodds.json', 'rb').read()
         response = requests.put(url=url, data=data, headers=headers)
         with closing(sqlite3.connect(db.DB_NAME)) as conn:
             cur = conn.cursor()
-            cur.execute('''SELECT * FROM MESSAGES;''')
+            cur.execute('''SELECT Me_ID FROM MESSAGES;''')
             messages = cur.fetchall()
             cur.execute('''SELECT * FROM SELECTIONS;''')
             selections = cur.fetchall()
@@ -64,14 +137,14 @@ class TestCase(unittest.TestCase):
                 6737666888266680000, 'Draw', 1.01, 385086549360973400, 994839351740) and (
                 8243901714083343000, 'Real Madrid', 10.0, 385086549360973400, 994839351740) in selections
 
-    def test_3_new_event_2(self):
+    def test_03_new_event_2(self):
         url = 'http://127.0.0.1:5000/api/v1/resources/external/'
         headers = {'Content-Type': 'application/json'}
         data = open('newevent2.json', 'rb').read()
         response = requests.post(url=url, data=data, headers=headers)
         with closing(sqlite3.connect(db.DB_NAME)) as conn:
             cur = conn.cursor()
-            cur.execute('''SELECT * FROM MESSAGES;''')
+            cur.execute('''SELECT Me_ID FROM MESSAGES;''')
             messages = cur.fetchall()
             cur.execute('''SELECT * FROM SPORTS;''')
             sports = cur.fetchall()
@@ -94,7 +167,7 @@ class TestCase(unittest.TestCase):
                 6737666888266680001, 'Draw', 2.0, 385086549360973401, 994839351741) and (
                 8243901714083343001, 'Boca Juniors', 1.01, 385086549360973401, 994839351741) in selections
 
-    def test_4_match_by_id(self):
+    def test_04_match_by_id(self):
         url = 'http://127.0.0.1:5000/api/v1/resources/match/994839351740'
         response = requests.get(url=url).json()
         assert 994839351740 == response['id']
@@ -103,6 +176,10 @@ class TestCase(unittest.TestCase):
         assert "Football" in response['sport']['name']
         assert "2018-06-20 10:30:00" in response['startTime']
         assert "http://127.0.0.1:5000/api/v1/resources/match/994839351740" in response['url']
+        # Ids out of the SQLite integer range are not found
+        for path in ('', '/stream', '/history'):
+            url = 'http://127.0.0.1:5000/api/v1/resources/match/%i%s' % (2 ** 63, path)
+            assert 404 == requests.get(url=url).status_code
         for market in response['markets']:
             assert 385086549360973300 or 385086549360973400 == market['id']
             assert "1st Half Winner" or "Winner" in market['name']
@@ -114,7 +191,7 @@ class TestCase(unittest.TestCase):
                  "id": 6737666888266680000, "name": "Draw", "odds": 1.01} or {
                  "id": 8243901714083343000, "name": "Real Madrid", "odds": 10.0} in selection
 
-    def test_5_match_by_time(self):
+    def test_05_match_by_time(self):
         url = 'http://127.0.0.1:5000/api/v1/resources/match/football/?ordering=startTime'
         response = requests.get(url=url).json()
         assert [{"id": 994839351740,
@@ -126,7 +203,7 @@ class TestCase(unittest.TestCase):
                  "startTime": "2018-06-20 20:30:00",
                  "url": "http://127.0.0.1:5000/api/v1/resources/match/994839351741"}] == response
 
-    def test_6_match_by_name(self):
+    def test_06_match_by_name(self):
         url = 'http://127.0.0.1:5000/api/v1/resources/match/?name=Real%20Madrid%20vs%20Barcelona'
         response = requests.get(url=url).json()
         assert [{"id": 994839351740,
@@ -134,6 +211,671 @@ class TestCase(unittest.TestCase):
                  "startTime": "2018-06-20 10:30:00",
                  "url": "http://127.0.0.1:5000/api/v1/resources/match/994839351740"}] == response
 
+    def test_07_bulk_ingest(self):
+        url = 'http://127.0.0.1:5000/api/v1/resources/external/bulk/?batch=2'
+        headers = {'Content-Type': 'application/x-ndjson', 'Content-Encoding': 'gzip'}
+        lines = [json.dumps(json.load(open(name))) for name in ('newevent.json', 'updateodds.json', 'newevent2.json')]
+        lines.append('{"id": 1, "message_type": "NewEvent"')
+        data = gzip.compress('\n'.join(lines).encode('utf-8'))
+        response = requests.post(url=url, data=data, headers=headers).json()
+        assert ['duplicate', 'duplicate', 'duplicate', 'error'] == [result['status'] for result in response]
+        assert [1, 2, 3, 4] == [result['line'] for result in response]
+        assert 8661032861909884000 == response[0]['id']
+        # Corrupt deflate data after a valid gzip header
+        response = requests.post(url=url, data=data[:10] + b'\xff' * 20, headers=headers)
+        assert 400 == response.status_code
+        assert 'bad gzip body' in response.text
+        url = 'http://127.0.0.1:5000/api/v1/resources/external/bulk/?batch=%i' % (db.INGEST_MAX_BATCH_SIZE + 1)
+        assert 400 == requests.post(url=url, data=data, headers=headers).status_code
+
+    def test_08_match_by_time_paginated(self):
+        url = 'http://127.0.0.1:5000/api/v1/resources/match/sport/Football/?ordering=startTime&limit=1'
+        response = requests.get(url=url)
+        assert [994839351740] == [match['id'] for match in response.json()]
+        response = requests.get(url=url, params={'cursor': response.headers['X-Next-Cursor']})
+        assert [994839351741] == [match['id'] for match in response.json()]
+        assert 'X-Next-Cursor' not in response.headers
+        assert 400 == requests.get(url=url, params={'cursor': '1529487000:%i' % 2 ** 63}).status_code
+        url = 'http://127.0.0.1:5000/api/v1/resources/match/football/'
+        response = requests.get(url=url, params={'ordering': 'startTime', 'from': '2018-06-20 12:00:00'}).json()
+        assert [994839351741] == [match['id'] for match in response]
+
+    def test_09_match_search(self):
+        url = 'http://127.0.0.1:5000/api/v1/resources/match/?search=real%20mad'
+        response = requests.get(url=url).json()
+        assert [994839351740] == [match['id'] for match in response]
+        url = 'http://127.0.0.1:5000/api/v1/resources/match/?search=Riv&limit=1'
+        response = requests.get(url=url).json()
+        assert [994839351741] == [match['id'] for match in response]
+
+    def test_10_match_etag(self):
+        url = 'http://127.0.0.1:5000/api/v1/resources/match/994839351740'
+        response = requests.get(url=url)
+        etag = response.headers['ETag']
+        response = requests.get(url=url, headers={'If-None-Match': etag})
+        assert 304 == response.status_code
+        assert b'' == response.content
+        url = 'http://127.0.0.1:5000/api/v1/resources/external/'
+        data = json.load(open('updateodds.json'))
+        data['id'] += 1
+        data['event']['markets'][0]['selections'][0]['odds'] = 5.5
+        requests.post(url=url, data=json.dumps(data), headers={'Content-Type': 'application/json'})
+        url = 'http://127.0.0.1:5000/api/v1/resources/match/994839351740'
+        response = requests.get(url=url, headers={'If-None-Match': etag})
+        assert 200 == response.status_code
+        assert etag != response.headers['ETag']
+        selection_id = data['event']['markets'][0]['selections'][0]['id']
+        assert [5.5] == [selection['odds'] for market in response.json()['markets']
+                         for selection in market['selections'] if selection['id'] == selection_id]
+
+    def test_11_metrics(self):
+        url = 'http://127.0.0.1:5000/metrics'
+        response = requests.get(url=url)
+        assert response.headers['Content-Type'].startswith('text/plain')
+        assert 'betbright_messages_ingested_total{message_type="NewEvent"}' in response.text
+        assert 'betbright_request_seconds_count{route="api_get_match_by_id"}' in response.text
+
+    def test_12_odds_delta(self):
+        url = 'http://127.0.0.1:5000/api/v1/resources/external/'
+        headers = {'Content-Type': 'application/json'}
+        data = json.load(open('updateodds.json'))
+        data['id'] += 2
+        data['event']['markets'][0]['selections'][0]['odds'] = 4.5
+        requests.post(url=url, data=json.dumps(data), headers=headers)
+        url = 'http://127.0.0.1:5000/api/v1/resources/match/994839351740'
+        etag = requests.get(url=url).headers['ETag']
+        url = 'http://127.0.0.1:5000/api/v1/resources/external/'
+        data['id'] += 1
+        response = requests.post(url=url, data=json.dumps(data), headers=headers)
+        assert '<p>200</p>' in response.text
+        assert '0' == response.headers['X-Odds-Changed']
+        assert '3' == response.headers['X-Odds-Unchanged']
+        data['id'] += 1
+        data['event']['markets'][0]['selections'][1]['odds'] = 3.25
+        response = requests.post(url=url, data=json.dumps(data), headers=headers)
+        assert '1' == response.headers['X-Odds-Changed']
+        assert '2' == response.headers['X-Odds-Unchanged']
+        url = 'http://127.0.0.1:5000/api/v1/resources/match/994839351740'
+        assert etag != requests.get(url=url).headers['ETag']
+        url = 'http://127.0.0.1:5000/metrics'
+        assert 'betbright_odds_selections_total{result="unchanged"}' in requests.get(url=url).text
+
+    def test_13_odds_history(self):
+        url = 'http://127.0.0.1:5000/api/v1/resources/external/'
+        data = json.load(open('updateodds.json'))
+        data['id'] += 5
+        data['event']['markets'][0]['selections'][0]['odds'] = 7.5
+        requests.post(url=url, data=json.dumps(data), headers={'Content-Type': 'application/json'})
+        selection_id = data['event']['markets'][0]['selections'][0]['id']
+        url = 'http://127.0.0.1:5000/api/v1/resources/match/994839351740/history'
+        response = requests.get(url=url)
+        odds = [selection['odds'] for selection in response.json()['selections'] if selection['id'] == selection_id][0]
+        assert [7.5] == odds[-1:]
+        assert 10.0 in odds
+        response = requests.get(url=url, params={'from': '2000-01-01 00:00:00', 'to': '2000-01-02 00:00:00'})
+        assert all(not selection['odds'] for selection in response.json()['selections'])
+        url = 'http://127.0.0.1:5000/api/v1/resources/match/1/history'
+        assert 404 == requests.get(url=url).status_code
+
+    def test_14_snapshot(self):
+        database = db.DB_NAME
+        with temporary_directory() as directory:
+            path = os.path.join(directory, 'snapshot')
+            tables = db.export_snapshot(path)
+            db.DB_NAME = os.path.join(directory, 'replica.db')
+            assert tables == db.import_snapshot(path)
+            assert 994839351740 == db.get_match_by_id(994839351740)['id']
+            with closing(sqlite3.connect(db.DB_NAME)) as replica, closing(sqlite3.connect(database)) as conn:
+                for table in tables:
+                    query = 'SELECT * FROM %s ORDER BY rowid;' % table
+                    assert conn.execute(query).fetchall() == replica.execute(query).fetchall()
+
+    def test_15_matches_by_ids(self):
+        url = 'http://127.0.0.1:5000/api/v1/resources/match/'
+        response = requests.get(url=url, params={'ids': '994839351740,994839351741,1,994839351740'})
+        assert [994839351740, 994839351741] == [match['id'] for match in response.json()]
+        streamed = requests.get(url=url, params={'ids': '994839351740,994839351741', 'stream': 'true'})
+        assert response.json() == streamed.json()
+        response = requests.post(url=url, data=json.dumps({'ids': [994839351741]}),
+                                 headers={'Content-Type': 'application/json'})
+        assert [994839351741] == [match['id'] for match in response.json()]
+        assert 400 == requests.get(url=url, params={'ids': '994839351740,a'}).status_code
+        assert 400 == requests.post(url=url, data=json.dumps([]),
+                                    headers={'Content-Type': 'application/json'}).status_code
+
+    def test_16_message_validation(self):
+        url = 'http://127.0.0.1:5000/api/v1/resources/external/'
+        headers = {'Content-Type': 'application/json'}
+        data = json.load(open('newevent.json'))
+        data['id'] = 1
+        data['event']['markets'][1]['selections'][0]['odds'] = 'evens'
+        response = requests.post(url=url, data=json.dumps(data), headers=headers)
+        assert 400 == response.status_code
+        with closing(sqlite3.connect(db.DB_NAME)) as conn:
+            assert [] == conn.execute('''SELECT * FROM MESSAGES WHERE Me_ID = 1;''').fetchall()
+        data['message_type'] = 'NewMatch'
+        assert 'bad message_type' in requests.post(url=url, data=json.dumps(data), headers=headers).text
+        assert 'bad JSON' in requests.post(url=url, data='{"id": 1', headers=headers).text
+        url = 'http://127.0.0.1:5000/api/v1/resources/external/bulk/'
+        data['message_type'] = 'NewEvent'
+        response = requests.post(url=url, data=json.dumps(data), headers=headers).json()
+        assert 'error' == response[0]['status']
+        assert 1 == response[0]['id']
+        assert 'event.markets[1].selections[0].odds' in response[0]['error']
+
+    def test_17_archive_events(self):
+        tables = [('EVENTS', 'Ev_ID'), ('MARKETS', 'Ma_EVENTID'), ('SELECTIONS', 'Se_EVENTID'),
+                  ('ODDS_TICKS', 'Ot_EVENTID'), ('ODDS_BLOCKS', 'Ob_EVENTID')]
+        with temporary_directory('ARCHIVE_DB_NAME', 'ARCHIVE_HORIZON', 'HISTORY_ROLL_AGE') as directory:
+            db.DB_NAME = os.path.join(directory, 'events.db')
+            db.ARCHIVE_DB_NAME = os.path.join(directory, 'archive.db')
+            db.ARCHIVE_HORIZON = 86400
+            db.create_db()
+            data = json.load(open('newevent.json'))
+            match_id = data['event']['id']
+            db.ingest(data)
+            data = json.load(open('updateodds.json'))
+            db.ingest(data)
+            # Roll the ticks so far into blocks, later odds stay as ticks
+            db.HISTORY_ROLL_AGE = -1
+            db.roll_odds_history()
+            data['id'] += 1
+            data['event']['markets'][0]['selections'][0]['odds'] = 5.5
+            db.ingest(data)
+            data = json.load(open('newevent2.json'))
+            data['event']['startTime'] = '2100-01-01 00:00:00'
+            db.ingest(data)
+            assert match_id == db.get_match_by_id(match_id)['id']
+            assert db.MATCH_CACHE.get(match_id) is not None
+            assert db.get_odds_book().event_odds(match_id)
+            with closing(sqlite3.connect(db.DB_NAME)) as conn:
+                rows = [sorted(conn.execute('SELECT * FROM %s WHERE %s = ?;' % table, (match_id,)).fetchall())
+                        for table in tables]
+            assert all(rows)
+            # An interrupted run copied the event to the archive, then failed before deleting it
+            db._create_archive()
+            with closing(sqlite3.connect(db.ARCHIVE_DB_NAME)) as archive:
+                archive.execute('ATTACH DATABASE ? AS events;', (db.DB_NAME,))
+                for table, column in tables:
+                    archive.execute('INSERT INTO %s SELECT * FROM events.%s WHERE %s = ?;' % (table, table, column),
+                                    (match_id,))
+                archive.commit()
+
+            report = db.archive_events()
+            assert 1 == report['events']
+            assert [len(table_rows) for table_rows in rows] == [report['rows'][table] for table, _ in tables]
+            with closing(sqlite3.connect(db.DB_NAME)) as conn, closing(sqlite3.connect(db.ARCHIVE_DB_NAME)) as archive:
+                for table, table_rows in zip(tables, rows):
+                    # Rows are copied in index order, so their rowids may differ
+                    query = 'SELECT * FROM %s WHERE %s = ?;' % table
+                    assert [] == conn.execute(query, (match_id,)).fetchall()
+                    assert table_rows == sorted(archive.execute(query, (match_id,)).fetchall())
+            assert [] == db.search_matches('real madrid')
+            assert [data['event']['id']] == [match['id'] for match in db.search_matches('boca')]
+            assert db.MATCH_CACHE.get(match_id) is None
+            assert {} == db.get_odds_book().event_odds(match_id)
+            assert {} == db.get_match_by_id(match_id)
+
+            report = db.archive_events()
+            assert 0 == report['events']
+            assert not any(report['rows'].values())
+
+    def test_18_writer_queue(self):
+        messages = [json.load(open(name)) for name in ('newevent.json', 'updateodds.json', 'newevent2.json')]
+        with temporary_directory() as directory:
+            address = os.path.join(directory, 'writer.sock')
+            db.DB_NAME = os.path.join(directory, 'writer.db')
+            db.create_db()
+            queue = writer.Writer(address, depth=2, batch_size=1)
+            conn, answers = multiprocessing.Pipe()
+            assert queue.submit(messages[:1], conn, threading.Lock())
+            client = writer.WriterClient(address)
+            results = []
+            sender = threading.Thread(target=lambda: results.append(client.ingest_batch(messages[1:])))
+            # A lock on the database holds the first message in the writer, the next ones queue up
+            with closing(sqlite3.connect(db.DB_NAME)) as locker:
+                locker.execute('''BEGIN IMMEDIATE;''')
+                queue.start()
+                wait_for(lambda: 0 == queue.stats()['queued'])
+                sender.start()
+                wait_for(lambda: 2 == queue.stats()['queued'])
+                with self.assertRaises(writer.QueueFull):
+                    client.ingest_batch(messages[:1])
+                closer = threading.Thread(target=queue.close)
+                closer.start()
+                locker.rollback()
+            closer.join()
+            sender.join()
+            assert writer.OK == answers.recv()[0]
+            assert [[db.PROCESSED, db.PROCESSED]] == [[result['status'] for result in batch] for batch in results]
+            assert not queue.submit(messages[:1], conn, threading.Lock())
+            assert {'queued': 0, 'batches': 2, 'messages': 3, 'rejected': 2} == {
+                key: queue.stats()[key] for key in ('queued', 'batches', 'messages', 'rejected')}
+            assert all(db.message_processed(message['id']) for message in messages)
+
+    def test_19_writer_subscriber(self):
+        with temporary_directory() as directory:
+            address = os.path.join(directory, 'writer.sock')
+            # The writer process uses the database in its working directory
+            db.DB_NAME = os.path.join(directory, 'BetBright.db')
+            db.create_db()
+            process = subprocess.Popen([sys.executable, os.path.abspath('writer.py'), address], cwd=directory)
+            try:
+                client = writer.WriterClient(address)
+
+                def subscribers():
+                    try:
+                        return client.stats()['subscribers']
+                    except writer.WriterError:
+                        # Not listening yet
+                        return None
+
+                threading.Thread(target=client.subscribe, daemon=True).start()
+                wait_for(lambda: 1 == subscribers())
+                data = json.load(open('newevent.json'))
+                subscription = db.ODDS_STREAM.subscribe(data['event']['id'])
+                client.ingest_batch([data])
+                data = json.load(open('updateodds.json'))
+                assert db.PROCESSED == client.ingest_batch([data])[0]['status']
+                # Odds committed by the writer process reach the odds stream of this one
+                deltas = {}
+                wait_for(lambda: deltas.update((delta['selection'], delta['odds']) for delta in subscription.take())
+                         or 3 == len(deltas))
+                assert {selection['id']: selection['odds'] for market in data['event']['markets']
+                        for selection in market['selections']} == deltas
+                subscription.close()
+            finally:
+                process.terminate()
+                process.wait()
+            assert not os.path.exists(address)
+
+    def test_20_odds_stream(self):
+        url = 'http://127.0.0.1:5000/api/v1/resources/match/994839351740/stream'
+        response = requests.get(url=url, stream=True, timeout=10)
+        lines = response.iter_lines()
+
+        def next_event():
+            event = {}
+            for line in lines:
+                if line and not line.startswith(b':'):
+                    name, _, value = line.decode('utf-8').partition(': ')
+                    event[name] = value
+                elif event:
+                    return event
+
+        try:
+            assert response.headers['Content-Type'].startswith('text/event-stream')
+            event = next_event()
+            assert 'snapshot' == event['event']
+            assert 994839351740 == json.loads(event['data'])['id']
+            data = json.load(open('updateodds.json'))
+            data['id'] += 6
+            data['event']['markets'][0]['selections'][0]['odds'] = 6.25
+            requests.post(url='http://127.0.0.1:5000/api/v1/resources/external/', data=json.dumps(data),
+                          headers={'Content-Type': 'application/json'})
+            event = next_event()
+            assert 'odds' == event['event']
+            assert {'market': data['event']['markets'][0]['id'],
+                    'selection': data['event']['markets'][0]['selections'][0]['id'],
+                    'odds': 6.25} in json.loads(event['data'])
+        finally:
+            response.close()
+        url = 'http://127.0.0.1:5000/api/v1/resources/match/1/stream'
+        assert 404 == requests.get(url=url).status_code
+
+    def test_21_odds_stream_overflow(self):
+        broker = pubsub.Broker(max_pending=2)
+        subscription = broker.subscribe(1)
+        events = pubsub.iter_events(cache.Snapshot({'id': 1, 'markets': []}), subscription, heartbeat=0.01)
+        assert b'event: snapshot\ndata: {"id":1,"markets":[]}\n\n' == next(events)
+        # Deltas of a selection are coalesced, the latest odds win
+        broker.publish(1, [{'market': 1, 'selection': 1, 'odds': 2.0}, {'market': 1, 'selection': 2, 'odds': 3.0}])
+        broker.publish(1, [{'market': 1, 'selection': 1, 'odds': 2.5}])
+        assert [{'market': 1, 'selection': 2, 'odds': 3.0},
+                {'market': 1, 'selection': 1, 'odds': 2.5}] == json.loads(next(events).split(b'data: ')[1])
+        # A consumer more than max_pending selections behind is dropped
+        broker.publish(1, [{'market': 1, 'selection': selection, 'odds': 2.0} for selection in range(3)])
+        assert b'event: overflow\ndata: {}\n\n' == next(events)
+        assert [] == list(events)
+        assert {'events': 0, 'subscriptions': 0, 'published': 6, 'overflows': 1} == broker.stats()
+
+    def test_22_odds_write_behind(self):
+        with temporary_directory('ODDS_WRITE_BEHIND', 'ODDS_FLUSH_INTERVAL') as directory:
+            db.DB_NAME = os.path.join(directory, 'odds.db')
+            db.ODDS_WRITE_BEHIND = True
+            db.ODDS_FLUSH_INTERVAL = 0.05
+            db.create_db()
+            db.ingest(json.load(open('newevent.json')))
+            data = json.load(open('updateodds.json'))
+            market = data['event']['markets'][0]
+            odds = {selection['id']: selection['odds'] for selection in market['selections']}
+            result = {}
+            assert db.ingest(data, result)
+            assert {'changed': 3, 'unchanged': 0, 'unknown': 0} == result
+            # Committed odds are served at once, the flusher writes them to SELECTIONS later
+            match = db.get_match_by_id(data['event']['id'])
+            assert odds == {selection['id']: selection['odds'] for match_market in match['markets']
+                            if match_market['id'] == market['id'] for selection in match_market['selections']}
+
+            def stored_odds():
+                with closing(sqlite3.connect(db.DB_NAME)) as conn:
+                    return dict(conn.execute('''SELECT Se_ID, Se_ODDS FROM SELECTIONS WHERE Se_MARKETID = ?;''',
+                                             (market['id'],)).fetchall())
+
+            wait_for(lambda: odds == stored_odds())
+            assert 0 == db.flush_odds()
+            data['id'] += 1
+            result = {}
+            assert db.ingest(data, result)
+            assert {'changed': 0, 'unchanged': 3, 'unknown': 0} == result
+
+    def test_23_concurrent_duplicates(self):
+        url = 'http://127.0.0.1:5000/api/v1/resources/external/'
+        data = json.load(open('updateodds.json'))
+        data['id'] += 7
+        body = json.dumps(data)
+        responses = []
+        senders = [threading.Thread(target=lambda: responses.append(requests.put(
+            url=url, data=body, headers={'Content-Type': 'application/json'}).text)) for _ in range(8)]
+        for sender in senders:
+            sender.start()
+        for sender in senders:
+            sender.join()
+        assert 1 == sum('<p>200</p>' in response for response in responses)
+        assert 7 == sum('Message already processed' in response for response in responses)
+        with closing(sqlite3.connect(db.DB_NAME)) as conn:
+            messages = conn.execute('''SELECT Me_ID FROM MESSAGES WHERE Me_ID = ?;''', (data['id'],)).fetchall()
+        assert [(data['id'],)] == messages
+
+    def test_24_matches_deep_page(self):
+        with temporary_directory() as directory:
+            db.DB_NAME = os.path.join(directory, 'matches.db')
+            db.create_db()
+            with closing(sqlite3.connect(db.DB_NAME)) as conn:
+                conn.execute('''INSERT INTO SPORTS VALUES(?, ?);''', (221, 'Football'))
+                conn.executemany('''INSERT INTO EVENTS VALUES(?, ?, ?, ?);''',
+                                 ((event_id, 'Match %i' % event_id, 1529487000 + event_id // 2 * 60, 221)
+                                  for event_id in range(20000)))
+                conn.commit()
+            # SQLite virtual machine steps, in hundreds, of the only pooled connection
+            steps = []
+            with db.get_pool().connection() as conn:
+                conn.set_progress_handler(lambda: steps.append(1), 100)
+
+            def page(cursor):
+                del steps[:]
+                matches, _ = db.get_matches_by_start_time('Football', cursor=cursor, limit=10)
+                return [match['id'] for match in matches], len(steps)
+
+            matches, first_steps = page(None)
+            assert list(range(10)) == matches
+            # Deep pages seek the index past the events of previous pages instead of reading them
+            matches, deep_steps = page('%i:%i' % (1529487000 + 19000 // 2 * 60, 19000))
+            assert list(range(19001, 19011)) == matches
+            assert deep_steps <= first_steps + 5
+
+    def test_25_write_errors(self):
+        with temporary_directory('POOL_TIMEOUT') as directory:
+            db.DB_NAME = os.path.join(directory, 'errors.db')
+            db.POOL_TIMEOUT = 0.1
+            db.create_db()
+            data = json.load(open('newevent.json'))
+            assert writer.ingest(data)
+            # Event ids used by another event are bad messages, not written, and can not be sent again
+            data['id'] += 10
+            with self.assertRaises(writer.MessageError):
+                writer.ingest(data)
+            result = writer.ingest_batch([data])[0]
+            assert db.ERROR == result['status']
+            assert not db.message_processed(data['id'])
+            # A locked database fails the whole call, so the message can be sent again later
+            data = json.load(open('updateodds.json'))
+            with closing(sqlite3.connect(db.DB_NAME)) as locker:
+                locker.execute('''BEGIN IMMEDIATE;''')
+                with self.assertRaises(writer.WriterError):
+                    writer.ingest(data)
+                with self.assertRaises(writer.WriterError):
+                    writer.ingest_batch([data])
+                locker.rollback()
+            assert not db.message_processed(data['id'])
+            assert [db.PROCESSED] == [result['status'] for result in writer.ingest_batch([data])]
+            # So does a full database, limited on the only pooled connection
+            with db.get_pool().connection() as conn:
+                page_count, = conn.execute('''PRAGMA page_count;''').fetchone()
+                conn.execute('''PRAGMA max_page_count = %i;''' % page_count)
+            data = json.load(open('newevent2.json'))
+            data['event']['name'] = 'Boca Juniors vs River Plate' * 10000
+            with self.assertRaises(writer.WriterError):
+                writer.ingest_batch([data])
+            with self.assertRaises(writer.WriterError):
+                writer.ingest(data)
+            assert not db.message_processed(data['id'])
+
+    def test_26_message_id_filter(self):
+        bloom = dedup.BloomFilter(1000, 0.01)
+        for key in range(1000):
+            bloom.add(key)
+        assert all(key in bloom for key in range(1000))
+        assert sum(key in bloom for key in range(10 ** 6, 10 ** 6 + 10000)) < 200
+        # Generations rotate by age, never by count: no id is forgotten before 'period' seconds
+        message_ids = dedup.MessageIdFilter(capacity=100, error_rate=0.01, period=60)
+        message_ids.clear(now=1000.0)
+        for message_id in range(1000):
+            message_ids.add(message_id, now=1000.0 + message_id * 0.05)
+        assert all(message_id in message_ids for message_id in range(1000))
+        message_ids.add(5000, now=1070.0)
+        assert 1 == message_ids.stats()['rotations']
+        assert all(message_id in message_ids for message_id in range(1000))
+        message_ids.add(6000, now=1140.0)
+        assert 2 == message_ids.stats()['rotations']
+        assert 5000 in message_ids and 6000 in message_ids
+        assert not any(message_id in message_ids for message_id in range(1000))
+        # Loaded ids all go to the current generation
+        message_ids.load(range(1000), now=2000.0)
+        message_ids.add(7000, now=2060.0)
+        assert all(message_id in message_ids for message_id in range(1000))
+
+    def test_27_prune_messages(self):
+        with temporary_directory('DEDUP_PRUNE_BATCH') as directory:
+            db.DB_NAME = os.path.join(directory, 'prune.db')
+            db.DEDUP_PRUNE_BATCH = 2
+            db.create_db()
+            old = int(time.time()) - db.DEDUP_RETENTION - 60
+            with closing(sqlite3.connect(db.DB_NAME)) as conn:
+                conn.executemany('''INSERT INTO MESSAGES VALUES(?, ?);''', [(message_id, old) for message_id in range(1, 6)])
+                conn.commit()
+            data = json.load(open('newevent.json'))
+            assert writer.ingest(data)
+            assert db.message_processed(data['id'])
+            # Old ids are deleted over several transactions, recent ones are kept
+            assert 5 == db.prune_messages()
+            assert 0 == db.prune_messages()
+            with closing(sqlite3.connect(db.DB_NAME)) as conn:
+                assert [(data['id'],)] == conn.execute('''SELECT Me_ID FROM MESSAGES;''').fetchall()
+            # Old ids are not loaded in memory, recent ones are
+            db.reset_memory()
+            assert data['id'] in db.get_message_ids()
+            assert not db.message_processed(1)
+            assert db.message_processed(data['id'])
+
+    def test_28_asgi_app(self):
+        with temporary_directory() as directory:
+            db.DB_NAME = os.path.join(directory, 'asgi.db')
+            db.create_db()
+            assert writer.ingest(json.load(open('newevent.json')))
+            url = '/api/v1/resources/match/994839351740'
+            status, headers, body = asgi_request('GET', url)
+            assert 200 == status
+            assert 994839351740 == json.loads(body)['id']
+            etag = headers['etag']
+            status, headers, body = asgi_request('GET', url, headers=[('If-None-Match', etag)])
+            assert (304, etag, b'') == (status, headers['etag'], body)
+            assert 200 == asgi_request('GET', url, headers=[('If-None-Match', '"other"')])[0]
+            assert 404 == asgi_request('GET', '/api/v1/resources/match/1')[0]
+            assert 404 == asgi_request('GET', '/api/v1/resources/match/%i' % 2 ** 63)[0]
+            assert 405 == asgi_request('DELETE', url)[0]
+
+            # Gzip bodies are inflated as chunks arrive
+            url = '/api/v1/resources/external/bulk/'
+            data = gzip.compress(open('updateodds.json', 'rb').read().replace(b'\n', b'') + b'\n')
+            status, headers, body = asgi_request('POST', url, chunks=[data[:10], data[10:]],
+                                                 headers=[('Content-Encoding', 'gzip')])
+            assert 200 == status
+            assert [db.PROCESSED] == [result['status'] for result in json.loads(body)]
+            for data in (data[:-8], data[:10] + b'\xff' * 20):
+                status, headers, body = asgi_request('POST', url, chunks=[data], headers=[('Content-Encoding', 'gzip')])
+                assert (400, b"<h1>400</h1><p>Bad request: bad gzip body</p>") == (status, body)
+            assert 400 == asgi_request('POST', url, 'batch=0')[0]
+
+            # A full writer queue is answered with 429, to be sent again later
+            saved = writer.ADDRESS
+            writer.ADDRESS = os.path.join(directory, 'writer.sock')
+            queue = writer.Writer(writer.ADDRESS, depth=1, batch_size=1)
+            conn, answers = multiprocessing.Pipe()
+            try:
+                with closing(sqlite3.connect(db.DB_NAME)) as locker:
+                    locker.execute('''BEGIN IMMEDIATE;''')
+                    queue.start()
+                    assert queue.submit([json.load(open('newevent2.json'))], conn, threading.Lock())
+                    wait_for(lambda: 0 == queue.stats()['queued'])
+                    data = json.load(open('newevent2.json'))
+                    data['id'] += 1
+                    assert queue.submit([data], conn, threading.Lock())
+                    data['id'] += 1
+                    status, headers, body = asgi_request('POST', url, chunks=[json.dumps(data).encode('utf-8')])
+                    assert (429, '1', betbright_task_asgi.QUEUE_FULL) == (status, headers['retry-after'], body)
+                    closer = threading.Thread(target=queue.close)
+                    closer.start()
+                    locker.rollback()
+                closer.join()
+            finally:
+                writer.ADDRESS = saved
+            assert [writer.OK, writer.OK] == [answers.recv()[0] for _ in range(2)]
+    def test_29_odds_counts(self):
+        def update(message_id, value, selection_id=None):
+            data = json.load(open('updateodds.json'))
+            data['id'] = message_id
+            for selection in data['event']['markets'][0]['selections']:
+                selection['odds'] = value
+            if selection_id is not None:
+                data['event']['markets'][0]['selections'][0]['id'] = selection_id
+            return data
+
+        for write_behind in (False, True):
+            with temporary_directory('ODDS_WRITE_BEHIND') as directory:
+                db.DB_NAME = os.path.join(directory, 'counts.db')
+                db.ODDS_WRITE_BEHIND = write_behind
+                db.create_db()
+                # Later messages of a batch see the odds of earlier ones, the event of the batch included
+                results = db.ingest_batch([json.load(open('newevent.json')), update(1, 3.5), update(2, 3.5),
+                                           update(3, 4.5, selection_id=1)])
+                assert [{}, {'changed': 3, 'unchanged': 0, 'unknown': 0},
+                        {'changed': 0, 'unchanged': 3, 'unknown': 0},
+                        {'changed': 2, 'unchanged': 0, 'unknown': 1}] == [
+                    {key: result[key] for key in ('changed', 'unchanged', 'unknown') if key in result}
+                    for result in results]
+                result = {}
+                assert db.ingest(update(4, 4.5), result)
+                assert {'changed': 1, 'unchanged': 2, 'unknown': 0} == result
+    def test_30_connection_pool(self):
+        with temporary_directory() as directory:
+            connections = pool.ConnectionPool(os.path.join(directory, 'pool.db'), size=1, timeout=0.05)
+            conn = connections.acquire()
+            assert 'wal' == conn.execute('''PRAGMA journal_mode;''').fetchone()[0]
+            # A full pool times out waiting for a connection
+            with self.assertRaises(sqlite3.OperationalError):
+                connections.acquire()
+            # Released connections are reused, with any transaction left open rolled back
+            conn.execute('''BEGIN;''')
+            connections.release(conn)
+            with connections.connection() as reused:
+                assert reused is conn
+                assert not reused.in_transaction
+            assert {'size': 1, 'open': 1, 'idle': 1, 'connects': 1, 'checkouts': 3, 'waits': 1} == {
+                key: value for key, value in connections.stats().items() if key != 'wait_time'}
+            # Closing closes idle connections at once and checked out ones when released
+            conn = connections.acquire()
+            connections.close()
+            with self.assertRaises(sqlite3.ProgrammingError):
+                connections.acquire()
+            connections.release(conn)
+            assert 0 == connections.stats()['open']
+            with self.assertRaises(sqlite3.ProgrammingError):
+                conn.execute('''SELECT 1;''')
+
+            # The pool of the data layer follows DB_NAME
+            db.DB_NAME = os.path.join(directory, 'first.db')
+            first = db.get_pool()
+            assert first is db.get_pool()
+            db.DB_NAME = os.path.join(directory, 'second.db')
+            second = db.get_pool()
+            assert second is not first and db.DB_NAME == second.database
+            with self.assertRaises(sqlite3.ProgrammingError):
+                first.acquire()
+
+    def test_31_match_ordering(self):
+        with temporary_directory() as directory:
+            db.DB_NAME = os.path.join(directory, 'ordering.db')
+            db.create_db()
+            # Markets and selections come in no particular order from the provider
+            data = json.load(open('newevent.json'))
+            for market in data['event']['markets']:
+                market['selections'].reverse()
+            db.ingest(data)
+            match_id = data['event']['id']
+            expected = sorted((market['id'], sorted(selection['id'] for selection in market['selections']))
+                              for market in data['event']['markets'])
+            match = db.get_match_by_id(match_id)
+            assert expected == [(market['id'], [selection['id'] for selection in market['selections']])
+                                for market in match['markets']]
+            # Loads from database give the same document
+            db.MATCH_CACHE.clear()
+            assert match == db.get_match_by_id(match_id)
+            rows = [(1, 'Winner', 10, 'Home', 1.5), (1, 'Winner', 11, 'Away', 2.5), (2, 'Total', 20, 'Over', 1.9)]
+            assert [{'id': 1, 'name': 'Winner', 'selections': [{'id': 10, 'name': 'Home', 'odds': 1.5},
+                                                               {'id': 11, 'name': 'Away', 'odds': 3.0}]},
+                    {'id': 2, 'name': 'Total', 'selections': [{'id': 20, 'name': 'Over', 'odds': 1.9}]}] == \
+                db._group_markets(rows, {11: 3.0})
+
+    def test_32_statements(self):
+        registry = statements.Registry()
+        insert = registry.register('insert', '''INSERT INTO T VALUES(?, ?);''')
+        select = registry.register('select', '''SELECT B FROM T WHERE A = ?;''')
+        with self.assertRaises(ValueError):
+            registry.register('insert', '''INSERT INTO T VALUES(?, ?);''')
+        assert insert is registry['insert'] and 2 == len(registry)
+        with closing(sqlite3.connect(':memory:')) as conn:
+            cur = conn.cursor()
+            cur.execute('''CREATE TABLE T(A INTEGER, B TEXT);''')
+            # Parameters are bound, so quotes in values need no escaping
+            assert 2 == insert.executemany(cur, [(1, "Newell's Old Boys"), (2, 'River "Millonario"')])
+            assert 1 == insert.execute(cur, (3, None))
+            assert [("Newell's Old Boys",)] == select.fetchall(cur, (1,))
+            assert ('River "Millonario"',) == select.fetchone(cur, (2,))
+            assert select.fetchone(cur, (4,)) is None
+        assert {'calls': 2, 'rows': 3} == {key: insert.stats()[key] for key in ('calls', 'rows')}
+        assert {'calls': 3, 'rows': 2} == {key: select.stats()[key] for key in ('calls', 'rows')}
+
+        # Every statement of the data layer takes its values as parameters and prepares on the schema
+        with temporary_directory('ARCHIVE_DB_NAME') as directory:
+            db.DB_NAME = os.path.join(directory, 'statements.db')
+            db.ARCHIVE_DB_NAME = os.path.join(directory, 'archive.db')
+            db.create_db()
+            db._create_archive()
+            with closing(sqlite3.connect(db.DB_NAME)) as conn:
+                conn.execute('''ATTACH DATABASE ? AS archive;''', (db.ARCHIVE_DB_NAME,))
+                for name in statements.REGISTRY.stats():
+                    sql = statements.REGISTRY[name].sql
+                    assert '%' not in sql and sql.replace("'delete'", '').count("'") == 0, name
+                    numbered = [int(number) for number in re.findall(r'\?(\d+)', sql)]
+                    parameters = max(numbered) if numbered else sql.count('?')
+                    conn.execute('EXPLAIN ' + sql, (None,) * parameters)
+            data = json.load(open('newevent.json'))
+            data['event']['name'] = "Newell's Old Boys vs Rosario Central"
+            db.ingest(data)
+            assert [data['event']['id']] == [match['id'] for match in db.get_match_by_name(data['event']['name'])]
+            assert [data['event']['id']] == [match['id'] for match in db.search_matches("newell's")]
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,573 @@
+# coding=utf-8
+# __author__ = 'Mario Romera Fernández'
+
+# Single writer ingest for several API worker processes
+# SQLite takes one writer at a time, so instead of every worker writing inline and contending on
+# the database lock, workers send provider messages to a dedicated writer process that drains them
+# in group transactions, and stay free to serve reads on every core. Run the writer with:
+#     python writer.py /tmp/betbright-writer.sock
+# and the workers with BETBRIGHT_WRITER=/tmp/betbright-writer.sock in their environment.
+# Without BETBRIGHT_WRITER messages are written inline, as in a single process deployment.
+# A 'host:port' address also needs the same BETBRIGHT_WRITER_KEY in the writer and the workers.
+
+import collections
+import logging
+import os
+import signal
+import sqlite3
+import sys
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+
+import db
+import provider
+
+
+# Writer address: a Unix socket path or 'host:port', None to write inline
+ADDRESS = os.environ.get('BETBRIGHT_WRITER') or None
+
+# Key authenticating workers to the writer. Requests are unpickled by the writer, so whoever can
+# connect can run code on it: without a key only Unix sockets are used, reachable by their owner only
+AUTHKEY = os.environ.get('BETBRIGHT_WRITER_KEY', '').encode('utf-8') or None
+
+# Messages waiting in the writer queue before workers get 429 responses
+QUEUE_DEPTH = 10000
+
+# Messages per group transaction
+BATCH_SIZE = db.INGEST_BATCH_SIZE
+
+# Seconds a worker waits for the writer to answer
+TIMEOUT = 30.0
+
+# Seconds before a worker reconnects its commit subscription
+RECONNECT_INTERVAL = 1.0
+
+# Writer answers
+OK = 'ok'
+BUSY = 'busy'
+FAILED = 'failed'
+SUBSCRIBED = 'subscribed'
+
+logger = logging.getLogger(__name__)
+
+
+class WriterError(Exception):
+    """
+    Raised when the writer process can not be reached or fails to write a batch, or when the
+    database fails to write inline, e.g. locked for longer than db.POOL_TIMEOUT
+    """
+
+
+class QueueFull(WriterError):
+    """
+    Raised when the writer queue is full; the message should be sent again later
+    """
+
+
+class MessageError(ValueError):
+    """
+    Raised for valid messages the writer could not store, e.g. with ids already used by other events
+    """
+
+
+def parse_address(address):
+    """
+    Parses a writer address
+    :param address: STR Unix socket path or 'host:port'
+    :return: STR path or TUPLE (STR host, INT port)
+    :raises WriterError: for 'host:port' addresses without AUTHKEY
+    """
+
+    host, separator, port = address.rpartition(':')
+    if separator and port.isdigit() and '/' not in address:
+        if AUTHKEY is None:
+            raise WriterError('Writer address %s needs BETBRIGHT_WRITER_KEY' % address)
+        return host, int(port)
+    return address
+
+
+class Writer(object):
+    """
+    Writer process side: a bounded queue of messages drained by a single thread in group
+    transactions with db.ingest_batch
+
+    Each worker thread holds a connection and sends one batch at a time, waiting for its results,
+    so whatever batches arrive while a transaction commits are written together in the next one.
+    Worker processes also subscribe to the messages committed, to keep their in-memory state
+    (match cache, odds book, odds stream) in step with the database.
+    """
+
+    def __init__(self, address, depth=None, batch_size=None):
+        """
+        :param address: STR Unix socket path or 'host:port'
+        :param depth: INT maximum number of queued messages, QUEUE_DEPTH by default
+        :param batch_size: INT maximum number of messages per transaction, BATCH_SIZE by default
+        """
+
+        self.address = parse_address(address)
+        self.depth = depth or QUEUE_DEPTH
+        self.batch_size = batch_size or BATCH_SIZE
+        self._queue = collections.deque()
+        self._queued = 0
+        self._closing = False
+        self._cond = threading.Condition()
+        self._subscribers = set()
+        self._subscribers_lock = threading.Lock()
+        self._listener = None
+        self._drainer = None
+
+        # Stats
+        self._batches = 0
+        self._messages = 0
+        self._rejected = 0
+
+    def start(self):
+        """
+        Starts listening for workers and draining the queue
+        :return: None
+        """
+
+        if isinstance(self.address, str):
+            if os.path.exists(self.address):
+                os.remove(self.address)
+            # The socket is created accessible by its owner only
+            umask = os.umask(0o177)
+            try:
+                self._listener = Listener(self.address, authkey=AUTHKEY)
+            finally:
+                os.umask(umask)
+        else:
+            self._listener = Listener(self.address, authkey=AUTHKEY)
+        threading.Thread(target=self._accept, name='writer-accept', daemon=True).start()
+        self._drainer = threading.Thread(target=self._drain, name='writer-drain')
+        self._drainer.start()
+
+    def close(self):
+        """
+        Stops accepting messages and waits until the queued ones are written
+        :return: None
+        """
+
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        try:
+            self._listener.close()
+        except OSError:
+            pass
+        self._drainer.join()
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.remove(self.address)
+
+    def _accept(self):
+        """
+        Accepts worker connections, serving each one from its own thread
+        :return: None
+        """
+
+        while True:
+            try:
+                conn = self._listener.accept()
+            except OSError:
+                if self._closing:
+                    return
+                logger.exception('Failed to accept a worker connection')
+                continue
+            threading.Thread(target=self._serve, args=(conn,), name='writer-connection', daemon=True).start()
+
+    def _serve(self, conn):
+        """
+        Reads requests from a worker connection: ('ingest', messages), ('subscribe',) or ('stats',)
+        :param conn: multiprocessing.connection.Connection
+        :return: None
+        """
+
+        lock = threading.Lock()
+        try:
+            while True:
+                request = conn.recv()
+                if request[0] == 'ingest':
+                    if not self.submit(request[1], conn, lock):
+                        self._send(conn, lock, (BUSY, None))
+                elif request[0] == 'subscribe':
+                    # Acknowledged once registered, before any commit is sent on the connection
+                    with lock:
+                        with self._subscribers_lock:
+                            self._subscribers.add((conn, lock))
+                        conn.send((SUBSCRIBED, None))
+                    return
+                elif request[0] == 'stats':
+                    self._send(conn, lock, (OK, self.stats()))
+        except (EOFError, OSError):
+            conn.close()
+
+    @staticmethod
+    def _send(conn, lock, answer):
+        """
+        Sends an answer to a worker, ignoring workers gone meanwhile
+        :param conn: multiprocessing.connection.Connection
+        :param lock: threading.Lock of the connection
+        :param answer: TUPLE answer
+        :return: BOOLEAN False if the worker is gone
+        """
+
+        try:
+            with lock:
+                conn.send(answer)
+        except (OSError, ValueError):
+            return False
+        return True
+
+    def submit(self, messages, conn, lock):
+        """
+        Queues messages, unless the queue is full or closing
+        :param messages: LIST of DICT or provider.Message
+        :param conn: multiprocessing.connection.Connection to answer to
+        :param lock: threading.Lock of the connection
+        :return: BOOLEAN False if the messages were rejected
+        """
+
+        with self._cond:
+            if self._closing or (self._queued and self._queued + len(messages) > self.depth):
+                self._rejected += len(messages)
+                return False
+            self._queue.append((messages, conn, lock))
+            self._queued += len(messages)
+            self._cond.notify()
+        return True
+
+    def _take(self):
+        """
+        Waits for queued messages and takes up to batch_size of them, whole requests only
+        :return: LIST of (LIST messages, conn, lock) or None when closed and drained
+        """
+
+        with self._cond:
+            while not self._queue:
+                if self._closing:
+                    return None
+                self._cond.wait()
+            requests = [self._queue.popleft()]
+            count = len(requests[0][0])
+            while self._queue and count + len(self._queue[0][0]) <= self.batch_size:
+                requests.append(self._queue.popleft())
+                count += len(requests[-1][0])
+            self._queued -= count
+        return requests
+
+    def _drain(self):
+        """
+        Writes queued messages in group transactions until closed and drained
+        :return: None
+        """
+
+        while True:
+            requests = self._take()
+            if requests is None:
+                return
+            messages = [message for request_messages, _, _ in requests for message in request_messages]
+            try:
+                results = db.ingest_batch(messages)
+            except Exception as error:
+                logger.exception('Failed to write a batch of %i messages', len(messages))
+                for _, conn, lock in requests:
+                    self._send(conn, lock, (FAILED, str(error)))
+                continue
+            self._batches += 1
+            self._messages += len(messages)
+
+            # Subscribers are told before the senders get their results, so a worker answering a
+            # provider has usually seen the commit already
+            # Subscribers get the messages decoded, processed messages are valid
+            self._publish([provider.validate(message) for message, result in zip(messages, results)
+                           if result['status'] == db.PROCESSED])
+            start = 0
+            for request_messages, conn, lock in requests:
+                self._send(conn, lock, (OK, results[start:start + len(request_messages)]))
+                start += len(request_messages)
+
+    def _publish(self, messages):
+        """
+        Sends committed messages to the subscribed workers, dropping the ones gone
+        :param messages: LIST of provider.Message committed
+        :return: None
+        """
+
+        if not messages:
+            return
+        with self._subscribers_lock:
+            subscribers = list(self._subscribers)
+        for conn, lock in subscribers:
+            if not self._send(conn, lock, ('committed', messages)):
+                with self._subscribers_lock:
+                    self._subscribers.discard((conn, lock))
+
+    def stats(self):
+        """
+        Writer counters
+        :return: DICT writer stats
+        """
+
+        with self._cond:
+            queued = self._queued
+        with self._subscribers_lock:
+            subscribers = len(self._subscribers)
+        return {'queued': queued,
+                'depth': self.depth,
+                'batches': self._batches,
+                'messages': self._messages,
+                'rejected': self._rejected,
+                'subscribers': subscribers}
+
+
+class WriterClient(object):
+    """
+    Worker process side: sends messages to the writer and waits for their results
+    Every thread uses its own connection, opened on first use and again after errors
+    """
+
+    def __init__(self, address, timeout=None):
+        """
+        :param address: STR Unix socket path or 'host:port'
+        :param timeout: FLOAT seconds to wait for the writer to answer, TIMEOUT by default
+        """
+
+        self.address = parse_address(address)
+        self.timeout = timeout or TIMEOUT
+        self._local = threading.local()
+
+    def _request(self, request):
+        """
+        Sends a request on the connection of the current thread and waits for its answer
+        Requests are retried once on a new connection if the cached one is broken: messages sent
+        twice are found to be duplicates by the writer
+        :param request: TUPLE request
+        :return: answer data
+        """
+
+        for attempt in range(2):
+            conn = getattr(self._local, 'conn', None)
+            fresh = conn is None
+            try:
+                if fresh:
+                    conn = self._local.conn = Client(self.address, authkey=AUTHKEY)
+                conn.send(request)
+                if not conn.poll(self.timeout):
+                    self._drop()
+                    raise WriterError('Timed out waiting for the writer')
+                status, data = conn.recv()
+                break
+            except (EOFError, OSError) as error:
+                self._drop()
+                if fresh or attempt:
+                    raise WriterError('Writer unavailable: %s' % error)
+        if status == BUSY:
+            raise QueueFull('Writer queue full')
+        if status == FAILED:
+            raise WriterError('Writer failed: %s' % data)
+        return data
+
+    def _drop(self):
+        """
+        Closes the connection of the current thread
+        :return: None
+        """
+
+        conn = getattr(self._local, 'conn', None)
+        self._local.conn = None
+        if conn is not None:
+            conn.close()
+
+    def ingest_batch(self, messages):
+        """
+        Remote db.ingest_batch
+        :param messages: LIST of DICT or provider.Message received from external provider
+        :return: LIST of DICT {'id', 'status', ['error'], ['changed', 'unchanged', 'unknown']} per message, in the same order
+        """
+
+        return self._request(('ingest', messages))
+
+    def stats(self):
+        """
+        Stats of the writer process
+        :return: DICT writer stats
+        """
+
+        return self._request(('stats',))
+
+    def subscribe(self):
+        """
+        Keeps the in-memory state of this process in step with the writer commits
+        Runs forever, reconnecting after errors; in-memory state is reset on every connection
+        since commits may have been missed while disconnected, once the writer acknowledges the
+        subscription so no commit is missed between the reset and the registration
+        :return: None
+        """
+
+        while True:
+            try:
+                conn = Client(self.address, authkey=AUTHKEY)
+            except OSError:
+                time.sleep(RECONNECT_INTERVAL)
+                continue
+            try:
+                conn.send(('subscribe',))
+                if not conn.poll(self.timeout) or conn.recv()[0] != SUBSCRIBED:
+                    raise OSError('No subscription acknowledgement')
+                db.reset_memory()
+                while True:
+                    kind, messages = conn.recv()
+                    if kind == 'committed':
+                        db.apply_committed(messages)
+            except (EOFError, OSError):
+                logger.warning('Lost the writer commit subscription, reconnecting')
+            finally:
+                conn.close()
+            time.sleep(RECONNECT_INTERVAL)
+
+
+_client = None
+_client_lock = threading.Lock()
+_subscriber = None
+
+
+def get_client():
+    """
+    Returns the client of the writer at ADDRESS, creating it on first use
+    :return: WriterClient
+    """
+
+    global _client
+    with _client_lock:
+        if _client is None or _client.address != parse_address(ADDRESS):
+            _client = WriterClient(ADDRESS)
+        return _client
+
+
+def start_subscriber():
+    """
+    Starts the thread keeping this worker in step with the writer commits, if it is not running
+    :return: None
+    """
+
+    global _subscriber
+    client = get_client()
+    with _client_lock:
+        if _subscriber is None:
+            _subscriber = threading.Thread(target=client.subscribe, name='writer-subscriber', daemon=True)
+            _subscriber.start()
+
+
+_worker_started = False
+_worker_lock = threading.Lock()
+
+
+def start_worker():
+    """
+    Prepares this process to serve the API, once: without a writer process the database is upgraded
+    and its maintenance started, otherwise the process subscribes to the writer commits
+    Called on the first request, so it also runs in worker processes started by a WSGI server
+    :return: None
+    """
+
+    global _worker_started
+    if _worker_started:
+        return
+    with _worker_lock:
+        if _worker_started:
+            return
+        if ADDRESS is None:
+            db.upgrade_db()
+            db.start_maintenance()
+        else:
+            start_subscriber()
+        _worker_started = True
+
+
+def ingest(message, result=None):
+    """
+    db.ingest through the writer process when ADDRESS is set, inline otherwise
+    Messages are validated in the worker, bad ones never reach the writer process
+    :param message: DICT or provider.Message received from external provider
+    :param result: DICT filled with 'changed', 'unchanged' and 'unknown' selections for 'UpdateOdds' messages
+    :return: BOOLEAN True if the message has been processed, False if it had been already processed
+    :raises provider.MessageError: if the message is not valid
+    :raises MessageError: if the writer could not process the message
+    :raises WriterError: if the message could not be written now, it can be sent again
+    """
+
+    message = provider.validate(message)
+    if ADDRESS is None:
+        # Reported as the writer process reports them
+        try:
+            return db.ingest(message, result)
+        except db.MessageWriteError as error:
+            raise MessageError(str(error))
+        except sqlite3.OperationalError as error:
+            raise WriterError('Database unavailable: %s' % error)
+
+    status = get_client().ingest_batch([message])[0]
+    if status['status'] == db.ERROR:
+        raise MessageError(status['error'])
+    if result is not None:
+        result.update((key, status[key]) for key in ('changed', 'unchanged', 'unknown') if key in status)
+    return status['status'] == db.PROCESSED
+
+
+def ingest_batch(messages):
+    """
+    db.ingest_batch through the writer process when ADDRESS is set, inline otherwise
+    :param messages: LIST of DICT or provider.Message received from external provider
+    :return: LIST of DICT {'id', 'status', ['error'], ['changed', 'unchanged', 'unknown']} per message, in the same order
+    :raises WriterError: if the messages could not be written now, they can be sent again
+    """
+
+    if ADDRESS is None:
+        try:
+            return db.ingest_batch(messages)
+        except sqlite3.OperationalError as error:
+            raise WriterError('Database unavailable: %s' % error)
+    return get_client().ingest_batch(messages)
+
+
+def stats():
+    """
+    Stats of the data layer of this process, with the ones of the writer process if there is one
+    :return: DICT stats by component
+    """
+
+    data_stats = db.stats()
+    if ADDRESS is not None:
+        try:
+            data_stats['writer'] = get_client().stats()
+        except WriterError as error:
+            data_stats['writer'] = {'error': str(error)}
+    return data_stats
+
+
+def main(address):
+    """
+    Runs the writer process until SIGTERM or SIGINT, then drains the queue
+    :param address: STR Unix socket path or 'host:port'
+    :return: None
+    """
+
+    logging.basicConfig(level=logging.INFO)
+    db.upgrade_db()
+    db.start_maintenance()
+    writer = Writer(address)
+    writer.start()
+    stop = threading.Event()
+    for signal_number in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signal_number, lambda *_: stop.set())
+    logger.info('Writer listening on %s', address)
+    while not stop.wait(1.0):
+        pass
+    logger.info('Draining %i queued messages', writer.stats()['queued'])
+    writer.close()
+
+
+if __name__ == '__main__':
+
+    main(sys.argv[1] if len(sys.argv) > 1 else ADDRESS or 'BetBright.writer.sock')